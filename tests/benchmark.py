@@ -0,0 +1,297 @@
+"""
+Reproducible benchmarks of ImageTeller against the naive approach. Every measurement is printed as one json line so
+results can be saved, diffed and plotted.
+
+    python -m tests.benchmark --counts 10 100 1000 --sizes 10 100 --engines procedures tree hash > results.jsonl
+
+suites:
+    tell: build time, build memory, tell latency percentiles and probe counts against naive_tell on synthetic images,
+        followed by the crossover points, i.e. from how many images on a teller stays faster than naive_tell, and from
+        how many images on the 'hash' engine stays faster than every engine that probes
+    build: the stacked construction against the pairwise one
+    locate: ImageTeller.locate against cv2.matchTemplate on a 1920x1080 frame
+    parallel: images read and told per second by a ParallelTeller of 1, 2, 4... processes
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List, Tuple
+
+import numpy as np
+from cv2 import cv2
+
+from tests.main_test import generate_near_duplicates, generate_screenshot
+from whichimg import ParallelTeller
+from whichimg.main import ImageTeller, ENGINES
+
+
+def naive_tell(images, sample_img):
+    for i, img in enumerate(images):
+        if np.array_equal(img, sample_img):
+            return i
+    return -1
+
+
+def generate_images(count, size, channels=3, duplicates=0.0, seed=0) -> List[np.ndarray]:
+    """
+    :param duplicates: the share of images that are near duplicates of one base image, i.e. differ from it in a few
+        pixels. The rest are random.
+    """
+    rng = np.random.RandomState(seed)
+    base = rng.randint(0, 256, (size, size, channels)).astype(np.uint8)
+    images = []
+    seen = set()
+
+    while len(images) < count:
+        if rng.rand() < duplicates:
+            img = base.copy()
+            changed = rng.randint(1, 4)
+            img[rng.randint(0, size, changed), rng.randint(0, size, changed)] = rng.randint(0, 256, (changed, channels))
+        else:
+            img = rng.randint(0, 256, (size, size, channels)).astype(np.uint8)
+
+        if img.tobytes() not in seen:
+            seen.add(img.tobytes())
+            images.append(img)
+
+    return images
+
+
+def percentiles(seconds: List[float]) -> dict:
+    microseconds = np.array(seconds) * 1e6
+    return {'mean_us': float(microseconds.mean()),
+            'p50_us': float(np.percentile(microseconds, 50)),
+            'p90_us': float(np.percentile(microseconds, 90)),
+            'p99_us': float(np.percentile(microseconds, 99))}
+
+
+def time_each(tell, queries, repeat) -> List[float]:
+    seconds = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            tell(query)
+            seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def bench_tell(counts, sizes, channels, duplicates, engines, surprise_share, repeat, seed):
+    results = []
+
+    for count, size, channel_count, duplicate_share in itertools.product(counts, sizes, channels, duplicates):
+        images = generate_images(count, size, channel_count, duplicate_share, seed)
+        surprise_count = int(round(count * surprise_share))
+        # surprises come from the same distribution, but aren't possible images
+        surprises = generate_images(count + surprise_count, size, channel_count, duplicate_share, seed)[count:]
+        surprises = [img for img in surprises if naive_tell(images, img) == -1]
+        queries = images + surprises
+        config = {'count': count, 'size': size, 'channels': channel_count, 'duplicates': duplicate_share,
+                  'surprises': len(surprises)}
+
+        naive = time_each(lambda img: naive_tell(images, img), queries, repeat)
+        record = dict(config, suite='tell', engine='naive', **percentiles(naive))
+        results.append(record)
+        print(json.dumps(record), flush=True)
+
+        for engine in engines:
+            tracemalloc.start()
+            start = time.perf_counter()
+            teller = ImageTeller(images, engine=engine)
+            build_seconds = time.perf_counter() - start
+            _, build_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            probes = []
+            for query in queries:
+                trace = []
+                teller._tell(query, trace)
+                probes.append(len(trace))
+
+            record = dict(config, suite='tell', engine=engine, build_s=build_seconds, build_peak_bytes=build_peak,
+                          probes_mean=float(np.mean(probes)), probes_max=int(np.max(probes)),
+                          **percentiles(time_each(teller.tell, queries, repeat)))
+            record['speedup'] = np.mean(naive) * 1e6 / record['mean_us']
+            results.append(record)
+            print(json.dumps(record), flush=True)
+
+    for engine in engines:  # from how many images on the engine stays faster than naive_tell
+        for size, channel_count, duplicate_share in itertools.product(sizes, channels, duplicates):
+            same = sorted((r for r in results if r['engine'] == engine and r['size'] == size and
+                           r['channels'] == channel_count and r['duplicates'] == duplicate_share),
+                          key=lambda r: r['count'])
+            crossover = None
+            for record in reversed(same):
+                if record['speedup'] <= 1:
+                    break
+                crossover = record['count']
+            print(json.dumps({'suite': 'tell', 'crossover': engine, 'against': 'naive', 'size': size,
+                              'channels': channel_count, 'duplicates': duplicate_share, 'count': crossover}), flush=True)
+
+    if 'hash' in engines:  # from how many images on hashing stays faster than probing
+        for engine, size, channel_count, duplicate_share in itertools.product(
+                [engine for engine in engines if engine != 'hash'], sizes, channels, duplicates):
+            crossover = None
+            for count in sorted(counts, reverse=True):
+                latencies = {r['engine']: r['mean_us'] for r in results if
+                             r['count'] == count and r['size'] == size and r['channels'] == channel_count and
+                             r['duplicates'] == duplicate_share}
+                if latencies['hash'] >= latencies[engine]:
+                    break
+                crossover = count
+            print(json.dumps({'suite': 'tell', 'crossover': 'hash', 'against': engine, 'size': size,
+                              'channels': channel_count, 'duplicates': duplicate_share, 'count': crossover}), flush=True)
+
+
+def pairwise_procedures(teller, shape):
+    """
+    the procedures of the images of <shape> the way ImageTeller first built them, image by image: every procedure
+    probes the first pixel where the examined image differs from the last image still possible besides it. The baseline
+    of the build suite
+    """
+    procedures = dict()
+    indexes = teller._shapeToImgIndexes[shape]
+    if len(indexes) == 1:  # There's only one image in a particular shape
+        return procedures
+
+    for this_index in indexes:
+        procedures_for_progress = []
+        this_possibilities = indexes.copy()
+        while True:  # generate procedures that's enough to determine a certain pic
+            diff_r, diff_c, this_color, that_color = pairwise_diff(teller, this_index, this_possibilities)
+
+            that_possibilities = []
+            neither_possibilities = []
+            for index in indexes:
+                color = teller._possible_images[index][diff_r][diff_c]
+                if not np.array_equal(color, this_color):
+                    if index in this_possibilities:
+                        this_possibilities.remove(index)
+                    if np.array_equal(color, that_color):
+                        that_possibilities.append(index)
+                    else:
+                        neither_possibilities.append(index)
+
+            procedures_for_progress.append(
+                ((diff_r, diff_c), this_color, that_color, set(this_possibilities), set(that_possibilities),
+                 set(neither_possibilities)))
+            if len(this_possibilities) == 1:
+                break
+
+        procedures[this_index] = procedures_for_progress
+    return procedures
+
+
+def pairwise_diff(teller, examined_img_index, possibilities):
+    """
+    :return: row, column, and the colors of the examined image and of the last other image of <possibilities> at the
+        first pixel where they differ
+    """
+    that_index = [possibility for possibility in possibilities if possibility != examined_img_index][-1]
+    this_img = teller._possible_images[examined_img_index]
+    that_img = teller._possible_images[that_index]
+
+    this_mask, that_mask = teller._masks[examined_img_index], teller._masks[that_index]
+    usable = this_mask if that_mask is None else that_mask if this_mask is None else this_mask & that_mask
+
+    differing = np.any(this_img != that_img, axis=-1)
+    if usable is not None:
+        differing &= usable
+    diff_r, diff_c = np.argwhere(differing)[0]
+    return diff_r, diff_c, this_img[diff_r][diff_c], that_img[diff_r][diff_c]
+
+
+def bench_build(counts, size, seed):
+    for count in counts:
+        teller = ImageTeller(generate_near_duplicates(count, size, seed=seed))
+        shape = (size, size)
+
+        start = time.perf_counter()
+        pairwise_procedures(teller, shape)
+        pairwise = time.perf_counter() - start
+
+        start = time.perf_counter()
+        teller._produce_procedures_of_shape(shape)
+        stacked = time.perf_counter() - start
+
+        print(json.dumps({'suite': 'build', 'count': count, 'size': size, 'pairwise_s': pairwise,
+                          'stacked_s': stacked, 'speedup': pairwise / stacked}), flush=True)
+
+
+def match_template(frame, templates) -> List[Tuple[int, int, int]]:
+    matches = []
+    for index, template in enumerate(templates):
+        # float rounding makes exact matches slightly above 0
+        ys, xs = np.nonzero(cv2.matchTemplate(frame, template, cv2.TM_SQDIFF) < 0.01 * template.size)
+        height, width = template.shape[:2]
+        matches.extend((index, x, y) for y, x in zip(ys.tolist(), xs.tolist()) if
+                       np.array_equal(frame[y:y + height, x:x + width], template))
+    return matches
+
+
+def bench_locate(repeat, seed):
+    frame, templates, places = generate_screenshot(1080, 1920, seed)
+    teller = ImageTeller(templates)
+
+    assert sorted(teller.locate(frame)) == sorted(match_template(frame, templates)) == sorted(places)
+
+    located = min(time_each(teller.locate, [frame], repeat))
+    matched = min(time_each(lambda img: match_template(img, templates), [frame], repeat))
+    print(json.dumps({'suite': 'locate', 'frame': '1920x1080', 'count': len(templates), 'locate_s': located,
+                      'match_template_s': matched, 'speedup': matched / located}), flush=True)
+
+
+def bench_parallel(count, size, seed):
+    images = generate_images(count, size, seed=seed)
+    teller = ImageTeller(images)
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = []
+        for number, img in enumerate(images * 10):
+            files.append(os.path.join(directory, '%d.png' % number))
+            cv2.imwrite(files[-1], img)
+
+        processes = 1
+        while processes <= (os.cpu_count() or 1):
+            with ParallelTeller(teller, processes) as parallel:
+                list(parallel.tell_files(files[:processes * 64]))  # warm up the workers
+                start = time.perf_counter()
+                list(parallel.tell_files(files))
+                seconds = time.perf_counter() - start
+            print(json.dumps({'suite': 'parallel', 'processes': processes, 'files': len(files), 'size': size,
+                              'files_per_s': len(files) / seconds}), flush=True)
+            processes *= 2
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark ImageTeller, one json line per measurement")
+    parser.add_argument('--suites', nargs='+', default=['tell', 'build', 'locate', 'parallel'],
+                        choices=['tell', 'build', 'locate', 'parallel'])
+    parser.add_argument('--counts', nargs='+', type=int, default=[2, 10, 50, 200])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 50, 200])
+    parser.add_argument('--channels', nargs='+', type=int, default=[3])
+    parser.add_argument('--duplicates', nargs='+', type=float, default=[0.0, 0.9],
+                        help="shares of near duplicate images")
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--surprises', type=float, default=0.2, help="unknown queries per possible image")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if 'tell' in args.suites:
+        bench_tell(args.counts, args.sizes, args.channels, args.duplicates, args.engines, args.surprises,
+                   args.repeat, args.seed)
+    if 'build' in args.suites:
+        bench_build(args.counts, 100, args.seed)
+    if 'locate' in args.suites:
+        bench_locate(args.repeat, args.seed)
+    if 'parallel' in args.suites:
+        bench_parallel(max(args.counts), 100, args.seed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,17 +1,24 @@
+import asyncio
+import csv
 import glob
+import json
 import os
 import random
 import subprocess
 import sys
-import time
+import tempfile
+import tracemalloc
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 from typing import List, Tuple, Dict
 
 import numpy as np
 from cv2 import cv2
 
-from whichimg.main import ImageTeller
+from whichimg import TemplateStore, ParallelTeller, ScreenWatcher, tell_regions, build_index, template_checksum, \
+    MultiScaleTeller
+from whichimg.main import ImageTeller, ENGINES, cmd
 
 FILE_DIR = os.path.dirname(__file__)
 
@@ -125,112 +132,989 @@ class MyTestCase(unittest.TestCase):
                     self.assertEqual(t.tell(img), dd)
 
 
+    def test_tree_telling_w_surprises(self):
+        repeat = 30
 
-    def test_cmd(self):
-        cmd = ' '.join((sys.executable, path.join('..', 'whichimg', 'main.py')))
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, _ = p.communicate()
+        for i in range(2, len(ALL_IMAGES) - 1):
+            for j in range(repeat):
+                training, surprises = get_teller_surprise_images_pair(i)
 
-        res = stdout.decode(encoding='utf-8').strip()
-        print("command line result:", res)
+                training_images = list(training.values())
+                t = ImageTeller(training_images, surprises=True, engine='tree')
 
-    def tearDown(self) -> None:
-        os.chdir(MyTestCase.oldDir)
+                for s in surprises.values():
+                    self.assertEqual(t.tell(s), -1)
 
+                for dd, img in enumerate(training_images):
+                    self.assertEqual(t.tell(img), dd)
 
-def generate_grey_scale_fixtures():
-    files = [file for file in glob.glob(path.join(FILE_DIR, 'fixtures', '*.png')) if not (file.endswith('bw.png'))]
-    images = [cv2.imread(file, cv2.IMREAD_GRAYSCALE) for file in files]
-    print(len(images), 'non bw images is going to be converted to greyscale')
-    for i in range(len(images)):
-        cv2.imwrite(path.join(FILE_DIR, files[i].split('.')[0] + '_bw.png'), images[i])
+    def test_tree_depth(self):
+        rng = np.random.RandomState(0)
+        images = [rng.randint(0, 4, (20, 20, 3)).astype(np.uint8) for _ in range(256)]
+        t = ImageTeller(images, engine='tree')
 
-def naive_tell(images, sample_img):
-    for i, img in enumerate(images):
-        if np.array_equal(img, sample_img):
-            return i
-    return -1
+        def depth(node):
+            if type(node) is not tuple:
+                return 0
+            return 1 + max(depth(child) for child in node[1].values())
 
+        self.assertLessEqual(depth(t._shapeToTree[(20, 20)]), 8)
+        for dd, img in enumerate(images):
+            self.assertEqual(t.tell(img), dd)
 
+    def test_hash_telling_w_surprises(self):
+        repeat = 30
 
-def compare_shit_w_surprise():
-    repeat = 20
-    length = len(ALL_IMAGES)
+        for i in range(2, len(ALL_IMAGES) - 1):
+            for j in range(repeat):
+                training, surprises = get_teller_surprise_images_pair(i)
 
-    pairs = []
+                training_images = list(training.values())
+                t = ImageTeller(training_images, surprises=True, engine='hash')
 
-    for i in range(2, length - 1):
-        for j in range(repeat):
+                for s in surprises.values():
+                    self.assertEqual(t.tell(s), -1)
+
+                for dd, img in enumerate(training_images):
+                    self.assertEqual(t.tell(img), dd)
 
-            training, surprises = get_teller_surprise_images_pair(i)
+    def test_hash_accepts_what_tell_accepts(self):
+        big = get_fixture_img('bloody_sea')
+        images = [phage, phage_blue_face_bw, big[:10, :10].copy()]
+        t = ImageTeller(images, engine='hash')
+        reference = ImageTeller(images)
+
+        queries = [phage_blue_face_bw[..., 0], big[:10, :10], big[5:15, 5:15], phage_demon_horns]
+        for query in queries:
+            self.assertEqual(t.tell(query), reference.tell(query))
+        self.assertEqual(t.tell(phage_blue_face_bw[..., 0]), 1)
+        self.assertEqual(t.tell(big[:10, :10]), 2)
+
+        # other dtypes are cast to the one of the possible images before they're hashed
+        deep = [img.astype(np.uint16) * 257 for img in generate_near_duplicates(3, 12, seed=8)]
+        images += deep
+        tellers = [ImageTeller(images, engine=engine) for engine in ENGINES]
+        queries = [phage.astype(np.uint16), phage.astype(np.int64), phage.astype(np.float64),
+                   phage.astype(np.float64) + 0.5, phage_blue_face_bw[..., 0].astype(np.float32),
+                   big[:10, :10].astype(np.int32) + 256, deep[1].astype(np.int64), deep[2] // 257,
+                   deep[0].astype(np.float64), (deep[0] // 257).astype(np.uint8)]
+        expected = [0, 0, 0, -1, 1, -1, 4, -1, 3, -1]
+        for teller in tellers:
+            self.assertEqual([teller.tell(query) for query in queries], expected)
+
+    def test_packed_telling_w_surprises(self):
+        for i in range(2, len(ALL_IMAGES) - 1):
+            for j in range(5):
+                training, surprises = get_teller_surprise_images_pair(i)
+                training_images = list(training.values())
+                t = ImageTeller(training_images, engine='packed')
+                reference = ImageTeller(training_images)
 
-            pairs.append((list(training.values()), surprises.values()))
+                for img in surprises.values():
+                    self.assertEqual(t.tell(img), -1)
+                for dd, img in enumerate(training_images):
+                    self.assertEqual(t.tell(img), dd)
+                    self.assertEqual(t._probe_pixels_of(dd), reference._probe_pixels_of(dd))
 
+    def test_packed_reads_any_pixel_width(self):
+        images = [img.astype(np.uint16) * 257 for img in generate_near_duplicates(20, 30)]  # 6 bytes per pixel
+        images += [np.dstack([img, img[..., :1]])[:20, :20].copy() for img in images[:5]]  # 8 bytes per pixel
+        t = ImageTeller(images, engine='packed')
 
-    tellers = []
-    for training_images, _ in pairs:
-        tellers.append(ImageTeller(training_images,surprises=True))
+        for dd, img in enumerate(images):
+            self.assertEqual(t.tell(img), dd)
+        self.assertEqual(t.tell(images[0].astype(np.uint8)), -1)
 
-    time1 = time.time()
-    for training_images, surprise_images in pairs:
+    def test_tell_many(self):
+        repeat = 10
 
-            for s in surprise_images:
-                naive_tell(training_images, s)
-            for img in training_images:
-                naive_tell(training_images, img)
+        for i in range(2, len(ALL_IMAGES) - 1):
+            for j in range(repeat):
+                training, surprises = get_teller_surprise_images_pair(i)
+                training_images = list(training.values())
 
-    print(time.time()-time1)
+                for engine in ENGINES:
+                    t = ImageTeller(training_images, engine=engine)
+                    queries = list(surprises.values()) + training_images + [img[..., 0] for img in training_images]
+                    random.shuffle(queries)
+
+                    self.assertEqual(t.tell_many(queries).tolist(), [t.tell(img) for img in queries])
+
+    def test_tell_many_stacked(self):
+        images = generate_near_duplicates(50, 20)
+        t = ImageTeller(images)
+        batch = np.stack(images + generate_near_duplicates(10, 20, seed=1))
+
+        answers = t.tell_many(batch, chunk=7)
+        self.assertEqual(answers.tolist(), list(range(50)) + [-1] * 10)
+
+    def test_tell_many_walks_own_engine(self):
+        images = generate_near_duplicates(80, 30, seed=4)
+        weights = [50 if index % 7 == 0 else 1 for index in range(len(images))]
+        unknown = generate_near_duplicates(20, 30, seed=4 + 1)
+        masks = [None] * len(images)
+        masks[3] = np.zeros((30, 30), dtype=bool)
+        masks[3][5:20, 5:20] = True
+        on_background = np.where(masks[3][..., None], images[3], 255 - images[3])
+        queries = images + unknown + [on_background, images[3][..., ::-1]]
+
+        for engine in ('procedures', 'packed'):
+            for t in (ImageTeller(images, engine=engine, weights=weights), ImageTeller(images, engine=engine,
+                                                                                        masks=masks)):
+                self.assertEqual(t.tell_many(queries).tolist(), [t.tell(img) for img in queries])
+                self.assertFalse(t._shapeToTree)  # no tree is built on the side
+
+                with tempfile.TemporaryDirectory() as directory:
+                    t.save(path.join(directory, 'teller.whichimg'))
+                    loaded = ImageTeller.load(path.join(directory, 'teller.whichimg'))
+                    self.assertEqual(loaded.tell_many(np.stack(queries)).tolist(), [t.tell(img) for img in queries])
+
+        t = ImageTeller(images, engine='hash')
+        self.assertEqual(t.tell_many(queries).tolist(), [t.tell(img) for img in queries])
+        self.assertFalse(t._shapeToTree)
+
+    def test_tell_many_any_dtype(self):
+        images = generate_near_duplicates(6, 12, seed=5)
+        floats = [img.astype(np.float64) for img in images]  # pixels of 24 bytes can't be packed for a tree
+        queries = floats + [img + 0.5 for img in floats] + images
+
+        for engine in ('procedures', 'hash'):
+            t = ImageTeller(floats, engine=engine)
+            self.assertEqual(t.tell_many(queries).tolist(), [t.tell(img) for img in queries])
+            self.assertEqual(t.tell_many(np.stack(floats)).tolist(), list(range(6)))
+
+        for engine in ENGINES:
+            t = ImageTeller(images, engine=engine)
+            queries = [img.astype(np.int64) for img in images] + [img.astype(np.int64) + 256 for img in images]
+            self.assertEqual(t.tell_many(queries).tolist(), [t.tell(img) for img in queries])
+            self.assertEqual(t.tell_many(queries).tolist(), list(range(6)) + [-1] * 6)
+
+    def test_save_load(self):
+        training, surprises = get_teller_surprise_images_pair(8)
+        training_images = list(training.values()) + [ALL_IMAGES[0]]  # never sampled as training
+
+        with tempfile.TemporaryDirectory() as directory:
+            for engine in ENGINES:
+                file = path.join(directory, engine + '.whichimg')
+                ImageTeller(training_images, engine=engine).save(file)
+
+                t = ImageTeller.load(file, possible_images=training_images)
+                for s in surprises.values():
+                    self.assertEqual(t.tell(s), -1)
+                for dd, img in enumerate(training_images):
+                    self.assertEqual(t.tell(img), dd)
+                self.assertEqual(t.tell_many(training_images).tolist(), list(range(len(training_images))))
 
-    time2 = time.time()
-    lll = 0
-    for training_images, surprise_images in pairs:
-        t = tellers[lll]
-        for s in surprise_images:
-            t.tell(s)
+                with self.assertRaises(ValueError):
+                    ImageTeller.load(file, possible_images=training_images[::-1])
 
-        for img in training_images:
-            t.tell(img)
-        lll += 1
-    print(time.time() - time2)
+            with open(file, 'r+b') as f:
+                f.write(b'NOTWHICH')
+            with self.assertRaises(ValueError):
+                ImageTeller.load(file)
 
+    def test_template_store(self):
+        training, surprises = get_teller_surprise_images_pair(8)
+        training_images = list(training.values())
 
-def compare_shit_wo_surprise():
-    repeat = 18
-    length = len(ALL_IMAGES)
+        with tempfile.TemporaryDirectory() as directory:
+            file = path.join(directory, 'templates.whichimg')
+            t = ImageTeller(training_images, store_path=file)
+            shared = ImageTeller(TemplateStore.open(file), engine='tree')
 
-    training_image_sets = []
+            for teller in (t, shared):
+                for shape, indexes in teller._shapeToImgIndexes.items():
+                    stack = teller._store.stacks[shape]
+                    self.assertIsInstance(stack.base, np.memmap)
+                    for index in indexes:
+                        self.assertTrue(np.shares_memory(teller._possible_images[index], stack))
 
-    for i in range(2, length - 1):
-        for j in range(repeat):
+                for s in surprises.values():
+                    self.assertEqual(teller.tell(s), -1)
+                for dd, img in enumerate(training_images):
+                    self.assertEqual(teller.tell(img), dd)
 
-            training = get_training_images(i)
+            del t, shared, teller, stack
 
-            training_image_sets.append(list(training.values()))
+    def test_add_remove_image(self):
+        repeat = 10
 
+        for j in range(repeat):
+            images = get_random_images(len(ALL_IMAGES) - 1)
+            first, later = images[:3], images[3:]
+
+            for engine in ENGINES:
+                t = ImageTeller(first, engine=engine)
+                known = dict(enumerate(first))
+
+                for img in later:
+                    known[t.add_image(img)] = img
+                for index in random.sample(list(known), len(known) // 2):
+                    t.remove_image(index)
+                    del known[index]
+                    self.assertEqual(t.tell(images[index]), -1)
+
+                for index, img in known.items():
+                    self.assertEqual(t.tell(img), index)
+                self.assertEqual(t.tell_many(images).tolist(), [index if index in known else -1 for index in
+                                                                range(len(images))])
+
+    def test_locate(self):
+        frame, templates, places = generate_screenshot(200, 300)
+
+        for engine in ENGINES:
+            t = ImageTeller(templates, engine=engine)
+            self.assertEqual(sorted(t.locate(frame)), sorted(places))
+            self.assertEqual(sorted(t.locate(frame, probes=1)), sorted(places))
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        t = ImageTeller([cv2.cvtColor(gray[40:55, 70:90], cv2.COLOR_GRAY2BGR), templates[0]])
+        self.assertEqual(t.locate(gray), [(0, 70, 40)])
+
+    def test_tolerance(self):
+        rng = np.random.RandomState(0)
+        images = [img for img in get_training_images(8).values()]
+        t = ImageTeller(images, tolerance=2)
+
+        for dd, img in enumerate(images):
+            noisy = np.clip(img.astype(int) + rng.randint(-2, 3, img.shape), 0, 255).astype(np.uint8)
+            self.assertEqual(t.tell(noisy), dd)
+            self.assertEqual(t.tell(img), dd)
+
+            too_noisy = img.copy()
+            too_noisy[0, 0] = np.where(too_noisy[0, 0] > 127, too_noisy[0, 0] - 3, too_noisy[0, 0] + 3)
+            self.assertEqual(t.tell(too_noisy), -1)
+            self.assertEqual(ImageTeller(images).tell(noisy), dd if np.array_equal(noisy, img) else -1)
+
+        for procedures in t._shapeToProcedures.values():
+            for procedures_for_progress in (procedures.values() if procedures else []):
+                for procedure in procedures_for_progress:
+                    self.assertGreater(np.abs(procedure[1].astype(int) - procedure[2]).max(), 4)
+
+        frame, templates, places = generate_screenshot(200, 300)
+        noisy_frame = np.clip(frame.astype(int) + rng.randint(-1, 2, frame.shape), 0, 255).astype(np.uint8)
+        self.assertEqual(sorted(ImageTeller(templates, tolerance=1).locate(noisy_frame)), sorted(places))
+
+    def test_stream(self):
+        training_images = list(get_training_images(6).values())
+        other = ALL_IMAGES[0]  # never sampled as training
+        surprise = 255 - training_images[1]  # differs from the frame before it in every pixel
+
+        for engine in ENGINES:
+            t = ImageTeller(training_images + [other], engine=engine)
+            frames = [training_images[0]] * 3 + [training_images[1]] * 2 + [surprise, training_images[0]] + [
+                other] * 3
+
+            told = []
+            full_tell = t._tell
+            t._tell = lambda img, trace: told.append(img) or full_tell(img, trace)
+
+            self.assertEqual(list(t.stream(iter(frames))),
+                             [(0, 0), (3, 1), (5, -1), (6, 0), (7, len(training_images))])
+            if engine != 'hash':
+                self.assertEqual(len(told), 5)
+
+            told.clear()
+            list(t.stream(frames, verify_every=2))
+            if engine != 'hash':
+                self.assertEqual(len(told), 8)
+
+        # the hash engine watches tree paths, built when the stream starts and when images are added, not per frame
+        near_duplicates = generate_near_duplicates(6, 20)
+        t = ImageTeller(near_duplicates[:5], engine='hash')
+        changes = t.stream(near_duplicates[index] for index in (0, 0, 3, 3, 5, 5, 4))
+        self.assertIn((20, 20), t._shapeToTree)
+        told = []
+        full_tell = t._tell
+        t._tell = lambda img, trace: told.append(img) or full_tell(img, trace)
+        self.assertEqual(next(changes), (0, 0))
+        t.add_image(near_duplicates[5])
+        self.assertEqual(list(changes), [(2, 3), (4, 5), (6, 4)])
+        self.assertEqual(len(told), 4)
+
+        # pixels of 24 bytes can't be packed into a tree, the hash engine tells every frame
+        images = [img.astype(np.float64) for img in training_images[:3]]
+        frames = [images[0]] * 2 + [images[1], images[2] + 0.5, images[2]]
+        for engine in ('procedures', 'hash'):
+            t = ImageTeller(images, engine=engine)
+            self.assertEqual(list(t.stream(frames)), [(0, 0), (2, 1), (3, -1), (4, 2)])
+
+    def test_stats(self):
+        training_images = list(get_training_images(6).values())
+        surprise = ALL_IMAGES[0]  # never sampled as training
+
+        for engine in ENGINES:
+            records = []
+            t = ImageTeller(training_images, engine=engine, on_tell=records.append)
+            for img in training_images + [surprise, np.zeros((3, 3, 3), dtype=np.uint8)]:
+                t.tell(img)
+
+            stats = t.stats(reset=True)
+            self.assertEqual(len(records), len(training_images) + 2)
+            self.assertEqual(sum(counters['calls'] for counters in stats.values()), len(records))
+            self.assertEqual(stats[(3, 3)]['branches'], {'shape': 1})
+            self.assertEqual(sum(counters['probes'] for counters in stats.values()),
+                             sum(record['probes'] for record in records))
+            self.assertGreaterEqual(sum(counters['verifications'] for counters in stats.values()),
+                                    len(training_images))
+            for shape in t._shapeToImgIndexes:
+                self.assertGreater(stats[shape]['build_seconds'], 0)
+                self.assertEqual(t.stats()[shape]['calls'], 0)
+
+        self.assertRaises(AssertionError, ImageTeller(training_images).stats)
+
+        # images that are the same where both are opaque are verified one after the other, every one counts
+        img = training_images[0]
+        left, right = np.zeros(img.shape[:2], dtype=bool), np.zeros(img.shape[:2], dtype=bool)
+        left[:, :img.shape[1] // 2] = right[:, img.shape[1] // 2:] = True
+        records = []
+        t = ImageTeller([img, img.copy()], engine='tree', masks=[left, right], on_tell=records.append)
+        changed = img.copy()
+        changed[left] ^= 1
+        self.assertEqual(t.tell(changed), 1)
+        counters = t.stats()[img.shape[:2]]
+        self.assertEqual(counters['verifications'], 2)
+        self.assertEqual(counters['verification_seconds'], records[0]['verification_seconds'])
+        self.assertEqual(counters['probes'], records[0]['probes'])
+
+        # every thread keeps the record of its own tell
+        images = generate_near_duplicates(20, 30, seed=11)
+        queries = (images + [255 - img for img in images]) * 10
+        records = []
+        t = ImageTeller(images, engine='hash', on_tell=records.append)
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(8) as executor:
+                indexes = list(executor.map(t.tell, queries))
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(indexes, (list(range(20)) + [-1] * 20) * 10)
+        self.assertEqual(t.stats()[(30, 30)]['calls'], len(queries))
+        for record in records:
+            self.assertEqual(record['branch'], 'none' if record['index'] == -1 else 'digest')
+            self.assertEqual(record['verification_seconds'] is None, record['index'] == -1)
+
+    def test_parallel(self):
+        training_images = list(get_training_images(6).values())
+        queries = training_images * 3 + ALL_IMAGES[:2]
+        expected = list(range(len(training_images))) * 3 + [-1, -1]
+
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for number, img in enumerate(queries):
+                files.append(path.join(directory, '%d.png' % number))
+                cv2.imwrite(files[-1], img)
+
+            with ParallelTeller(ImageTeller(training_images), processes=2) as parallel:
+                self.assertEqual(parallel.tell_many(queries, chunk=4).tolist(), expected)
+                self.assertEqual(list(parallel.tell_files(files + [path.join(directory, 'missing.png')], chunk=4)),
+                                 expected + [None])
+
+            index = path.join(directory, 'teller.whichimg')
+            ImageTeller(training_images).save(index)
+            results = path.join(directory, 'results.jsonl')
+            cmd(['classify', index, *files, '-o', results, '--processes', '2'])
+            with open(results) as lines:
+                self.assertEqual([json.loads(line)['index'] for line in lines], expected)
+
+    def test_compilation(self):
+        training_images = [get_fixture_img(name) for name in ('phage', 'emerald', 'phage_blue_face', 'bloody_sea',
+                                                              'rainbow_1', 'antelope_horn', 'phage_demon_horns')]
+        surprise = 255 - phage
+        shapes = {img.shape[:2] for img in training_images}
+
+        # the image added later has the shape of pending images, or a shape of its own
+        for added in (get_fixture_img('phage_one_less_leg'), training_images[3][:12, :12].copy()):
+            for engine in ENGINES:
+                t = ImageTeller(training_images, engine=engine, compilation='lazy')
+                self.assertEqual(t._pending, shapes)
+                self.assertEqual(t.tell(training_images[1]), 1)
+                self.assertEqual(t._pending, shapes - {training_images[1].shape[:2]})
+
+                self.assertEqual(t.add_image(added), len(training_images))
+                for dd, img in enumerate(training_images + [added]):
+                    self.assertEqual(t.tell(img), dd)
+                self.assertEqual(t.tell(surprise), -1)
+                self.assertFalse(t._pending)
+
+            t = ImageTeller(training_images, engine=engine, compilation='background')
+            for dd, img in enumerate(training_images):
+                self.assertEqual(t.tell(img), dd)
+            self.assertEqual(t.tell(surprise), -1)
+            t.compile_all()
+            self.assertFalse(t._pending)
+            for dd, img in enumerate(training_images):
+                self.assertEqual(t.tell(img), dd)
+
+            t = ImageTeller(training_images, engine=engine, compilation='lazy')
+            for shape in shapes:  # as if the background thread didn't get to any shape yet
+                for index in t._shapeToImgIndexes[shape]:
+                    self.assertEqual(t._compare_directly(training_images[index], shape), index)
+                self.assertEqual(t._compare_directly(255 - training_images[t._shapeToImgIndexes[shape][0]], shape), -1)
+
+    def test_adaptive_order(self):
+        images = generate_near_duplicates(60, 30, seed=8)
+        frequent = 41
+        queries = [frequent] * 30 + list(range(len(images)))
+
+        def probes(teller, img):
+            trace = []
+            teller._tell(img, trace)
+            return len(trace)
+
+        for engine in ('procedures', 'tree', 'packed'):
+            plain = ImageTeller(images, engine=engine)
+            weights = [1] * len(images)
+            weights[frequent] = 1000
+            weighted = ImageTeller(images, engine=engine, weights=weights)
+            self.assertLess(probes(weighted, images[frequent]), probes(plain, images[frequent]))
+            self.assertEqual([weighted.tell(img) for img in images], list(range(len(images))))
+
+            t = ImageTeller(images, engine=engine, adapt_every=25)
+            for query in queries:
+                self.assertEqual(t.tell(images[query]), query)
+            t.adapt()  # whether or not the background thread got to it yet
+            self.assertEqual(t._shapeToOrder[(30, 30)][0], frequent)
+            self.assertLess(probes(t, images[frequent]), probes(plain, images[frequent]))
+            self.assertEqual(t.tell(255 - images[frequent]), -1)
+
+            with tempfile.TemporaryDirectory() as directory:
+                t.save(path.join(directory, 'adapted.whichimg'))
+                loaded = ImageTeller.load(path.join(directory, 'adapted.whichimg'))
+            self.assertEqual(probes(loaded, images[frequent]), probes(t, images[frequent]))
+            self.assertEqual([loaded.tell(img) for img in images], list(range(len(images))))
+
+    def test_alpha_masks(self):
+        rng = np.random.RandomState(9)
+        icons = []
+        for _ in range(12):
+            icon = rng.randint(0, 256, (24, 24, 4)).astype(np.uint8)
+            icon[..., 3] = 0  # transparent, the background shows through
+            icon[4:20, 4:20, 3] = 255
+            icon[4, 4:20, 3] = 128  # semi transparent, blended with the background
+            icons.append(icon)
+        icons[5][2:22, 2:22, 3] = 255  # a bigger icon
+
+        def on_background(icon):
+            background = rng.randint(0, 256, icon.shape[:2] + (3,)).astype(np.uint8)
+            return np.where(icon[..., 3:] == 255, icon[..., :3], background)
+
+        for engine in ('procedures', 'tree', 'packed'):
+            for verify_samples in (0, 64):
+                t = ImageTeller(icons, engine=engine, masks='alpha', verify_samples=verify_samples)
+                captures = [on_background(icon) for icon in icons]
+                self.assertEqual([t.tell(capture) for capture in captures], list(range(len(icons))))
+                self.assertEqual(t.tell_many(np.stack(captures)).tolist(), list(range(len(icons))))
+
+                changed = captures[3].copy()
+                changed[10:14, 10:14] = 255 - changed[10:14, 10:14]  # opaque pixels
+                self.assertEqual(t.tell(changed, certain=True), -1)
+
+            frame = rng.randint(0, 256, (120, 160, 3)).astype(np.uint8)
+            frame[50:74, 70:94] = on_background(icons[7])
+            self.assertIn((7, 70, 50), t.locate(frame))
+
+            masks = [icon[..., 3] == 255 for icon in icons]
+            explicit = ImageTeller([icon[..., :3] for icon in icons], engine=engine, masks=masks)
+            self.assertEqual(explicit.tell(on_background(icons[2])), 2)
+
+            unmasked = 255 - icons[0][..., :3]
+            index = explicit.add_image(unmasked)
+            self.assertEqual(explicit.tell(unmasked), index)
+            self.assertEqual(explicit.tell(on_background(icons[9]) // 2), -1)
+            inverted = icons[1].copy()
+            inverted[..., :3] = 255 - inverted[..., :3]
+            self.assertEqual(explicit.tell(on_background(inverted)), -1)
+            index = explicit.add_image(inverted, mask='alpha')
+            self.assertEqual(explicit.tell(on_background(inverted)), index)
+            self.assertEqual(explicit.tell(on_background(icons[0])), 0)
+            self.assertEqual(explicit.tell(on_background(icons[4])), 4)
+
+            with tempfile.TemporaryDirectory() as directory:
+                t.save(path.join(directory, 'icons.whichimg'))
+                loaded = ImageTeller.load(path.join(directory, 'icons.whichimg'))
+                self.assertEqual([loaded.tell(on_background(icon)) for icon in icons], list(range(len(icons))))
+
+        with self.assertRaises(AssertionError):
+            ImageTeller(icons, engine='hash', masks='alpha')
+
+    def test_masks_of_some_images(self):
+        rng = np.random.RandomState(13)
+        plain = rng.randint(0, 256, (12, 12, 3)).astype(np.uint8)
+        other = plain.copy()
+        other[0, 0] = 255 - other[0, 0]  # differs only outside of the mask of the icon
+        icon = plain.copy()
+        icon_mask = np.zeros((12, 12), dtype=bool)
+        icon_mask[4:8, 4:8] = True
+
+        left, right = np.zeros((12, 12), dtype=bool), np.zeros((12, 12), dtype=bool)
+        left[:, :6], right[:, 6:] = True, True
+        halves = [rng.randint(0, 256, (12, 12, 3)).astype(np.uint8) for _ in range(2)]
+
+        for engine in ('procedures', 'tree', 'packed'):
+            t = ImageTeller([plain, other, icon], engine=engine, masks=[None, None, icon_mask])
+            self.assertEqual([t.tell(img) for img in (plain, other)], [0, 1])
+            self.assertEqual(t.tell_many([plain, other]).tolist(), [0, 1])
+            on_background = rng.randint(0, 256, (12, 12, 3)).astype(np.uint8)
+            on_background[4:8, 4:8] = icon[4:8, 4:8]
+            self.assertEqual(t.tell(on_background), 2)
+            on_background[5, 5] = 255 - on_background[5, 5]
+            self.assertEqual(t.tell(on_background), -1)
+
+            # disjoint masks, no pixel is opaque in both
+            t = ImageTeller(halves, engine=engine, masks=[left, right])
+            for index, (img, mask) in enumerate(zip(halves, (left, right))):
+                capture = np.where(mask[..., None], img, 255 - img)
+                self.assertEqual(t.tell(capture), index)
+                self.assertEqual(t.tell_many([capture]).tolist(), [index])
+                self.assertEqual(t.tell(255 - capture), -1)
+            self.assertIn(t.tell(np.where(left[..., None], halves[0], halves[1])), (0, 1))  # both match
+
+            with tempfile.TemporaryDirectory() as directory:
+                t.save(path.join(directory, 'halves.whichimg'))
+                loaded = ImageTeller.load(path.join(directory, 'halves.whichimg'))
+                self.assertEqual(loaded.tell(np.where(right[..., None], halves[1], 0)), 1)
+
+            with self.assertRaises(AssertionError):  # the same where they're opaque, with the same masks
+                ImageTeller([halves[0], np.where(left[..., None], halves[0], 0)], engine=engine, masks=[left, left])
+
+    def test_multi_scale(self):
+        templates = generate_near_duplicates(5, 16, seed=10) + generate_near_duplicates(5, 20, seed=11)
+        scales = (1, 1.25, 1.5, 2)
+
+        def captured(img, scale):
+            if scale == 1:
+                return img
+            size = int(round(img.shape[1] * scale)), int(round(img.shape[0] * scale))
+            return cv2.resize(img, size, interpolation=cv2.INTER_LINEAR)
+
+        for engine in ENGINES:
+            t = MultiScaleTeller(templates, scales=scales, engine=engine)
+            self.assertIn((20, 20), t.teller._shapeToImgIndexes)  # 16 by 1.25 and 20 by 1 share a bucket
+            self.assertEqual(len(t.teller._shapeToImgIndexes[(20, 20)]), 10)
+
+            for index, img in enumerate(templates):
+                for scale in scales:
+                    self.assertEqual(t.tell(captured(img, scale)), (index, scale))
+            self.assertEqual(t.tell(255 - captured(templates[7], 1.5)), (-1, None))
+            self.assertEqual(t.tell(captured(templates[7], 1.1)), (-1, None))
+
+        queries = [captured(templates[2], 2), captured(templates[8], 1.25), 255 - templates[0]]
+        self.assertEqual(t.tell_many(queries), [(2, 2.0), (8, 1.25), (-1, None)])
+
+        frame = np.zeros((100, 120, 3), dtype=np.uint8)
+        frame[30:60, 40:70] = captured(templates[6], 1.5)
+        self.assertIn((6, 1.5, 40, 30), t.locate(frame))
+
+        with tempfile.TemporaryDirectory() as directory:
+            t.save(path.join(directory, 'scaled.whichimg'), labels=[str(index) for index in range(len(templates))])
+            loaded = MultiScaleTeller.load(path.join(directory, 'scaled.whichimg'))
+            self.assertEqual(loaded.tell(captured(templates[3], 1.25)), (3, 1.25))
+            self.assertEqual(loaded.labels, [str(index) for index in range(len(templates))])
+
+            ImageTeller(templates).save(path.join(directory, 'plain.whichimg'))
+            with self.assertRaises(ValueError):
+                MultiScaleTeller.load(path.join(directory, 'plain.whichimg'))
+
+        icons = []
+        for number in range(3):
+            icon = np.random.RandomState(number).randint(0, 256, (16, 16, 4)).astype(np.uint8)
+            icon[..., 3] = 0
+            icon[2:14, 2:14, 3] = 255
+            icons.append(icon)
+        t = MultiScaleTeller(icons, scales=scales, masks='alpha')
+        for index, icon in enumerate(icons):
+            for scale in scales:
+                scaled = captured(icon, scale)
+                background = np.random.RandomState(9).randint(0, 256, scaled.shape[:2] + (3,)).astype(np.uint8)
+                self.assertEqual(t.tell(np.where(scaled[..., 3:] == 255, scaled[..., :3], background)), (index, scale))
+
+    def test_closest(self):
+        images = generate_near_duplicates(20, 32, seed=12) + get_random_images(5)
+
+        def brute_force(img):
+            distances = [np.abs(possible.astype(int) - img).mean() if possible.shape == img.shape else np.inf
+                         for possible in images]
+            return sorted(range(len(images)), key=lambda index: distances[index])
+
+        for engine in ENGINES:
+            t = ImageTeller(images, engine=engine)
+
+            drifted = images[6].copy()
+            drifted[3:9, 3:9] = 255 - drifted[3:9, 3:9]
+            index, closest = t.tell(drifted, nearest=True)
+            self.assertEqual(index, -1)
+            self.assertEqual(closest[0][0], 6)
+            for index, distance in closest:
+                self.assertAlmostEqual(distance, np.abs(images[index].astype(int) - drifted).mean())
+            self.assertEqual(closest, sorted(closest, key=lambda pair: pair[1]))
+            self.assertEqual(closest, t.closest(drifted))
+            # every candidate compared in full is the brute force search
+            exact = t.closest(drifted, count=5, candidates=len(images))
+            self.assertEqual([index for index, _ in exact], brute_force(drifted)[:5])
+
+            self.assertEqual(t.tell(images[4], nearest=True), (4, []))
+            self.assertEqual(t.closest(images[4], count=1), [(4, 0.0)])
+            self.assertEqual(len(t.tell(drifted, nearest=5)[1]), 5)
+            self.assertEqual(t.closest(np.zeros((7, 7, 3), dtype=np.uint8)), [])
+
+        icons = [np.random.RandomState(number).randint(0, 256, (32, 32, 3)).astype(np.uint8) for number in range(12)]
+        masks = [np.zeros((32, 32), dtype=bool) for _ in icons]
+        for mask in masks:
+            mask[8:24, 8:24] = True
+        t = ImageTeller(icons, masks=masks)
+        capture = icons[11].copy()
+        capture[~masks[11]] = 0  # the background doesn't count
+        capture[10, 10] = 255 - capture[10, 10]
+        self.assertEqual(t.tell(capture), -1)
+        [(index, distance)] = t.closest(capture, count=1)
+        self.assertEqual(index, 11)
+        self.assertAlmostEqual(distance, np.abs(icons[11][10, 10].astype(int) - capture[10, 10]).mean() / 256)
+
+    def test_verify_samples(self):
+        training_images = [get_fixture_img(name) for name in ('phage', 'phage_blue_face', 'phage_demon_horns',
+                                                              'emerald', 'bloody_sea', 'rainbow_1')]
+        training_images += [np.random.RandomState(number).randint(0, 256, (24, 24, 3)).astype(np.uint8) for number in
+                            range(2)]
+
+        for engine in ENGINES:
+            t = ImageTeller(training_images, engine=engine, verify_samples=16)
+
+            for dd, img in enumerate(training_images):
+                self.assertEqual(t.tell(img), dd)
+                self.assertEqual(t.tell(img, certain=True), dd)
+
+                noisy = img.copy()
+                noisy[..., 0] ^= 1  # differs in every pixel
+                self.assertEqual(t.tell(noisy), -1)
+
+                rows, columns = t._samples_of(img.shape[:2])
+                self.assertEqual(len(rows), min(16, img.shape[0] * img.shape[1]))
+                unsampled = np.ones(img.shape[:2], dtype=bool)
+                unsampled[rows, columns] = False
+                if unsampled.any():
+                    changed = img.copy()
+                    changed[unsampled] ^= 1  # differs only where it isn't sampled, so it may pass
+                    self.assertIn(t.tell(changed), (dd, -1))
+                    self.assertEqual(t.tell(changed, certain=True), -1)
+
+            self.assertEqual(t.tell_many(training_images).tolist(), list(range(len(training_images))))
+
+            # the samples are drawn again for every tell, so pixels that one draw missed are caught by a later one
+            img = training_images[-1]
+            t = ImageTeller([img], engine=engine, verify_samples=16)  # nothing to probe, only the samples verify
+            t._random = np.random.RandomState(0)
+            rows, columns = t._samples_of(img.shape[:2])
+            changed = img ^ 1
+            changed[rows, columns] = img[rows, columns]
+            self.assertIn(-1, {t.tell(changed) for _ in range(10)})
+
+    def test_screen_watcher(self):
+        images = generate_near_duplicates(3, 20)
+        icons = generate_near_duplicates(2, 8, seed=1)
+        screens = [(0, 0)] * 5 + [(1, 0)] * 5 + [(2, 1)] * 5  # which image and icon every screenshot shows
+
+        async def watch():
+            grabbed = []
+
+            def grab():
+                image, icon = screens[min(len(grabbed), len(screens) - 1)]
+                screenshot = np.zeros((50, 80, 3), dtype=np.uint8)
+                screenshot[10:30, 40:60] = images[image]
+                screenshot[0:8, 0:8] = icons[icon]
+                grabbed.append(screenshot)
+                if len(grabbed) == len(screens):
+                    watcher.stop()
+                return screenshot
+
+            watcher = ScreenWatcher(grab)
+            image_region = watcher.watch(ImageTeller(images), (40, 10, 20, 20), interval=0.001)
+            icon_region = watcher.watch(ImageTeller(icons, engine='packed'), (0, 0, 8, 8), interval=0.001)
+
+            async def changes(region):
+                return [index for _, index in [change async for change in region]]
+
+            _, image_changes, icon_changes = await asyncio.gather(watcher.run(), changes(image_region),
+                                                                  changes(icon_region))
+            return len(grabbed), image_changes, icon_changes
+
+        grabbed, image_changes, icon_changes = asyncio.get_event_loop().run_until_complete(watch())
+        self.assertEqual(grabbed, len(screens))  # one screenshot per tick for both regions
+        self.assertEqual(image_changes, [0, 1, 2])
+        self.assertEqual(icon_changes, [0, 1])
+
+    def test_tell_regions(self):
+        frame, templates, places = generate_screenshot(300, 400)
+        gray_templates = [cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR) for img in
+                          templates]
+        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        for index, x, y in places:
+            height, width = templates[index].shape[:2]
+            gray_frame[y:y + height, x:x + width] = gray_templates[index][..., 0]
+
+        for engine in ENGINES:
+            tellers = [ImageTeller(templates, engine=engine), ImageTeller(gray_templates, engine=engine)]
+            for teller, img in zip(tellers, (frame, gray_frame)):
+                regions = [(teller, x, y, templates[index].shape[:2]) for index, x, y in places] + \
+                          [(teller, 0, 0, templates[0].shape[:2]), (teller, 399, 299, templates[0].shape[:2])]
+                self.assertEqual(tell_regions(img, regions), [index for index, _, _ in places] + [-1, -1])
+
+            # RGB to BGR by reversing the channels is a view whose channels aren't next to each other
+            rgb_frame = np.ascontiguousarray(frame[..., ::-1])
+            self.assertEqual(tell_regions(rgb_frame[..., ::-1], [(tellers[0], x, y, templates[index].shape[:2])
+                                                                 for index, x, y in places]),
+                             [index for index, _, _ in places])
+            rgb = [np.ascontiguousarray(img[..., ::-1]) for img in templates]
+            self.assertEqual([tellers[0].tell(img[..., ::-1]) for img in rgb], list(range(len(templates))))
+
+    def test_tell_at_shape(self):
+        small = generate_near_duplicates(3, 5)
+        large = generate_near_duplicates(3, 10, seed=1)
+        frame = np.zeros((20, 20, 3), dtype=np.uint8)
+        frame[4:14, 6:16] = large[2]
+        for engine in ENGINES:
+            t = ImageTeller(small + large, engine=engine, surprises=False)
+            # without surprises the probes of a small image could pass inside the large one
+            self.assertEqual(t.tell_at(frame, 6, 4, (10, 10)), 5)
+            self.assertEqual(tell_regions(frame, [(t, 6, 4, (10, 10)), (t, 15, 15, (10, 10))]), [5, -1])
+            with self.assertRaises(AssertionError):
+                t.tell_at(frame, 6, 4)
+
+            self.assertEqual(ImageTeller(large, engine=engine).tell_at(frame, 6, 4), 2)
+
+    def test_native_layouts(self):
+        bgr = generate_near_duplicates(4, 20)
+        gray = [img[..., 0].copy() for img in generate_near_duplicates(4, 16, seed=1)]
+        bgra = [np.dstack([img, np.full(img.shape[:2], 255, np.uint8)]) for img in generate_near_duplicates(4, 12,
+                                                                                                         seed=2)]
+        deep = [img.astype(np.uint16) * 257 for img in generate_near_duplicates(4, 10, seed=3)]
+        deep_gray = [img[..., 0].astype(np.uint16) * 257 for img in generate_near_duplicates(4, 8, seed=4)]
+        images = bgr + gray + bgra + deep + deep_gray
+
+        for engine in ENGINES:
+            t = ImageTeller(images, engine=engine)
+            self.assertEqual(t._store.stacks[(16, 16)].shape[3], 1)  # gray is stored as gray
+            self.assertEqual(t._store.stacks[(12, 12)].shape[3], 4)
+            self.assertEqual(t._store.stacks[(8, 8)].dtype, np.uint16)
+
+            for dd, img in enumerate(images):
+                self.assertEqual(t.tell(img), dd)
+            for dd, img in enumerate(gray):
+                self.assertEqual(t.tell(img[..., None]), len(bgr) + dd)
+            for dd, img in enumerate(bgr):  # e.g. a region of a BGRA screenshot
+                self.assertEqual(t.tell(np.dstack([img, np.zeros(img.shape[:2], np.uint8)])), dd)
+            self.assertEqual(t.tell(bgra[0][..., :3]), len(bgr) + len(gray))  # opaque
+            self.assertEqual(t.tell(np.dstack([bgra[0][..., :3], np.zeros((12, 12), np.uint8)])), -1)
+            self.assertEqual(t.tell_many(images).tolist(), list(range(len(images))))
+            for dd, img in enumerate(deep):
+                self.assertEqual(t.tell(img.astype(np.int64)), len(images) - 8 + dd)
+                self.assertEqual(t.tell(img.astype(np.float32) + 0.5), -1)
+
+            # a bigger layout converts the images of the same size
+            index = t.add_image(np.dstack([bgr[0][..., ::-1], np.full((20, 20), 7, np.uint8)]))
+            self.assertEqual(t._store.stacks[(20, 20)].shape[3], 4)
+            self.assertEqual(t.tell(bgr[1]), 1)  # gets an opaque alpha channel, like the possible image
+            self.assertEqual(t.tell(np.dstack([bgr[1], np.full((20, 20), 255, np.uint8)])), 1)
+            self.assertEqual(t.tell(np.dstack([bgr[1], np.full((20, 20), 254, np.uint8)])), -1)
+            self.assertEqual(t.tell_many(bgr).tolist(), list(range(len(bgr))))
+            self.assertEqual(t.tell(t._possible_images[index]), index)
+
+            # a uint8 image among uint16 ones of the same size
+            deeper = ImageTeller([deep[0], deep[1], bgr[0][:10, :10]], engine=engine)
+            self.assertEqual(deeper._store.stacks[(10, 10)].dtype, np.uint16)
+            self.assertEqual(deeper.tell(bgr[0][:10, :10]), 2)
+            self.assertEqual(deeper.tell(deep[1]), 1)
+            self.assertEqual(deeper.tell_many([bgr[0][:10, :10], deep[0]]).tolist(), [2, 0])
+
+        mixed = ImageTeller([gray[0], bgr[0][:16, :16]])
+        self.assertEqual(mixed.tell(cv2.cvtColor(gray[0], cv2.COLOR_GRAY2BGR)), 0)
+        self.assertEqual(mixed.tell(gray[0]), 0)
+        self.assertEqual(mixed.tell(bgr[0][:16, :16]), 1)
+
+    def test_unpackable_pixels(self):
+        # pixels of 24 bytes can not be packed, their colors are compared channel by channel
+        images = [img.astype(np.float64) for img in get_training_images(6).values()]
+        t = ImageTeller(images)
+
+        for dd, img in enumerate(images):
+            self.assertEqual(t.tell(img), dd)
+
+        # pixels of 12 bytes with a tolerance
+        images = [img.astype(np.float32) for img in get_training_images(6).values()]
+        t = ImageTeller(images, tolerance=1)
+        for dd, img in enumerate(images):
+            self.assertEqual(t.tell(img.copy()), dd)
+            self.assertEqual(t.tell(np.clip(img + 1, 0, 255)), dd)
+
+        with self.assertRaises(AssertionError):
+            ImageTeller(images, tolerance=-1)
 
-    tellers = []
-    for training_images in training_image_sets:
-        tellers.append(ImageTeller(training_images,surprises=False))
+    def test_cmd(self):
+        cmd = ' '.join((sys.executable, path.join('..', 'whichimg', 'main.py')))
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, _ = p.communicate()
 
-    time1 = time.time()
-    # print(len(training_images))
-    for training_images in training_image_sets:
+        res = stdout.decode(encoding='utf-8').strip()
+        print("command line result:", res)
 
-            for img in training_images:
-                naive_tell(training_images, img)
+    def test_cmd_compile_classify(self):
+        files = sorted(glob.glob(path.join(FILE_DIR, 'fixtures', '*.png')))
+        templates, others = files[2:8], files[:2]
+
+        with tempfile.TemporaryDirectory() as directory:
+            template_dir = path.join(directory, 'templates')
+            os.mkdir(template_dir)
+            for file in templates:
+                cv2.imwrite(path.join(template_dir, path.basename(file)), cv2.imread(file))
+            with open(path.join(directory, 'broken.png'), 'w') as broken:
+                broken.write('not an image')
+
+            index = path.join(directory, 'templates.whichimg')
+            cmd(['compile', template_dir, '-o', index])
+
+            queries = templates + others + [path.join(directory, 'broken.png')]
+            results = path.join(directory, 'results.jsonl')
+            cmd(['classify', index, *queries, '-o', results, '--workers', '2'])
+            with open(results) as lines:
+                records = [json.loads(line) for line in lines]
+
+            self.assertEqual([record['path'] for record in records], queries)
+            self.assertEqual([record['label'] for record in records],
+                             [path.splitext(path.basename(file))[0] for file in templates] + [None] * 3)
+            self.assertEqual([record['index'] for record in records], list(range(len(templates))) + [-1, -1, None])
+
+            results = path.join(directory, 'results.csv')
+            cmd(['classify', index, template_dir, '--format', 'csv', '-o', results])
+            with open(results, newline='') as rows:
+                self.assertEqual([row['index'] for row in csv.DictReader(rows)],
+                                 [str(index) for index in range(len(templates))])
+
+            # a template saved twice under different names
+            cv2.imwrite(path.join(template_dir, 'copy.png'), cv2.imread(templates[0]))
+            with self.assertRaises(SystemExit) as exit:
+                cmd(['compile', template_dir, '-o', path.join(directory, 'copies.whichimg')])
+            self.assertIn(path.basename(templates[0]), str(exit.exception.code))
+            self.assertIn('copy.png', str(exit.exception.code))
+            self.assertFalse(path.exists(path.join(directory, 'copies.whichimg')))
+
+            # a missing index, and files that aren't an index
+            with open(path.join(directory, 'truncated.whichimg'), 'wb') as truncated, open(index, 'rb') as whole:
+                truncated.write(whole.read()[:100])
+            for file in ('missing.whichimg', 'broken.png', 'truncated.whichimg'):
+                with self.assertRaises(SystemExit) as exit:
+                    cmd(['classify', path.join(directory, file), *templates])
+                self.assertIn(file, str(exit.exception.code))
+
+    def test_build_index(self):
+        images = generate_near_duplicates(6, 24, seed=5) + generate_near_duplicates(4, 12, seed=6)
+        images += [img[..., 0] for img in generate_near_duplicates(3, 16, seed=7)]  # grayscale
+        images.append(images[1][:16, :16].copy())  # BGR with the grayscale ones
+        images.insert(3, ALL_IMAGES[0])  # the only image of its size
+
+        def read(file):
+            return cv2.imread(file, cv2.IMREAD_UNCHANGED)
+
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for number, img in enumerate(images):
+                files.append(path.join(directory, '%d.png' % number))
+                cv2.imwrite(files[-1], img)
+
+            for engine in ENGINES:
+                index = path.join(directory, engine + '.whichimg')
+                teller = build_index(files, index, engine=engine, labels=[str(n) for n in range(len(files))],
+                                     read=read, workers=2)
+                self.assertEqual(teller.labels[4], '4')
+                self.assertEqual([teller.tell(img) for img in images], list(range(len(images))))
+                self.assertEqual(teller.tell(255 - images[0]), -1)
+
+                # the same file as a teller built in memory would save
+                ImageTeller.load(index, possible_images=images)
+                in_memory = path.join(directory, engine + '_in_memory.whichimg')
+                ImageTeller(images, engine=engine).save(in_memory)
+                self.assertEqual(ImageTeller.load(in_memory, checksum=template_checksum(images)).tell(images[5]), 5)
+
+            with self.assertRaises(MemoryError):
+                build_index(files, path.join(directory, 'limited.whichimg'), memory_limit=20 * 24 * 24 * 3,
+                            read=read)
+
+            with self.assertRaises(ValueError):
+                build_index(files + [path.join(directory, 'missing.png')], path.join(directory, 'missing.whichimg'))
+
+    def test_build_index_memory_limit(self):
+        # binary images take a few procedures each
+        images = list((np.random.RandomState(3).randint(0, 2, (150, 16, 16)) * 255).astype(np.uint8))
+
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for number, img in enumerate(images):
+                files.append(path.join(directory, '%d.png' % number))
+                cv2.imwrite(files[-1], img)
+
+            index = path.join(directory, 'limited.whichimg')
+            outcomes = set()
+            for engine in ENGINES:
+                for limit in (2 << 20, 6 << 20, 32 << 20):
+                    tracemalloc.start()
+                    try:
+                        build_index(files, index, engine=engine, memory_limit=limit)
+                        outcomes.add('built')
+                    except MemoryError as error:
+                        self.assertFalse(path.exists(index))  # nothing or only a part was written
+                        outcomes.add('procedures' if 'procedures' in str(error) else 'sizes')
+                    finally:
+                        _, peak = tracemalloc.get_traced_memory()
+                        tracemalloc.stop()
+                    self.assertLessEqual(peak, limit)
+
+                    if path.exists(index):
+                        os.remove(index)
+
+            self.assertEqual(outcomes, {'built', 'procedures', 'sizes'})
 
-    print(time.time()-time1)
+    def tearDown(self) -> None:
+        os.chdir(MyTestCase.oldDir)
 
-    time2 = time.time()
-    lll = 0
-    for training_images in training_image_sets:
-        t = tellers[lll]
 
-        for img in training_images:
-            t.tell(img)
-        lll += 1
-    print(time.time() - time2)
+def generate_grey_scale_fixtures():
+    files = [file for file in glob.glob(path.join(FILE_DIR, 'fixtures', '*.png')) if not (file.endswith('bw.png'))]
+    images = [cv2.imread(file, cv2.IMREAD_GRAYSCALE) for file in files]
+    print(len(images), 'non bw images is going to be converted to greyscale')
+    for i in range(len(images)):
+        cv2.imwrite(path.join(FILE_DIR, files[i].split('.')[0] + '_bw.png'), images[i])
 
+def generate_near_duplicates(count, size=100, changed_pixels=5, seed=0) -> List[np.ndarray]:
+    rng = np.random.RandomState(seed)
+    base = rng.randint(0, 256, (size, size, 3)).astype(np.uint8)
+    images = []
+    for _ in range(count):
+        img = base.copy()
+        img[rng.randint(0, size, changed_pixels), rng.randint(0, size, changed_pixels)] = rng.randint(0, 256, (
+            changed_pixels, 3))
+        images.append(img)
+    return images
+
+
+def generate_screenshot(height, width, seed=0):
+    """
+    :return: a random frame, fixtures pasted on it twice each without overlapping, and the places they were pasted
+    """
+    rng = np.random.RandomState(seed)
+    frame = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    templates = [get_fixture_img(name) for name in ('phage', 'phage_blue_face', 'emerald', 'bloody_sea', 'rainbow_1')]
+    places = []
+
+    cell = 25
+    cells = random.Random(seed).sample([(y, x) for y in range(0, height - cell, cell) for x in
+                                         range(0, width - cell, cell)], 2 * len(templates))
+    for number, (y, x) in enumerate(cells):
+        template = templates[number // 2]
+        frame[y:y + template.shape[0], x:x + template.shape[1]] = template
+        places.append((number // 2, x, y))
+
+    return frame, templates, places
 
 
 if __name__ == '__main__':
@@ -1 +1,6 @@
-from whichimg.main import ImageTeller
\ No newline at end of file
+from whichimg.main import ImageTeller, tell_regions
+from whichimg.store import TemplateStore, template_checksum
+from whichimg.builder import build_index
+from whichimg.parallel import ParallelTeller
+from whichimg.scaled import MultiScaleTeller
+from whichimg.watcher import ScreenWatcher
@@ -0,0 +1,165 @@
+from typing import List, Optional, Iterable, Callable, Tuple, Sequence
+
+import numpy as np
+from cv2 import cv2
+
+from whichimg.main import ImageTeller, ENGINES, _decoded, _PROCEDURE_BYTES, _SET_ENTRY_BYTES
+from whichimg.store import TemplateStore, _IndexWriter, _image_checksum, _combined_checksum, _with_layout
+
+
+_IMAGE_BYTES = 2048  # the views, checksum and digest of every image
+
+
+def _peak_bytes(count: int, shape: Tuple[int, int], channels: int, dtype: np.dtype, engine: str,
+                tolerance: int = 0, workers: int = 1) -> int:
+    """
+    a rough upper bound of the memory it takes to analyze <count> images of <shape>, procedures aside: their stack,
+    the images decoded ahead and the python objects of every image, plus the packed colors, the per pixel counts and
+    the channel by channel comparisons that the engine works with
+    """
+    pixels = count * shape[0] * shape[1]
+    pixel_bytes = channels * dtype.itemsize
+    stack = pixels * pixel_bytes
+    objects = min(count, 4 * workers + 1) * shape[0] * shape[1] * pixel_bytes + count * _IMAGE_BYTES  # see _decoded
+    if count == 1 or engine == 'hash':
+        return stack + objects
+
+    width = 1
+    while width < pixel_bytes:
+        width *= 2
+
+    binned = stack if tolerance else 0
+    # colors compared channel by channel: a copy of the stack, the larger and smaller channels, their differences, and
+    # whether they're close
+    compared = 4 * stack + pixels * (channels + 1) if tolerance or width > 8 else 0
+    if width > 8:  # nothing is packed
+        return stack + objects + binned + compared
+
+    padded = pixels * width if width != pixel_bytes else 0
+    sorting = min(pixels, max(1 << 22, count)) * 40  # the temporaries of one chunk of _color_group_sizes
+    if engine == 'tree':
+        # whether a pixel varies, the packed colors of varying pixels and of the images of a node, group sizes and
+        # their logarithms
+        counts = pixels * (1 + 2 * width + 4 + 8)
+    else:
+        counts = pixels * 4  # how many images share the color of every image at every pixel
+    return stack + objects + binned + compared + padded + counts + sorting
+
+
+def _least_procedure_bytes(count: int, engine: str) -> int:
+    """
+    the memory the procedures of <count> images take at least: every image gets one, and its sets hold all images
+    between them. What they take beyond that is counted while they're built
+    """
+    if count == 1 or engine not in ('procedures', 'packed'):
+        return 0
+    return count * (_PROCEDURE_BYTES + count * _SET_ENTRY_BYTES)
+
+
+def build_index(paths: Iterable[str], index_path: str, engine: str = 'procedures', surprises: bool = True,
+                tolerance: int = 0, verify_samples: int = 0, memory_limit: Optional[int] = None,
+                labels: Optional[List[str]] = None, read: Callable[[str], Optional[np.ndarray]] = cv2.imread,
+                workers: int = 1, weights: Optional[Sequence[float]] = None, adapt_every: int = 0) -> ImageTeller:
+    """
+    build a teller from image files without holding all of them in memory, and save it like ImageTeller.save does.
+
+    The files are read twice. The first pass only notes the size and layout of every image. The second pass reads the
+    images of one size at a time, analyzes them and writes their pixels and procedures to <index_path> before it goes
+    on to the next size. So the memory it takes depends on the biggest group of images of the same size, not on the
+    number of images. Files that can't be read, or that are the same image as another file, are a ValueError that
+    names them.
+
+    :param paths: image files, their order gives the indexes
+    :param index_path: where to save the teller, it will be overwritten
+    :param engine: see ImageTeller
+    :param surprises: see ImageTeller
+    :param tolerance: see ImageTeller
+    :param verify_samples: see ImageTeller
+    :param memory_limit: if given, how many bytes analyzing the images of one size may take, roughly. Every size is
+        checked against it before anything is written, a MemoryError tells which one doesn't fit. How much memory
+        procedures take depends on how alike the images are, they're counted while they're built. If they outgrow
+        the limit, the MemoryError comes then and the partly written index is removed
+    :param labels: see ImageTeller.save
+    :param read: decodes one file, e.g. lambda path: cv2.imread(path, cv2.IMREAD_UNCHANGED) to keep grayscale, alpha
+        and 16 bit images as they are. cv2.imread by default, which reads BGR
+    :param workers: decoding threads
+    :param weights: see ImageTeller
+    :param adapt_every: see ImageTeller
+    :return: the saved teller, memory mapped by ImageTeller.load
+    """
+    assert engine in ENGINES, "engine should be one of %s" % (ENGINES,)
+    paths = list(paths)
+    assert len(paths) >= 1, "Please provide at least one image file"
+    assert labels is None or len(labels) == len(paths), "give one label per path"
+    assert weights is None or len(weights) == len(paths), "give one weight per path"
+
+    shape_to_indexes = dict()
+    layouts = []  # channels and dtype of every image
+    for index, (path, img) in enumerate(_decoded(paths, workers, read)):
+        if img is None:
+            raise ValueError("can't read %s" % path)
+        assert img.ndim in (2, 3), "Please provide 2 dimensional grayscale images or images with a channel axis"
+        shape_to_indexes.setdefault(img.shape[:2], []).append(index)
+        layouts.append((1 if img.ndim == 2 else img.shape[2], img.dtype))
+
+    shape_to_layout = dict()
+    shape_to_bytes = dict()  # what analyzing the images of a size takes, procedures aside
+    for shape, indexes in shape_to_indexes.items():
+        channels = max(layouts[index][0] for index in indexes)
+        dtype = np.result_type(*[layouts[index][1] for index in indexes])
+        shape_to_layout[shape] = channels, dtype
+
+        if memory_limit is not None:
+            shape_to_bytes[shape] = _peak_bytes(len(indexes), shape, channels, dtype, engine, tolerance, workers)
+            needed = shape_to_bytes[shape] + _least_procedure_bytes(len(indexes), engine)
+            if needed > memory_limit:
+                raise MemoryError("analyzing the %d images of %dx%d takes about %d bytes, the limit is %d" %
+                                  (len(indexes), shape[1], shape[0], needed, memory_limit))
+
+    writer = _IndexWriter(index_path)
+    checksums: List[Optional[bytes]] = [None] * len(paths)
+    buckets = []
+    leaves = dict()
+    digests = []
+    teller = None
+
+    try:
+        for number, (shape, indexes) in enumerate(shape_to_indexes.items()):
+            teller = store = stack = None  # let go of the images of the previous size before reading the next
+            channels, dtype = shape_to_layout[shape]
+
+            stack = np.empty((len(indexes),) + shape + (channels,), dtype=dtype)
+            for row, (path, img) in enumerate(_decoded([paths[index] for index in indexes], workers, read)):
+                if img is None or img.shape[:2] != shape:
+                    raise ValueError("%s changed while the index was built" % path)
+                stack[row] = _with_layout(img, channels, dtype)
+                checksums[indexes[row]] = _image_checksum(stack[row])
+
+            first_of_checksum = dict()
+            for index in indexes:
+                first = first_of_checksum.setdefault(checksums[index], index)
+                if first != index:
+                    raise ValueError("%s and %s are the same image" % (paths[first], paths[index]))
+
+            buckets.append([list(shape), indexes])
+            writer.add('%d/stack' % number, stack)
+
+            store = TemplateStore.__new__(TemplateStore)
+            store._assign(len(paths), {shape: indexes}, {shape: stack})
+            teller = ImageTeller(store, surprises=surprises, engine=engine, tolerance=tolerance,
+                                 verify_samples=verify_samples, weights=weights, adapt_every=adapt_every,
+                                 compilation='lazy')
+            if memory_limit is not None:
+                teller._procedureBytesLimit = memory_limit - shape_to_bytes[shape]
+            teller.compile_all()
+            teller._save_shape(writer, number, shape, leaves)
+            digests.extend(teller._digest_rows())
+
+        if digests:
+            writer.add('digests', np.array(digests, dtype=np.int64).reshape(-1, 2))
+    except BaseException:
+        writer.discard()
+        raise
+
+    writer.close(teller._meta(len(paths), _combined_checksum(checksums), buckets, leaves, labels))
+    return ImageTeller.load(index_path)
@@ -1,10 +1,25 @@
 #!/usr/bin/env python3
 import argparse
-from typing import List, Dict, Tuple, Set
+import array
+import collections
+import copy
+import csv
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Set, Union, Optional, Iterable, Iterator, Callable, Sequence
 
 import numpy as np
 from cv2 import cv2
 
+from whichimg.store import TemplateStore, template_checksum, _IndexWriter, _read_index, _alpha_masks
+
 # class Procedure:
 #     def __init__(self, r_c: Tuple[int, int], this_color: np.array, that_color: np.array, is_this_indexes: Set[int],
 #                  is_that_indexes: Set[int], is_neither_indexes: Set[int]):
@@ -42,92 +57,1789 @@ from cv2 import cv2
 Procedure = Tuple[Tuple[int, int], np.ndarray, np.ndarray, Set[int],
                   Set[int], Set[int]]
 
+# (pixel row column, {pixel bytes: child}). A child is either another node or the index of an image. With masks, it
+# can be a list of images that probing can't tell apart, and b'' is the child of the images that are transparent at the
+# pixel, for colors no other child has
+TreeNode = Tuple[Tuple[int, int], Dict[bytes, Union['TreeNode', int, List[int]]]]
+
+ENGINES = ('procedures', 'tree', 'hash', 'packed')
+
+COMPILATIONS = ('eager', 'lazy', 'background')
+
+# roughly the memory of a procedure: its tuple, colors and empty sets, plus every index in its sets, as python ints in
+# the sets and as int64 when it's saved
+_PROCEDURE_BYTES = 1024
+_SET_ENTRY_BYTES = 160
+
+_RANKING_PIXELS = 1024  # at most how many of the pixels that differ among images closest ranks candidates by
+
+
+def _pack_pixels(images: np.ndarray) -> Optional[np.ndarray]:
+    """
+    view every pixel, i.e. the last axis, of <images> as one unsigned integer so that colors can be compared, sorted
+    and counted in bulk.
+
+    :return: None if a pixel takes more than 8 bytes
+    """
+    images = np.ascontiguousarray(images)
+    pixel_bytes = images.shape[-1] * images.itemsize
+
+    width = 1
+    while width < pixel_bytes:
+        width *= 2
+    if width > 8:
+        return None
+
+    raw = images.view(np.uint8).reshape(images.shape[:-1] + (pixel_bytes,))
+    if width != pixel_bytes:
+        padded = np.zeros(images.shape[:-1] + (width,), dtype=np.uint8)
+        padded[..., :pixel_bytes] = raw
+        raw = padded
+
+    return raw.view('u%d' % width)[..., 0]
+
+
+def _digest(img: np.ndarray) -> Tuple[Tuple[int, ...], str, int]:
+    """
+    a cheap fingerprint of the content of <img>. Equal images always have equal digests, different images almost never.
+    """
+    return img.shape, img.dtype.str, zlib.crc32(np.ascontiguousarray(img))
+
+
+def _absdiff(colors: np.ndarray, color: np.ndarray) -> np.ndarray:
+    """
+    per channel absolute difference that doesn't overflow unsigned integers
+    """
+    return np.maximum(colors, color) - np.minimum(colors, color)
+
+
+def _mean_absdiff(colors: np.ndarray, color: np.ndarray, opaque: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    :param colors: (images, pixels, channels)
+    :param color: (pixels, channels)
+    :param opaque: (images, pixels), if given only these pixels of every image count
+    :return: for every image, the mean absolute difference of its channels and those of <color>
+    """
+    differences = _absdiff(colors, color)
+    if opaque is None:
+        counts = max(differences[0].size, 1)
+    else:
+        differences = differences * opaque[..., None]
+        counts = np.maximum(opaque.sum(axis=1) * colors.shape[2], 1)
+    return differences.reshape(len(colors), -1).sum(axis=1, dtype=np.float64) / counts
+
+
+def _conformed(img: np.ndarray, channels: int, dtype: Optional[np.dtype] = None) -> Optional[np.ndarray]:
+    """
+    <img>, or a batch of images, like images of <channels> channels and <dtype>. A grayscale image gets a channel axis,
+    or is broadcast to BGR, and the alpha channel of BGRA is dropped for BGR, without copying. BGR and gray get an
+    opaque alpha channel for BGRA and other dtypes are cast, like the possible images were converted, see
+    store._with_layout. Other images are returned as they are.
+
+    :param img: (rows, columns) for grayscale or (..., rows, columns, channels)
+    :param dtype: if given, the dtype of the possible images
+    :return: None if <img> has values that <dtype> can't hold, so it can't be any of the possible images
+    """
+    if img.ndim == 2:
+        img = img[..., None]
+
+    have = img.shape[-1]
+    if have == 1 and channels in (3, 4):
+        img = np.broadcast_to(img, img.shape[:-1] + (3,))
+    if have == 4 and channels == 3:
+        img = img[..., :3]
+
+    if dtype is not None and img.dtype != dtype:
+        converted = img.astype(dtype)
+        if not np.can_cast(img.dtype, dtype) and not np.array_equal(converted, img):
+            return None
+        img = converted
+
+    if img.shape[-1] == 3 and channels == 4:
+        opaque = np.iinfo(img.dtype).max if np.issubdtype(img.dtype, np.integer) else 1
+        img = np.concatenate([img, np.full(img.shape[:-1] + (1,), opaque, dtype=img.dtype)], axis=-1)
+    return img
+
+
+def _close(colors: np.ndarray, color: np.ndarray, margin: int) -> np.ndarray:
+    """
+    :return: for every pixel of <colors>, whether no channel differs from <color> by more than <margin>
+    """
+    return np.all(_absdiff(colors, color) <= margin, axis=-1)
+
+
+def _color_group_sizes(packed: np.ndarray, chunk: int = 1 << 22, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    :param packed: (images, pixels) packed colors
+    :param chunk: roughly how many elements are processed at once, to bound the temporary memory
+    :param weights: if given, the weight of every image. A group then weighs the sum of the weights of its images
+        instead of their number
+    :return: an array like <packed>, telling for every image and pixel how many images have the same color there
+    """
+    count = packed.shape[0]
+    sizes = np.empty(packed.shape, dtype=np.int32 if weights is None else np.float64)
+    rows = np.arange(count, dtype=np.int32)[:, None]
+    step = max(1, chunk // count)
+
+    for start in range(0, packed.shape[1], step):
+        block = packed[:, start:start + step]
+        order = np.argsort(block, axis=0, kind='stable')
+        ordered = np.take_along_axis(block, order, axis=0)
+
+        first = np.ones(ordered.shape, dtype=bool)  # first of a run of the same color
+        first[1:] = ordered[1:] != ordered[:-1]
+        last = np.ones(ordered.shape, dtype=bool)
+        last[:-1] = first[1:]
+
+        run_starts = np.maximum.accumulate(np.where(first, rows, 0), axis=0)
+        run_ends = np.minimum.accumulate(np.where(last, rows, count)[::-1], axis=0)[::-1]
+
+        if weights is None:
+            np.put_along_axis(sizes[:, start:start + step], order, run_ends - run_starts + 1, axis=0)
+        else:
+            totals = np.cumsum(weights[order], axis=0)  # of the ordered images up to every row
+            before = np.where(run_starts > 0, np.take_along_axis(totals, np.maximum(run_starts - 1, 0), axis=0), 0)
+            np.put_along_axis(sizes[:, start:start + step], order,
+                              np.take_along_axis(totals, run_ends, axis=0) - before, axis=0)
+
+    return sizes
+
+
+def _flatten_procedures(procedures: Dict[int, List[Procedure]], indexes: List[int]) -> Dict[str, np.ndarray]:
+    flat = [procedure for index in indexes for procedure in procedures[index]]
+    arrays = {'order': np.array(indexes, dtype=np.int64),
+              'starts': np.cumsum([0] + [len(procedures[index]) for index in indexes]),
+              'rc': np.array([procedure[0] for procedure in flat], dtype=np.int64).reshape(-1, 2),
+              'this': np.array([procedure[1] for procedure in flat]),
+              'that': np.array([procedure[2] for procedure in flat])}
+
+    for slot, kind in ((3, 'this_set'), (4, 'that_set'), (5, 'neither_set')):
+        arrays[kind + '_starts'] = np.cumsum([0] + [len(procedure[slot]) for procedure in flat])
+        arrays[kind] = np.fromiter((index for procedure in flat for index in sorted(procedure[slot])), dtype=np.int64,
+                                   count=int(arrays[kind + '_starts'][-1]))
+
+    return arrays
+
+
+class _StoredProcedures(Mapping):
+    """
+    procedures of one shape that are decoded from a saved teller the first time an image needs them. They're iterated
+    in the order they were saved in
+    """
+
+    def __init__(self, indexes: List[int], arrays: Dict[str, np.ndarray]):
+        if 'order' in arrays:
+            indexes = arrays['order'].tolist()
+        self._rows = {index: row for row, index in enumerate(indexes)}
+        self._arrays = arrays
+        self._decoded = dict()
+
+    def __getitem__(self, index: int) -> List[Procedure]:
+        if index not in self._decoded:
+            arrays = self._arrays
+            row = self._rows[index]
+            procedures = []
+            for i in range(int(arrays['starts'][row]), int(arrays['starts'][row + 1])):
+                sets = [set(arrays[kind][arrays[kind + '_starts'][i]:arrays[kind + '_starts'][i + 1]].tolist()) for
+                        kind in ('this_set', 'that_set', 'neither_set')]
+                procedures.append((tuple(arrays['rc'][i].tolist()), arrays['this'][i], arrays['that'][i], *sets))
+            self._decoded[index] = procedures
+
+        return self._decoded[index]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class _ProbeTable:
+    """
+    the procedures of one shape compiled to flat arrays, for the 'packed' engine. Probe i reads the pixel at
+    <rows[i]>, <columns[i]> of the image as one integer and compares it with the packed colors <this[i]> and <that[i]>.
+    The sets of images are bitmasks over the rows of the shape, bit r is the image <indexes[r]>. The probes of row r are
+    starts[r]:starts[r + 1]. So a probe costs a slice, an int.from_bytes and a few integer operations, no numpy.
+    """
+
+    def __init__(self, indexes: List[int], width: int, pixel_bytes: int, itemsize: int, starts: List[int],
+                 rows: List[int], columns: List[int], this: List[int], that: List[int], this_masks: List[int],
+                 that_masks: List[int], neither_masks: List[int]):
+        colors = 'I' if pixel_bytes <= 4 else 'Q'
+        self.indexes = indexes
+        self.width = width
+        self.pixel_bytes = pixel_bytes
+        self.itemsize = itemsize
+        # a gray pixel read as one channel, times this, is the packed color with that value in every channel
+        self.gray_to_color = sum(1 << (8 * itemsize * channel) for channel in range(pixel_bytes // itemsize))
+        self.starts = starts
+        self.rows = array.array('q', rows)
+        self.columns = array.array('q', columns)
+        self.this = array.array(colors, this)
+        self.that = array.array(colors, that)
+        self.this_masks = this_masks
+        self.that_masks = that_masks
+        self.neither_masks = neither_masks
+
+    @classmethod
+    def of_procedures(cls, procedures: Dict[int, List[Procedure]], indexes: List[int], width: int,
+                      pixel_bytes: int, itemsize: int) -> '_ProbeTable':
+        rows = {index: row for row, index in enumerate(indexes)}
+
+        def mask(images: Set[int]) -> int:
+            bits = 0
+            for index in images:
+                bits |= 1 << rows[index]
+            return bits
+
+        def packed(color: np.ndarray) -> int:
+            return int.from_bytes(np.ascontiguousarray(color).tobytes(), 'little')
+
+        flat = [procedure for index in indexes for procedure in procedures[index]] if procedures else []
+        return cls(list(indexes), width, pixel_bytes, itemsize,
+                   np.cumsum([0] + [len(procedures[index]) if procedures else 0 for index in indexes]).tolist(),
+                   [int(procedure[0][0]) for procedure in flat], [int(procedure[0][1]) for procedure in flat],
+                   [packed(procedure[1]) for procedure in flat], [packed(procedure[2]) for procedure in flat],
+                   [mask(procedure[3]) for procedure in flat], [mask(procedure[4]) for procedure in flat],
+                   [mask(procedure[5]) for procedure in flat])
+
+    def rc(self, probe: int) -> Tuple[int, int]:
+        return self.rows[probe], self.columns[probe]
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        mask_bytes = (len(self.indexes) + 7) // 8
+
+        def masks(bitmasks: List[int]) -> np.ndarray:
+            raw = b''.join(bits.to_bytes(mask_bytes, 'little') for bits in bitmasks)
+            return np.frombuffer(raw, dtype=np.uint8).reshape(len(bitmasks), mask_bytes)
+
+        return {'indexes': np.array(self.indexes, dtype=np.int64),
+                'geometry': np.array([self.width, self.pixel_bytes, self.itemsize], dtype=np.int64),
+                'starts': np.array(self.starts, dtype=np.int64),
+                'rc': np.array([self.rows, self.columns], dtype=np.int64).T.reshape(-1, 2),
+                'this': np.array(self.this, dtype=np.uint64),
+                'that': np.array(self.that, dtype=np.uint64),
+                'this_masks': masks(self.this_masks),
+                'that_masks': masks(self.that_masks),
+                'neither_masks': masks(self.neither_masks)}
+
+    @classmethod
+    def of_arrays(cls, indexes: List[int], arrays: Dict[str, np.ndarray]) -> '_ProbeTable':
+        def masks(raw: np.ndarray) -> List[int]:
+            return [int.from_bytes(row.tobytes(), 'little') for row in raw]
+
+        if 'indexes' in arrays:
+            indexes = arrays['indexes'].tolist()
+        width, pixel_bytes, itemsize = arrays['geometry'].tolist()
+        return cls(list(indexes), width, pixel_bytes, itemsize, arrays['starts'].tolist(),
+                   arrays['rc'][:, 0].tolist(), arrays['rc'][:, 1].tolist(), arrays['this'].tolist(),
+                   arrays['that'].tolist(), masks(arrays['this_masks']), masks(arrays['that_masks']),
+                   masks(arrays['neither_masks']))
+
+
+def _bytes_of(img: np.ndarray) -> Tuple[memoryview, int, int, int]:
+    """
+    the bytes <img> lies in, without copying if it's a view of a C contiguous array whose channels are next to each
+    other, e.g. a region of a screenshot or a gray image broadcast to 3 channels. Other views, e.g. with the channels
+    reversed, are copied
+
+    :return: a memoryview of the bytes, the offset of the first pixel of <img> in it and the strides of rows and
+        columns. Pixel r, c starts at offset + r * row stride + c * column stride
+    """
+    if img.ndim == 3 and img.strides[2] not in (0, img.itemsize):
+        img = np.ascontiguousarray(img)
+
+    owner = img
+    while isinstance(owner.base, np.ndarray):
+        owner = owner.base
+
+    if not (owner.flags.c_contiguous and owner.size):
+        owner = img = np.ascontiguousarray(img)
+
+    offset = img.__array_interface__['data'][0] - owner.__array_interface__['data'][0]
+    return memoryview(owner.reshape(-1)).cast('B'), offset, img.strides[0], img.strides[1]
+
+
+class _FrameWatch:
+    """
+    what ImageTeller.stream remembers from one frame to the next
+    """
+
+    def __init__(self, teller: 'ImageTeller', verify_every: int = 0):
+        if teller._engine == 'hash':  # built before the first frame, not while frames are told
+            with teller._compiling:
+                teller._watchTrees = True
+                teller._compile_watch_trees(list(teller._store.stacks))
+        self.teller = teller
+        self.verify_every = verify_every
+        self.number = 0
+        self.index: Optional[int] = None
+        self.shape: Optional[Tuple[int, ...]] = None
+        self.watched: List[Tuple[Tuple[int, int], bytes]] = []  # (pixel, color) that decided the last told frame
+
+    def see(self, frame: np.ndarray) -> int:
+        """
+        :return: the index of <frame>, told again only if a watched pixel changed
+        """
+        number = self.number
+        self.number += 1
+
+        if self.watched and frame.shape == self.shape and not (
+                self.verify_every and number % self.verify_every == 0) and all(
+                frame[rc].tobytes() == color for rc, color in self.watched):
+            return self.index
+
+        teller = self.teller
+        trace = []
+        index = teller._tell(frame, trace)
+        if not trace and index != -1:  # the image was told without probes, watch the pixels of its tree path
+            stack = teller._store.stacks[tuple(frame.shape[:2])]
+            if stack.shape[3] * stack.itemsize <= 8:  # otherwise colors can't be packed, it's told every time
+                trace = teller._probe_pixels_of(index) or teller._locate_probes_of(index, 8)
+
+        self.watched = [(rc, frame[rc].tobytes()) for rc in trace]
+        self.shape = frame.shape
+        self.index = index
+        return index
+
+
+def tell_regions(frame: np.ndarray, regions: Iterable[Tuple['ImageTeller', int, int, Tuple[int, int]]]) -> List[int]:
+    """
+    tell many fixed regions of one frame, e.g. a screenshot, without cropping or converting anything, see
+    ImageTeller.tell_at
+
+    :param regions: (teller, x, y, shape) of every region, x, y being its top left corner and shape its rows and
+        columns
+    :return: the index of every region, -1 if it's none of the possible images of its teller
+    """
+    return [teller.tell_at(frame, x, y, shape) for teller, x, y, shape in regions]
+
+
+def _flatten_tree(root: TreeNode) -> Dict[str, np.ndarray]:
+    """
+    number the nodes breadth first. Edges point to node numbers, or to images as -2 - index. A list of images is a node
+    at pixel -1, -1 with an edge of color 0 to every image, and the b'' child of a node is its default, -1 if none
+    """
+    nodes = [root]
+    edge_colors = []
+    edge_targets = []
+    edge_starts = [0]
+    defaults = []
+    blank = bytes(len(next(color for color in root[1] if color)))
+
+    def target(child: Union[TreeNode, int, List[int]]) -> int:
+        if type(child) is not tuple and type(child) is not list:
+            return -2 - child
+        nodes.append(child)
+        return len(nodes) - 1
+
+    for node in nodes:  # grows while iterating
+        if type(node) is list:
+            for index in node:
+                edge_colors.append(blank)
+                edge_targets.append(-2 - index)
+            defaults.append(-1)
+        else:
+            for color, child in node[1].items():
+                if color:
+                    edge_colors.append(color)
+                    edge_targets.append(target(child))
+            defaults.append(target(node[1][b'']) if b'' in node[1] else -1)
+        edge_starts.append(len(edge_targets))
+
+    return {'rc': np.array([(-1, -1) if type(node) is list else node[0] for node in nodes],
+                           dtype=np.int64).reshape(-1, 2),
+            'edge_starts': np.array(edge_starts, dtype=np.int64),
+            'edge_colors': np.frombuffer(b''.join(edge_colors), dtype=np.uint8).reshape(len(edge_colors), -1),
+            'edge_targets': np.array(edge_targets, dtype=np.int64),
+            'defaults': np.array(defaults, dtype=np.int64)}
+
+
+def _unflatten_tree(arrays: Dict[str, np.ndarray]) -> TreeNode:
+    rcs = arrays['rc'].tolist()
+    starts = arrays['edge_starts'].tolist()
+    colors = arrays['edge_colors']
+    targets = arrays['edge_targets'].tolist()
+    defaults = arrays['defaults'].tolist() if 'defaults' in arrays else [-1] * len(rcs)
+
+    nodes = [[] if rc == [-1, -1] else (tuple(rc), dict()) for rc in rcs]
+    for number, node in enumerate(nodes):
+        for edge in range(starts[number], starts[number + 1]):
+            target = targets[edge]
+            if type(node) is list:
+                node.append(-2 - target)
+            else:
+                node[1][colors[edge].tobytes()] = nodes[target] if target >= 0 else -2 - target
+        if defaults[number] != -1:
+            node[1][b''] = nodes[defaults[number]] if defaults[number] >= 0 else -2 - defaults[number]
+
+    return nodes[0]
+
+
+class _Stats:
+    """
+    the counters of an instrumented teller, see ImageTeller.stats
+    """
+
+    def __init__(self, on_tell: Optional[Callable[[dict], None]]):
+        self.on_tell = on_tell
+        self.shapes: Dict[Tuple[int, int], dict] = dict()
+        self.lock = threading.Lock()  # held while the counters of <shapes> change, tells can run in many threads
+        self._local = threading.local()
+
+    @property
+    def call(self) -> Optional[dict]:
+        """
+        what the tell in progress in this thread did so far
+        """
+        return getattr(self._local, 'call', None)
+
+    @call.setter
+    def call(self, call: Optional[dict]):
+        self._local.call = call
+
+    def of(self, shape: Tuple[int, int]) -> dict:
+        if shape not in self.shapes:
+            self.shapes[shape] = {'calls': 0, 'seconds': 0.0, 'probes': 0, 'max_probes': 0, 'branches': dict(),
+                                  'verifications': 0, 'verification_seconds': 0.0, 'build_seconds': 0.0}
+        return self.shapes[shape]
+
+    def branch(self, name: str):
+        if self.call is not None:
+            self.call['branch'] = name
+
+    def verified(self, trace: Optional[List[Tuple[int, int]]], seconds: float):
+        if self.call is not None:
+            # the pixels appended for failed verifications aren't probes, they come after the first one
+            self.call.setdefault('probes', len(trace) if trace is not None else 0)
+            self.call['verifications'] = self.call.get('verifications', 0) + 1
+            self.call['verification_seconds'] = self.call.get('verification_seconds', 0.0) + seconds
+
 
 class ImageTeller:
     _shapeToImgIndexes: Dict[Tuple[int, int], List[int]]
 
-    def __init__(self, possible_images: List[np.ndarray], surprises = True):
+    def __init__(self, possible_images: Union[List[np.ndarray], TemplateStore], surprises = True,
+                 engine: str = 'procedures', store_path: Optional[str] = None, tolerance: int = 0,
+                 stats: bool = False, on_tell: Optional[Callable[[dict], None]] = None, compilation: str = 'eager',
+                 verify_samples: int = 0, weights: Optional[Sequence[float]] = None, adapt_every: int = 0,
+                 masks: Union[None, str, List[Optional[np.ndarray]]] = None):
         """
         An ImageTeller analyzes a list of given images upon creation to know their differences.
         It takes time to analyze. Please only initialize once.
 
-        :param possible_images: a list of numpy images
+        :param possible_images: a list of numpy images, or a TemplateStore
         :param surprises: whether the image teller will encounter unknown images. Setting it to False will give an roughly 10% performance increase.
+        :param engine: 'procedures' compiles a linear list of probes for every image.
+            'tree' compiles one shared decision tree per shape, every node probes the pixel whose colors split the
+            remaining images most evenly. A tell then takes about log(n) probes instead of up to n.
+            'hash' indexes a digest of every image. A tell then hashes the whole image and does one dict lookup,
+            which beats probing when the images you tell are mostly exact copies of the possible images.
+            'packed' runs the same probes as 'procedures', compiled to flat integer arrays. Colors are compared as
+            packed integers read straight from the bytes of the image, and sets of images are bitmasks. It takes less
+            memory and skips the numpy call overhead of every probe.
+        :param store_path: if given, the images are packed into this file and memory mapped from it, see TemplateStore
+        :param tolerance: how much every channel of a pixel may differ from the possible image, for noisy or lossy
+            captures. Procedures then only probe pixels where images differ by more than twice as much, and images are
+            verified by their largest difference instead of exact equality. Only the 'procedures' engine supports it.
+        :param stats: whether to count what every tell does, see ImageTeller.stats. Off, it costs next to nothing
+        :param on_tell: if given, it's called with a record of every tell, see ImageTeller.stats. Implies stats
+        :param compilation: when the images of every shape are analyzed.
+            'eager' analyzes all of them before the teller is returned.
+            'lazy' analyzes a shape on the first tell of an image of that shape.
+            'background' analyzes the shapes in a background thread, smallest first. Until a shape is done, images of
+            that shape are compared with all possible images of the shape directly.
+            Either way the teller is returned right away. compile_all analyzes what's left.
+        :param verify_samples: if > 0, a told image is verified at this many pixels instead of all of them, so
+            verification takes the same time however big the images are. The pixels are spread over the image: it's
+            cut into this many strips and one random pixel is taken from every strip, drawn again for every tell
+            (tell_many draws once per batch). An image that differs from the possible image in a share f of its
+            pixels then passes with a probability of at most (1 - f) ** samples, e.g. 64 samples let at most 0.15% of
+            the images through that differ in 10% of their pixels. Images that differ in a few pixels only will often
+            pass. tell(img, certain=True) verifies in full.
+        :param weights: if given, how often every image is expected to be told, relative to the others, e.g. how often
+            it was told in the past. Frequent images are then tried first and confirmed with fewer probes: the
+            procedures of frequent images are tried before the others, their first probes tell them apart from other
+            frequent images, and trees split by weight, like a Huffman code. Weights are rounded down to powers of
+            two, images that are told about as often are treated alike
+        :param adapt_every: if > 0, tell counts which index it returns, and after every this many answers the shapes
+            are ordered again by weights plus counts in a background thread, see adapt
+        :param masks: which pixels of the possible images count, e.g. for icons whose background changes. 'alpha' takes
+            the opaque pixels of BGRA images as their masks and tells them as BGR images. Or give a (rows, columns)
+            bool array for every image, None for images whose pixels all count. Probes then only read pixels that are
+            opaque in all images of a shape, and images are only verified at their own opaque pixels. The 'hash' engine
+            doesn't support masks
         """
         assert len(possible_images) >= 1, "Please provide a list of at least one image as an argument"
+        assert engine in ENGINES, "engine should be one of %s" % (ENGINES,)
+        assert compilation in COMPILATIONS, "compilation should be one of %s" % (COMPILATIONS,)
+        assert verify_samples >= 0, "verify_samples can't be negative"
+        assert weights is None or len(weights) == len(possible_images), "give one weight per image"
+        assert weights is None or min(weights) > 0, "weights have to be positive"
+        assert adapt_every >= 0, "adapt_every can't be negative"
+        assert tolerance >= 0, "tolerance can't be negative"
+        assert tolerance == 0 or engine == 'procedures', "only the 'procedures' engine supports a tolerance"
 
         self._surprises = surprises
+        self._engine = engine
+        self._tolerance = tolerance
+        self._verifySamples = verify_samples
+        self._shapeToStrips: Dict[Tuple[int, int], np.ndarray] = dict()  # bounds of the strips of verify_samples
+        self._random = np.random.RandomState()  # draws the samples, RandomState locks itself for threads
+        self.labels: Optional[List[str]] = None  # names of the indexes, only loaded tellers have them, see save
+        self._extraMeta = dict()  # saved and loaded with the teller, for wrappers like MultiScaleTeller
+        self._stats = _Stats(on_tell) if stats or on_tell is not None else None
+        self._procedureBytesLimit: Optional[int] = None  # see build_index
+        self._priors = [1.0] * len(possible_images) if weights is None else [float(weight) for weight in weights]
+        self._answerCounts: Dict[int, int] = collections.Counter()  # only counted with adapt_every
+        self._adaptEvery = adapt_every
+        self._answersToAdapt = adapt_every
+        self._adapting = False  # an adapt thread is running
+        self._shapeToOrder: Dict[Tuple[int, int], List[int]] = dict()  # the order the shape was analyzed in
+
+        if not isinstance(possible_images, TemplateStore):
+            if isinstance(masks, str):
+                assert masks == 'alpha', "masks should be 'alpha' or a list of masks"
+                possible_images, masks = _alpha_masks(possible_images)
+            possible_images = TemplateStore(possible_images, store_path, masks)
+        self._store = possible_images
+        assert engine != 'hash' or not self._store.mask_stacks, "the 'hash' engine doesn't support masks"
+
+        self._possible_images = self._store.images  # views into the contiguous stack of their shape
+        self._masks = self._store.masks  # None for images without a mask
+        self._indexToOpaque: Dict[int, Tuple[np.ndarray, np.ndarray]] = dict()  # see _opaque_of
+        self._shapeToRanking: Dict[Tuple[int, int], np.ndarray] = dict()  # see _ranking_pixels_of
+
+        self._shapeToImgIndexes = self._store.shape_to_indexes
+
+        self._shapeToProcedures: Dict[Tuple[int, int], Dict[int, List[Procedure]]] = dict()
+        self._shapeToTree: Dict[Tuple[int, int], TreeNode] = dict()
+        self._watchTrees = False  # whether a stream watches the trees of the 'hash' engine, see _compile_watch_trees
+        self._digestToIndexes: Dict[Tuple[Tuple[int, ...], str, int], List[int]] = dict()
+        self._shapeToTable: Dict[Tuple[int, int], _ProbeTable] = dict()
+
+        self._compilation = compilation
+        self._compiling = threading.Lock()  # held while a pending shape is analyzed or images are added or removed
+        self._pending: Set[Tuple[int, int]] = set()  # shapes that aren't analyzed yet
+
+        if compilation == 'eager':
+            for shape in self._shapeToImgIndexes.keys():
+                self._compile_shape(shape)
+        else:
+            self._pending.update(self._shapeToImgIndexes.keys())
+            if compilation == 'background':
+                threading.Thread(target=self.compile_all, name='whichimg compilation', daemon=True).start()
+
+    def compile_all(self):
+        """
+        analyze every shape that isn't analyzed yet. With background compilation, this helps the background thread and
+        returns when every shape is done.
+        """
+        while True:
+            with self._compiling:
+                if not self._pending:
+                    return
+                shape = min(self._pending, key=lambda pending: len(self._shapeToImgIndexes[pending]))
+                self._compile_shape(shape)
+                self._pending.discard(shape)
+
+    def _compile_pending(self, shape: Tuple[int, int]):
+        with self._compiling:
+            if shape in self._pending:
+                self._compile_shape(shape)
+                self._pending.discard(shape)
+
+    def _compile_shape(self, shape: Tuple[int, int]):
+        """
+        analyze the images of <shape> for the engine of this teller
+        """
+        if self._stats is not None:
+            start = time.perf_counter()
+            self._compile_shape_of_engine(shape)
+            with self._stats.lock:
+                self._stats.of(shape)['build_seconds'] += time.perf_counter() - start
+        else:
+            self._compile_shape_of_engine(shape)
+
+    def _compile_shape_of_engine(self, shape: Tuple[int, int]):
+        order, weights = self._order_of(shape)
+
+        # new objects replace the old ones, tells that are walking the old ones can finish
+        if self._engine == 'tree':
+            self._shapeToTree[shape] = self._produce_tree_of_shape(shape, weights)
+        elif self._engine == 'hash':
+            for index in self._shapeToImgIndexes[shape]:
+                self._digestToIndexes.setdefault(_digest(self._possible_images[index]), []).append(index)
+        elif self._engine == 'packed':
+            stack = self._store.stacks[shape]
+            self._shapeToTable[shape] = _ProbeTable.of_procedures(
+                self._produce_procedures_of_shape(shape, weights), order[::-1], shape[1],  # the highest bit first
+                stack.itemsize * int(np.prod(stack.shape[3:], dtype=np.int64)), stack.itemsize)
+        else:
+            procedures = self._produce_procedures_of_shape(shape, weights)
+            # can be empty if there's only one image of a single shape, otherwise they're tried in this order
+            self._shapeToProcedures[shape] = {index: procedures[index] for index in order} if procedures else procedures
+
+        self._shapeToOrder[shape] = order
+
+    def _order_of(self, shape: Tuple[int, int]) -> Tuple[List[int], Optional[np.ndarray]]:
+        """
+        :return: the indexes of <shape>, the most frequent first, and their weights rounded down to powers of two in
+            the order of the stack. No weights if all images weigh the same
+        """
+        indexes = self._shapeToImgIndexes[shape]
+        weights = np.array([self._priors[index] + self._answerCounts.get(index, 0) for index in indexes])
+        weights = 2.0 ** np.floor(np.log2(weights))
 
-        self._possible_images = possible_images
+        if (weights == weights[0]).all():
+            return list(indexes), None
+        return [indexes[row] for row in np.argsort(-weights, kind='stable')], weights
 
-        self._shapeToImgIndexes = dict()
+    def adapt(self):
+        """
+        analyze the shapes again whose images are told in a different order of frequency than when they were
+        analyzed, by the weights of the teller plus the answers counted since. With adapt_every it runs in a background
+        thread on its own. Tells can go on meanwhile, they use the old analysis until the new one is done.
+        """
+        for shape in list(self._shapeToImgIndexes):
+            with self._compiling:
+                if shape in self._pending or shape not in self._shapeToImgIndexes or self._engine == 'hash':
+                    continue
+                if self._order_of(shape)[0] != self._shapeToOrder.get(shape):
+                    self._compile_shape(shape)
+
+    def _adapt_in_background(self):
+        try:
+            self.adapt()
+        finally:
+            self._adapting = False
+
+    def tell(self, img: np.array, certain: bool = False,
+             nearest: Union[bool, int] = False) -> Union[int, Tuple[int, List[Tuple[int, float]]]]:
+        """
+        Analyzes <img> and returns the the index of argument <img> in possible images, -1 if not found
+        Note: It will only stably return -1 when keyword argument <surprises> of this teller is set to True. (which is the default)
+        If you set it to False. It will still get known images right. But it's possible it will mistaken unexpected images for known ones.
 
-        for index, img in enumerate(possible_images):
-            if img.shape[2] != 3:
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        :param img: the image you want to tell
+        :param certain: if this teller verifies samples only, whether to compare the told image in full anyway
+        :param nearest: if set, return the index and, for an unknown image, the closest possible images too, see
+            closest. The pixels the tell probed are reused to rank them. An int is how many, True is 3
+        :return: the index, or (index, closest) with <nearest>. closest is empty unless the index is -1
+        """
+        trace = [] if nearest is not False else None
+        if self._stats is None:
+            index = self._tell(img, trace)
+        else:
+            index = self._tell_instrumented(img, trace)
+
+        if certain and self._verifySamples and self._surprises and index != -1:
+            possible_image = self._possible_images[index]
+            img = _conformed(img, possible_image.shape[2], possible_image.dtype)
+            if img is None or not self._matches(img, possible_image, self._opaque_of(index)):
+                index = -1
+
+        if self._adaptEvery and index != -1:
+            self._answerCounts[index] += 1  # a count lost to a race with another thread doesn't matter
+            self._answersToAdapt -= 1
+            if self._answersToAdapt <= 0 and not self._adapting:
+                self._answersToAdapt = self._adaptEvery
+                self._adapting = True
+                threading.Thread(target=self._adapt_in_background, name='whichimg adaptation', daemon=True).start()
+
+        if nearest is not False:
+            return index, (self._closest(img, trace, 3 if nearest is True else nearest) if index == -1 else [])
+        return index
+
+    def closest(self, img: np.ndarray, count: int = 3, candidates: int = 8) -> List[Tuple[int, float]]:
+        """
+        the possible images that <img> is most like, e.g. to log what an unknown image resembles. Only images of the
+        same shape are compared. They are ranked by the pixels a tell of <img> probes and by some of the pixels the
+        images differ in, and only the best <candidates> of them are compared in full.
+
+        :param count: how many images to return
+        :param candidates: how many images are compared in full. The more, the likelier the ranking is exact
+        :return: (index, distance) of up to <count> images, the closest first. The distance is the mean absolute
+            difference of the channels of <img> and the image, over the pixels of its mask. An empty list if no
+            possible image has the shape of <img>
+        """
+        trace = []
+        self._tell(img, trace)
+        return self._closest(img, trace, count, candidates)
 
-            shape_tuple = tuple(img.shape[:2])
+    def _closest(self, img: np.ndarray, trace: List[Tuple[int, int]], count: int,
+                 candidates: int = 8) -> List[Tuple[int, float]]:
+        shape = tuple(img.shape[:2])
+        if shape not in self._shapeToImgIndexes:
+            return []
+        indexes = self._store.shape_to_indexes[shape]
+        stack = self._store.stacks[shape]
+        mask_stack = self._store.mask_stacks.get(shape)
+        img = _conformed(img, stack.shape[3], stack.dtype)
+        if img is None or img.shape != stack.shape[1:]:
+            return []
 
-            if shape_tuple in self._shapeToImgIndexes:
-                self._shapeToImgIndexes[shape_tuple].append(index)
-            else:
-                self._shapeToImgIndexes[shape_tuple] = [index]
+        channels = stack.shape[3]
+        pixels = stack.reshape(len(stack), -1, channels)
+        img = img.reshape(-1, channels)
+        opaque = None if mask_stack is None else mask_stack.reshape(len(mask_stack), -1)
 
-        self._shapeToProcedures: Dict[Tuple[int, int], Dict[int, List[Procedure]]] = {shape: dict() for shape in
-                                                                                      self._shapeToImgIndexes.keys()}
+        flat = self._ranking_pixels_of(shape)
+        if trace:
+            probed = np.array(trace, dtype=np.int64).reshape(-1, 2)
+            flat = np.concatenate([flat, probed[:, 0] * shape[1] + probed[:, 1]])
+        estimates = _mean_absdiff(pixels.take(flat, axis=1), img[flat],
+                                  None if opaque is None else opaque.take(flat, axis=1))
+        best = np.argsort(estimates, kind='stable')[:max(count, candidates)]
 
-        for shape, imgIndexes in self._shapeToImgIndexes.items():
-            self._shapeToProcedures[shape] = self._produce_procedures_of_shape(
-                shape)  # can be empty dict if there's only one image of a single shape
+        distances = _mean_absdiff(pixels[best], img, None if opaque is None else opaque[best])
+        closest = np.argsort(distances, kind='stable')[:count]
+        return [(int(indexes[best[row]]), float(distances[row])) for row in closest]
 
-    def tell(self, img: np.array) -> int:
+    def tell_at(self, frame: np.ndarray, x: int, y: int, shape: Optional[Tuple[int, int]] = None) -> int:
         """
-        Analyzes <img> and returns the the index of argument <img> in possible images, -1 if not found
-        Note: It will only stably return -1 when keyword argument <surprises> of this teller is set to True. (which is the default)
-        If you set it to False. It will still get known images right. But it's possible it will mistaken unexpected images for known ones.
+        tell the image whose top left corner is at <x>, <y> of <frame>, e.g. a fixed region of a screenshot. Nothing is
+        cropped, copied or converted: the probes read the frame itself, a gray frame too.
 
-        :param img: the image you want to tell
+        :param shape: rows and columns of the region, by default the shape of the possible images. A teller of
+            several shapes needs it: an image of the wrong shape can match where the probes of its shape look
+        :return: the index of the image, -1 if it's none of the possible images
+        """
+        if shape is None:
+            assert len(self._shapeToImgIndexes) == 1, "The possible images have several shapes, give the shape"
+            shape = next(iter(self._shapeToImgIndexes))
+        rows, columns = shape
+        if y + rows > frame.shape[0] or x + columns > frame.shape[1]:
+            return -1
+        return self.tell(frame[y:y + rows, x:x + columns])  # a view
+
+    def _ranking_pixels_of(self, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        :return: the flat pixels that closest ranks images of <shape> by, besides the probed ones. Pixels that all
+            images share add the same to every image, so these are up to _RANKING_PIXELS pixels, evenly spread over the
+            ones that differ among the images
+        """
+        if shape not in self._shapeToRanking:
+            stack = self._store.stacks[shape]
+            varying = np.zeros(shape, dtype=bool)
+            for img in stack[1:]:  # one image at a time, stacks can be bigger than memory
+                varying |= (img != stack[0]).any(axis=2)
+            flat = np.flatnonzero(varying)
+            if len(flat) > _RANKING_PIXELS:
+                flat = flat[np.linspace(0, len(flat) - 1, _RANKING_PIXELS).astype(np.int64)]
+            self._shapeToRanking[shape] = flat
+        return self._shapeToRanking[shape]
+
+    def _tell_instrumented(self, img: np.ndarray, trace: Optional[List[Tuple[int, int]]] = None) -> int:
+        stats = self._stats
+        call = stats.call = {'branch': None}
+        if trace is None:
+            trace = []
+
+        start = time.perf_counter()
+        try:
+            index = self._tell(img, trace)
+        finally:
+            stats.call = None
+        seconds = time.perf_counter() - start
+
+        shape = tuple(img.shape[:2])
+        probes = call.get('probes', len(trace))
+        branch = call['branch'] if shape in self._shapeToImgIndexes else 'shape'
+
+        with stats.lock:
+            counters = stats.of(shape)
+            counters['calls'] += 1
+            counters['seconds'] += seconds
+            counters['probes'] += probes
+            counters['max_probes'] = max(counters['max_probes'], probes)
+            counters['branches'][branch] = counters['branches'].get(branch, 0) + 1
+            if 'verifications' in call:
+                counters['verifications'] += call['verifications']
+                counters['verification_seconds'] += call['verification_seconds']
+
+        if stats.on_tell is not None:
+            stats.on_tell({'shape': shape, 'index': index, 'branch': branch, 'probes': probes, 'seconds': seconds,
+                           'verification_seconds': call.get('verification_seconds')})
+        return index
+
+    def stats(self, reset: bool = False) -> Dict[Tuple[int, int], dict]:
+        """
+        a snapshot of what this teller did, per shape of the told images. The teller has to be created with stats=True
+        or an on_tell callback.
+
+        Every shape has the numbers of
+            calls: tells, and seconds: the time they took in total
+            probes: pixels probed in total, and max_probes: the most of a single tell
+            branches: tells per way the walk ended.
+                'this': the examined image was left alone, 'last': one other image was left,
+                'none': no image was left, 'single': the only image of its shape,
+                'leaf': a leaf of the tree, 'digest': a digest was found, 'collision': several were,
+                'shape': no image has this shape, 'pending': the shape wasn't analyzed yet
+            verifications: how often a told image was compared with a possible image, which can be several times
+                per tell when probing can't tell images apart, and verification_seconds: the time that took in total
+            build_seconds: the time it took to analyze the images of the shape
+
+        A record passed to on_tell has the shape, index, branch, probes, seconds and verification_seconds of one tell,
+        the latter is the time of all its verifications, None if the image wasn't verified.
+
+        :param reset: whether to start counting from zero again, build times are kept
+        """
+        assert self._stats is not None, "create the teller with stats=True to collect stats"
+
+        with self._stats.lock:
+            snapshot = copy.deepcopy(self._stats.shapes)
+            if reset:
+                for shape, counters in list(self._stats.shapes.items()):
+                    del self._stats.shapes[shape]
+                    self._stats.of(shape)['build_seconds'] = counters['build_seconds']
+        return snapshot
+
+    def _tell(self, img: np.ndarray, trace: Optional[List[Tuple[int, int]]]) -> int:
+        """
+        :param trace: if given, the pixels the walk probes are appended to it
         """
         # assert isinstance(img, np.ndarray), "only accepts images in form of numpy.ndarray"
 
-        if img.ndim == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        shape = tuple(img.shape[:2])
 
+        if shape not in self._shapeToImgIndexes:
+            return -1
+
+        stack = self._store.stacks[shape]
+        img = _conformed(img, stack.shape[3], stack.dtype)  # in the layout of the possible images, a view if it can be
+        if img is None:
+            return -1
+
+        if self._pending and shape in self._pending:
+            if self._compilation == 'background':
+                if self._stats is not None:
+                    self._stats.branch('pending')
+                return self._compare_directly(img, shape)
+            self._compile_pending(shape)
+
+        if self._engine == 'tree':
+            return self._walk_tree(img, shape, trace)
+        if self._engine == 'hash':
+            return self._walk_digests(img)
+        if self._engine == 'packed':
+            return self._walk_table(img, shape, trace)
+
+        return self._walk_procedures(img, shape, trace)
+
+    def stream(self, frames: Iterable[np.ndarray], verify_every: int = 0) -> Iterator[Tuple[int, int]]:
+        """
+        tell a stream of frames, e.g. the same screen region polled over and over, and only report changes.
+
+        After a frame is told, the next frames only read the pixels that decided it. As long as those pixels keep
+        their colors the frame is taken to be unchanged, so changes elsewhere in the frame go unnoticed until one of
+        them changes or the next full tell. An unknown frame is watched at the decisive pixels and at a pixel where it
+        differs from the only image it could have been. The 'hash' engine has no probes, its frames are watched on the
+        path of the decision tree of their shape, which is built before the first frame and again when images are added
+        or removed, and unknown frames are told every time. So are frames of shapes with pixels of more than 8 bytes, e.g. float64 BGR, which have no tree.
+
+        :param frames: an iterable of images
+        :param verify_every: if > 0, every this many frames are told in full no matter what
+        :return: an iterator of (frame number, index) whenever the index changes, starting with the first frame
+        """
+        return self._stream(_FrameWatch(self, verify_every), frames)  # the watch is set up before the first frame
+
+    @staticmethod
+    def _stream(watch: _FrameWatch, frames: Iterable[np.ndarray]) -> Iterator[Tuple[int, int]]:
+        last_index = None
+        for number, frame in enumerate(frames):
+            index = watch.see(frame)
+            if index != last_index:
+                last_index = index
+                yield number, index
+
+    def tell_many(self, images: Union[np.ndarray, List[np.ndarray]], chunk: int = 256,
+                  certain: bool = False) -> np.ndarray:
+        """
+        tell a batch of images at once. Every probe is read for all images that reach it with one fancy indexing, and
+        images are verified in bulk. The answers are the same as calling tell on every image.
+
+        Images are told with the tree, procedures or probe table of the engine of this teller. The 'hash' engine has
+        no probes, its images are hashed one by one.
+
+        :param images: a (batch, rows, columns, channels) array, a (batch, rows, columns) array of grayscale images or
+            a list of images of any shapes
+        :param chunk: at most this many images are verified at once
+        :param certain: see tell
+        :return: an int array with the index of every image, -1 for unknown images
+        """
+        if self._tolerance:  # the trees are exact
+            return np.array([self.tell(img, certain) for img in images], dtype=int)
+
+        answers = np.full(len(images), -1, dtype=int)
+
+        if isinstance(images, np.ndarray):
+            groups = [(np.arange(len(images)), images)]
+        else:
+            positions_of_shape = dict()
+            for position, img in enumerate(images):
+                positions_of_shape.setdefault(img.shape, []).append(position)
+            groups = [(np.array(positions), np.stack([images[position] for position in positions])) for
+                      positions in positions_of_shape.values()]
+
+        for positions, batch in groups:
+            if batch.ndim == 3:  # grayscale
+                batch = batch[..., None]
+
+            shape = tuple(batch.shape[1:3])
+            if shape in self._shapeToImgIndexes:
+                stack = self._store.stacks[shape]
+                conformed = _conformed(batch, stack.shape[3], stack.dtype)
+                if conformed is None or self._engine == 'hash':
+                    # some images have values the possible images can't have, or there's nothing to probe
+                    answers[positions] = [self.tell(img, certain) for img in batch]
+                else:
+                    answers[positions] = self._tell_batch(conformed, shape, chunk, certain)
+
+        return answers
+
+    def _tell_batch(self, batch: np.ndarray, shape: Tuple[int, int], chunk: int, certain: bool) -> np.ndarray:
+        if self._pending:
+            self._compile_pending(shape)
+
+        if self._engine == 'tree':
+            answers = self._walk_tree_batch(batch, shape)
+        else:
+            answers = self._walk_procedures_batch(batch, shape)
+
+        if self._surprises:
+            stack = self._store.stacks[shape]
+            mask_stack = self._store.mask_stacks.get(shape)
+
+            known = np.flatnonzero(answers >= 0)
+            rows = np.searchsorted(self._shapeToImgIndexes[shape], answers[known])
+            if self._verifySamples and not certain:
+                sample_rows, sample_columns = self._samples_of(shape)
+                batch = batch[:, sample_rows, sample_columns]
+                stack = stack[:, sample_rows, sample_columns]
+                if mask_stack is not None:
+                    mask_stack = mask_stack[:, sample_rows, sample_columns]
+            for start in range(0, len(known), chunk):
+                told = known[start:start + chunk]
+                same = np.all(batch[told] == stack[rows[start:start + chunk]], axis=-1)
+                if mask_stack is not None:
+                    same |= ~mask_stack[rows[start:start + chunk]]
+                equal = np.all(same.reshape(len(told), -1), axis=1)
+                answers[told[~equal]] = -1
+
+        return answers
+
+    def _walk_tree_batch(self, batch: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        _walk_tree for a whole batch. The images that reach a node are split by the colors of its pixel at once. The
+        answers aren't verified, except the leaves with several images that probing can't tell apart
+        """
+        answers = np.full(len(batch), -1, dtype=int)
+
+        pending = [(self._shapeToTree[shape], np.arange(len(batch)))]
+        while pending:
+            node, members = pending.pop()
+
+            if type(node) is list:
+                answers[members] = [self._confirm_any(batch[member], node) for member in members]
+                continue
+            if type(node) is not tuple:
+                answers[members] = node
+                continue
+
+            colors = batch[members, node[0][0], node[0][1]]
+            _, firsts, inverse = np.unique(_pack_pixels(colors), return_index=True, return_inverse=True)
+            for color_id, first in enumerate(firsts):
+                child = node[1].get(colors[first].tobytes(), node[1].get(b''))
+                if child is not None:
+                    pending.append((child, members[inverse.ravel() == color_id]))
+
+        return answers
+
+    def _walk_procedures_batch(self, batch: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        _walk_procedures, or _walk_table, for a whole batch. Images that took the same branches so far are a group, and
+        every probe reads its pixel for the whole group with one fancy indexing before the group splits by the
+        answer. The answers aren't verified, except where masks make a walk confirm an image before it goes on
+        """
+        answers = np.full(len(batch), -1, dtype=int)
+
+        if self._engine == 'packed':
+            table = self._shapeToTable[shape]
+            dtype = self._store.stacks[shape].dtype
+            order = list(range(len(table.indexes)))[::-1]  # rows, the highest bit first
+            remaining = (1 << len(order)) - 1
+
+            def color(packed: int) -> np.ndarray:
+                return np.frombuffer(packed.to_bytes(table.pixel_bytes, 'little'), dtype=dtype)
+
+            def index_of(row: int) -> int:
+                return table.indexes[row]
+
+            def has(images: int, row: int) -> bool:
+                return images >> row & 1 == 1
+
+            def without(images: int, row: int) -> int:
+                return images & ~(1 << row)
+
+            def only(images: int) -> Optional[int]:
+                return table.indexes[images.bit_length() - 1] if images & (images - 1) == 0 else None
+
+            def procedures_of(row: int) -> list:  # with bitmasks instead of sets
+                return [(table.rc(probe), color(table.this[probe]), color(table.that[probe]), table.this_masks[probe],
+                         table.that_masks[probe], table.neither_masks[probe]) for probe in
+                        range(table.starts[row], table.starts[row + 1])]
+        else:
+            procedures_for_all_images = self._shapeToProcedures[shape]
+            order = list(procedures_for_all_images) or self._shapeToImgIndexes[shape][:1]
+            remaining = set(self._shapeToImgIndexes[shape])
+
+            def index_of(index: int) -> int:
+                return index
+
+            def has(images: Set[int], index: int) -> bool:
+                return index in images
+
+            def without(images: Set[int], index: int) -> Set[int]:
+                return images - {index}
+
+            def only(images: Set[int]) -> Optional[int]:
+                return next(iter(images)) if len(images) == 1 else None
+
+            def procedures_of(index: int) -> List[Procedure]:
+                return procedures_for_all_images[index] if procedures_for_all_images else []
+
+        if len(order) == 1:
+            answers[:] = index_of(order[0])
+            return answers
+
+        # (position in <order> of the examined image, its next procedure, images still possible, members). The
+        # position of a group that's done with an image is that of the next one, at procedure None
+        pending = [(0, None, remaining, np.arange(len(batch)))]
+        while pending:
+            position, step, remaining, members = pending.pop()
+
+            if step is None:  # examine the next image that's still possible
+                while position < len(order) and not has(remaining, order[position]):
+                    position += 1
+                if position == len(order):
+                    continue
+                remaining = without(remaining, order[position])
+                step = 0
+
+            key = order[position]
+            procedures = procedures_of(key)
+            if step == len(procedures):  # masks keep the rest from being told apart from the image, compare
+                confirmed = np.array([self._confirm(batch[member], index_of(key)) != -1 for member in members],
+                                     dtype=bool)
+                answers[members[confirmed]] = index_of(key)
+                if not confirmed.all():
+                    pending.append((position + 1, None, remaining, members[~confirmed]))
+                continue
+
+            rc, this_color, that_color, this_images, that_images, neither_images = procedures[step]
+            colors = batch[members, rc[0], rc[1]]
+            is_this = np.all(colors == this_color, axis=-1)
+            is_that = ~is_this & np.all(colors == that_color, axis=-1)
+
+            if is_this.any():
+                left = remaining & this_images
+                if left:
+                    pending.append((position, step + 1, left, members[is_this]))
+                else:
+                    answers[members[is_this]] = index_of(key)
+
+            for chosen, images in ((is_that, that_images), (~is_this & ~is_that, neither_images)):
+                if chosen.any():
+                    left = remaining & images
+                    if only(left) is not None:
+                        answers[members[chosen]] = only(left)
+                    elif left:
+                        pending.append((position + 1, None, left, members[chosen]))
+
+        return answers
+
+    def locate(self, frame: np.ndarray, probes: int = 8) -> List[Tuple[int, int, int]]:
+        """
+        find every place where a possible image appears in <frame>, e.g. a screenshot.
+
+        For every possible image, the pixel with its rarest color is compared at all offsets at once. The offsets that
+        pass are narrowed down with a few more probes, the image's rarest colors and the pixels its procedures probe,
+        and only the offsets that pass all of them are compared in full.
+
+        :param frame: an image bigger than the possible images, of the same dtype. Pixels of at most 8 bytes.
+        :param probes: how many pixels of a possible image are checked before a full comparison
+        :return: (index, x, y) of every hit, where x, y is the top left corner in <frame>
+        """
+        original_frame = frame
+        packed_frames = dict()  # of the frame in every layout of possible images
+        hits = []
+
+        for shape, indexes in self._shapeToImgIndexes.items():
+            frame = _conformed(original_frame, self._store.stacks[shape].shape[3])
+            layout = frame.shape[2], frame.dtype.str
+            if layout not in packed_frames:
+                # one integer per pixel, so that every probe is a single comparison
+                packed_frames[layout] = _pack_pixels(frame)
+            packed_frame = packed_frames[layout]
+
+            height, width = shape
+            offset_rows, offset_columns = frame.shape[0] - height + 1, frame.shape[1] - width + 1
+            if offset_rows <= 0 or offset_columns <= 0:
+                continue
+
+            for index in indexes:
+                img = self._possible_images[index]
+                if img.dtype != frame.dtype or img.shape[2] != frame.shape[2]:
+                    continue
+                (row, column), *rest = self._locate_probes_of(index, probes)
+                packed = _pack_pixels(img)
+
+                if self._tolerance:
+                    ys, xs = np.nonzero(_close(frame[row:row + offset_rows, column:column + offset_columns],
+                                               img[row, column], self._tolerance))
+                else:
+                    ys, xs = np.nonzero(
+                        packed_frame[row:row + offset_rows, column:column + offset_columns] == packed[row, column])
+
+                for row, column in rest:
+                    if len(ys) == 0:
+                        break
+                    if self._tolerance:
+                        passed = _close(frame[ys + row, xs + column], img[row, column], self._tolerance)
+                    else:
+                        passed = packed_frame[ys + row, xs + column] == packed[row, column]
+                    ys, xs = ys[passed], xs[passed]
+
+                for y, x in zip(ys.tolist(), xs.tolist()):
+                    if self._matches(frame[y:y + height, x:x + width], img, self._opaque_of(index)):
+                        hits.append((index, x, y))
+
+        return hits
+
+    def _locate_probes_of(self, index: int, count: int) -> List[Tuple[int, int]]:
+        """
+        :return: up to <count> pixels of the image of <index> to check when locating it. First the pixels with its
+            rarest colors, then the pixels that tell it from the other images of its shape. Only pixels of its mask.
+        """
+        img = self._possible_images[index]
+        mask = self._masks[index]
+        flats = np.arange(img.shape[0] * img.shape[1]) if mask is None else np.flatnonzero(mask)
+        packed = _pack_pixels(img).ravel()[flats]
+        _, inverse, counts = np.unique(packed, return_inverse=True, return_counts=True)
+        order = np.argsort(counts[inverse.ravel()], kind='stable')
+        _, first_of_color = np.unique(packed[order], return_index=True)  # one pixel per color, rarest first
+        rarest = [divmod(int(flat), img.shape[1]) for flat in flats[order[np.sort(first_of_color)][:count]]]
+
+        return list(dict.fromkeys(rarest[:max(1, count // 2)] + self._probe_pixels_of(index) + rarest))[:count]
+
+    def _probe_pixels_of(self, index: int) -> List[Tuple[int, int]]:
+        """
+        :return: the pixels that the analysis of this teller probes to tell the image of <index>
+        """
+        img = self._possible_images[index]
         shape = tuple(img.shape[:2])
 
-        if shape not in self._shapeToProcedures:
+        if shape in self._shapeToProcedures and len(self._shapeToProcedures[shape]) > 0:
+            return [tuple(int(i) for i in procedure[0]) for procedure in self._shapeToProcedures[shape][index]]
+
+        if shape in self._shapeToTable:
+            table = self._shapeToTable[shape]
+            row = table.indexes.index(index)
+            return [table.rc(probe) for probe in range(table.starts[row], table.starts[row + 1])]
+
+        pixels = []
+        node = self._shapeToTree.get(shape)
+        while type(node) is tuple:
+            pixels.append(node[0])
+            node = node[1].get(img[node[0]].tobytes(), node[1].get(b''))
+        return pixels
+
+    def add_image(self, img: np.ndarray, mask: Union[None, str, np.ndarray] = None) -> int:
+        """
+        make <img> a possible image without analyzing everything again. Only the images of the same shape are looked
+        at, and only the procedures that can't tell them from <img> yet are extended. Shapes with masks are analyzed
+        again, a new mask can change which pixels can be probed.
+
+        Indexes are stable: <img> gets a new index after all existing ones, existing images keep theirs.
+
+        :param mask: 'alpha' for the opaque pixels of a BGRA <img>, or a (rows, columns) bool array, see ImageTeller
+        :return: the index of <img>
+        """
+        if isinstance(mask, str):
+            assert mask == 'alpha', "mask should be 'alpha' or a mask"
+            (img,), (mask,) = _alpha_masks([img])
+        assert mask is None or self._engine != 'hash', "the 'hash' engine doesn't support masks"
+
+        with self._compiling:
+            index = self._add_image(img, mask)
+            if self._watchTrees:
+                self._compile_watch_trees([tuple(img.shape[:2])])
+            return index
+
+    def _add_image(self, img: np.ndarray, mask: Optional[np.ndarray] = None) -> int:
+        self._priors.append(1.0)  # the weight of the new index
+        self._indexToOpaque = dict()  # images can be converted to another layout
+        self._shapeToRanking = dict()
+        shape = tuple(img.shape[:2])
+        if shape in self._pending:  # analyzed with the other images of its shape later
+            return self._store.add(img, mask)
+
+        was_compiled = shape in self._shapeToImgIndexes and len(self._shapeToImgIndexes[shape]) > 1
+        stack = self._store.stacks.get(shape)
+        layout = None if stack is None else stack.shape[3:] + (stack.dtype,)
+        index = self._store.add(img, mask)
+
+        stack = self._store.stacks[shape]
+        if shape in self._store.mask_stacks or layout is not None and layout != stack.shape[3:] + (stack.dtype,):
+            # the images of the shape were converted to fit <img>, or <img> can have a mask that rules out probed
+            # pixels, everything analyzed about them is outdated
+            self._digestToIndexes = {key: indexes for key, indexes in self._digestToIndexes.items() if
+                                     tuple(key[0][:2]) != shape}
+            self._shapeToTree.pop(shape, None)
+            self._compile_shape(shape)
+            return index
+
+        if self._engine == 'hash':
+            self._digestToIndexes.setdefault(_digest(self._possible_images[index]), []).append(index)
+        elif self._engine == 'tree':
+            self._add_to_tree(shape, index)
+        elif self._engine == 'packed':  # the bitmasks of every probe change, compile the table again
+            self._compile_shape(shape)
+        elif was_compiled and not self._tolerance:
+            self._add_to_procedures(shape, index)
+        else:
+            self._compile_shape(shape)
+
+        return index
+
+    def remove_image(self, index: int):
+        """
+        stop telling the image of <index>. Only the analysis of images of the same shape is touched.
+
+        Indexes are stable: other images keep their indexes and <index> is never given to another image.
+        """
+        with self._compiling:
+            shape = tuple(self._possible_images[index].shape[:2])
+            self._remove_image(index)
+            if self._watchTrees:
+                self._compile_watch_trees([shape])
+
+    def _remove_image(self, index: int):
+        img = self._possible_images[index]
+        assert img is not None, "image %d was already removed" % index
+
+        shape = tuple(img.shape[:2])
+        self._store.remove(index)
+        self._indexToOpaque = dict()
+        self._shapeToRanking = dict()
+        self._answerCounts.pop(index, None)
+        remaining = self._shapeToImgIndexes.get(shape, [])
+
+        if shape in self._pending:
+            if not remaining:
+                self._pending.discard(shape)
+        elif self._engine == 'hash':
+            key = _digest(img)
+            self._digestToIndexes[key].remove(index)
+            if not self._digestToIndexes[key]:
+                del self._digestToIndexes[key]
+        elif self._engine == 'tree':
+            if len(remaining) > 1 and shape in self._store.mask_stacks:  # in more than one place of the tree
+                self._compile_shape(shape)
+            else:
+                self._remove_from_tree(shape, img)
+        elif self._engine == 'packed':
+            if remaining:
+                self._compile_shape(shape)
+            else:
+                del self._shapeToTable[shape]
+        elif len(remaining) > 1:
+            procedures = dict(self._shapeToProcedures[shape])
+            del procedures[index]
+            for procedures_for_progress in procedures.values():
+                for procedure in procedures_for_progress:
+                    procedure[3].discard(index)
+                    procedure[4].discard(index)
+                    procedure[5].discard(index)
+            self._shapeToProcedures[shape] = procedures
+        elif remaining:
+            self._shapeToProcedures[shape] = []
+        else:
+            del self._shapeToProcedures[shape]
+
+    def _add_to_procedures(self, shape: Tuple[int, int], new_index: int):
+        stack = self._store.stacks[shape]
+        pixels = stack.reshape(len(stack), -1, stack.shape[-1])
+        packed = _pack_pixels(pixels)
+
+        indexes = np.array(self._shapeToImgIndexes[shape])
+        new = len(indexes) - 1  # appended last
+        new_img = self._possible_images[new_index]
+
+        procedures = dict(self._shapeToProcedures[shape])  # decodes stored procedures
+
+        for this, index in enumerate(indexes[:-1].tolist()):
+            still_possible = True
+
+            for procedure in procedures[index]:
+                color = new_img[procedure[0]]
+                if np.array_equal(color, procedure[1]):
+                    if still_possible:
+                        procedure[3].add(new_index)
+                elif np.array_equal(color, procedure[2]):
+                    procedure[4].add(new_index)
+                    still_possible = False
+                else:
+                    procedure[5].add(new_index)
+                    still_possible = False
+
+            if still_possible:  # the existing procedures can't tell <index> from the new image
+                procedures[index] = procedures[index] + self._stacked_procedures_of(
+                    this, np.array([this, new]), indexes, pixels, packed, shape[1])
+
+        procedures[new_index] = self._stacked_procedures_of(new, np.arange(len(indexes)), indexes, pixels, packed,
+                                                            shape[1])
+        self._shapeToProcedures[shape] = procedures
+
+    def _compile_watch_trees(self, shapes: List[Tuple[int, int]]):
+        """
+        build the decision trees of <shapes> for the 'hash' engine, which has no probes. Its trees aren't used to tell,
+        stream watches the pixels of their paths, which tell a frame from every other image of its shape. Shapes with
+        pixels of more than 8 bytes get none.
+        """
+        for shape in shapes:
+            stack = self._store.stacks.get(shape)
+            if stack is None or stack.shape[3] * stack.itemsize > 8:
+                self._shapeToTree.pop(shape, None)
+            else:
+                self._shapeToTree[shape] = self._produce_tree_of_shape(shape)
+
+    def _add_to_tree(self, shape: Tuple[int, int], new_index: int):
+        tree = self._shapeToTree.get(shape)
+        if type(tree) is not tuple:  # no other image or only one other image of this shape
+            self._compile_shape(shape)
+            return
+
+        new_img = self._possible_images[new_index]
+        node = tree
+        while True:
+            color = new_img[node[0]].tobytes()
+            child = node[1].get(color)
+
+            if child is None:
+                node[1][color] = new_index
+                return
+            if type(child) is tuple:
+                node = child
+                continue
+
+            other_img = self._possible_images[child]
+            differing = np.flatnonzero(np.any(
+                new_img.reshape(-1, new_img.shape[-1]) != other_img.reshape(-1, other_img.shape[-1]), axis=-1))
+
+            assert len(differing) > 0, "Got identical images"
+
+            rc = divmod(int(differing[0]), shape[1])
+            node[1][color] = (rc, {other_img[rc].tobytes(): child, new_img[rc].tobytes(): new_index})
+            return
+
+    def _remove_from_tree(self, shape: Tuple[int, int], img: np.ndarray):
+        remaining = self._shapeToImgIndexes.get(shape, [])
+
+        if len(remaining) <= 1:
+            if remaining:
+                self._shapeToTree[shape] = remaining[0]
+            else:
+                del self._shapeToTree[shape]
+            return
+
+        node = self._shapeToTree[shape]
+        while True:
+            color = img[node[0]].tobytes()
+            child = node[1][color]
+            if type(child) is not tuple:
+                del node[1][color]
+                return
+            node = child
+
+    def save(self, path: str, labels: Optional[List[str]] = None):
+        """
+        save everything this teller has analyzed to a file that ImageTeller.load can memory map
+
+        :param path: where to write the file, it will be overwritten
+        :param labels: if given, a name for every index, e.g. the file names of the possible images. A loaded teller
+            has them as its labels attribute
+        """
+        assert labels is None or len(labels) == len(self._possible_images), "give one label per index"
+        self.compile_all()
+
+        writer = _IndexWriter(path)
+        buckets = []
+        leaves = dict()
+
+        for number, (shape, indexes) in enumerate(self._shapeToImgIndexes.items()):
+            buckets.append([list(shape), indexes])
+            writer.add('%d/stack' % number, self._store.stacks[shape])
+            if shape in self._store.mask_stacks:
+                writer.add('%d/mask' % number, self._store.mask_stacks[shape])
+            self._save_shape(writer, number, shape, leaves)
+
+        digests = self._digest_rows()
+        if digests:
+            writer.add('digests', np.array(digests, dtype=np.int64).reshape(-1, 2))
+
+        writer.close(self._meta(len(self._possible_images), template_checksum(self._possible_images), buckets,
+                                leaves, labels))
+
+    def _save_shape(self, writer: _IndexWriter, number: int, shape: Tuple[int, int], leaves: Dict[int, int]):
+        """
+        write what this teller analyzed of <shape>, the <number>th bucket of the file. A tree that's just the index of
+        one image goes to <leaves> instead, it's saved in the footer.
+        """
+        prefix = '%d/' % number
+        indexes = self._shapeToImgIndexes[shape]
+
+        procedures = self._shapeToProcedures.get(shape)
+        if procedures:
+            for name, array in _flatten_procedures(procedures, list(procedures)).items():
+                writer.add(prefix + 'procedures/' + name, array)
+
+        table = self._shapeToTable.get(shape)
+        if table is not None:
+            for name, array in table.arrays().items():
+                writer.add(prefix + 'table/' + name, array)
+
+        tree = self._shapeToTree.get(shape)
+        if type(tree) is tuple:
+            for name, array in _flatten_tree(tree).items():
+                writer.add(prefix + 'tree/' + name, array)
+        elif tree is not None:
+            leaves[number] = tree
+
+    def _digest_rows(self) -> List[Tuple[int, int]]:
+        """
+        :return: (index, crc) of every digest of the hash engine
+        """
+        return [(index, crc) for (_, _, crc), indexes in self._digestToIndexes.items() for index in indexes]
+
+    def _meta(self, count: int, checksum: str, buckets: List[list], leaves: Dict[int, int],
+              labels: Optional[List[str]]) -> dict:
+        """
+        the footer of a saved teller, see load
+        """
+        return {'surprises': self._surprises,
+                'engine': self._engine,
+                'tolerance': self._tolerance,
+                'verify_samples': self._verifySamples,
+                'count': count,
+                'checksum': checksum,
+                'buckets': buckets,
+                'leaves': leaves,
+                'labels': labels,
+                'extra': self._extraMeta,
+                'weights': self._weights(),
+                'adapt_every': self._adaptEvery}
+
+    def _weights(self) -> Optional[List[float]]:
+        """
+        :return: the weights of the teller plus the answers counted since, None if all images weigh the same
+        """
+        weights = [prior + self._answerCounts.get(index, 0) for index, prior in enumerate(self._priors)]
+        return None if len(set(weights)) <= 1 else weights
+
+    @classmethod
+    def load(cls, path: str, possible_images: Optional[List[np.ndarray]] = None,
+             checksum: Optional[str] = None, stats: bool = False,
+             on_tell: Optional[Callable[[dict], None]] = None) -> 'ImageTeller':
+        """
+        open a teller saved by ImageTeller.save. The file is memory mapped, nothing is analyzed again, and procedures
+        are only decoded when a tell needs them. So even big tellers open in milliseconds.
+
+        :param possible_images: if given, the file is rejected unless it was saved from exactly these images
+        :param checksum: if given, the file is rejected unless its images have this template_checksum
+        :param stats: see ImageTeller
+        :param on_tell: see ImageTeller
+        """
+        meta, arrays = _read_index(path)
+
+        if possible_images is not None:
+            checksum = template_checksum(possible_images)
+        if checksum is not None and checksum != meta['checksum']:
+            raise ValueError("%s was saved from different possible images" % path)
+
+        teller = cls.__new__(cls)
+        teller.labels = meta.get('labels')
+        teller._extraMeta = meta.get('extra', dict())
+        teller._surprises = meta['surprises']
+        teller._engine = meta['engine']
+        teller._tolerance = meta['tolerance']
+        teller._verifySamples = meta.get('verify_samples', 0)
+        teller._shapeToStrips = dict()
+        teller._random = np.random.RandomState()
+        teller._stats = _Stats(on_tell) if stats or on_tell is not None else None
+        teller._store = TemplateStore._from_index(meta, arrays)
+        teller._possible_images = teller._store.images
+        teller._masks = teller._store.masks
+        teller._indexToOpaque = dict()
+        teller._shapeToRanking = dict()
+        teller._shapeToImgIndexes = teller._store.shape_to_indexes
+        teller._shapeToProcedures = dict()
+        teller._shapeToTree = dict()
+        teller._watchTrees = False
+        teller._digestToIndexes = dict()
+        teller._shapeToTable = dict()
+        teller._compilation = 'eager'  # nothing is analyzed again
+        teller._compiling = threading.Lock()
+        teller._pending = set()
+        teller._priors = meta.get('weights') or [1.0] * meta['count']
+        teller._answerCounts = collections.Counter()
+        teller._adaptEvery = meta.get('adapt_every', 0)
+        teller._answersToAdapt = teller._adaptEvery
+        teller._adapting = False
+        teller._shapeToOrder = dict()
+
+        for number, (shape, indexes) in enumerate(teller._shapeToImgIndexes.items()):
+            prefix = '%d/' % number
+
+            if prefix + 'procedures/starts' in arrays:
+                teller._shapeToProcedures[shape] = _StoredProcedures(indexes, {
+                    name[len(prefix + 'procedures/'):]: array for name, array in arrays.items() if
+                    name.startswith(prefix + 'procedures/')})
+            elif teller._engine == 'procedures':
+                teller._shapeToProcedures[shape] = []
+
+            if prefix + 'table/starts' in arrays:
+                teller._shapeToTable[shape] = _ProbeTable.of_arrays(indexes, {
+                    name[len(prefix + 'table/'):]: array for name, array in arrays.items() if
+                    name.startswith(prefix + 'table/')})
+
+            if prefix + 'tree/rc' in arrays:
+                teller._shapeToTree[shape] = _unflatten_tree({
+                    name[len(prefix + 'tree/'):]: array for name, array in arrays.items() if
+                    name.startswith(prefix + 'tree/')})
+            elif str(number) in meta['leaves']:
+                teller._shapeToTree[shape] = meta['leaves'][str(number)]
+
+        for shape in teller._shapeToImgIndexes:
+            teller._shapeToOrder[shape] = teller._order_of(shape)[0]
+
+        if 'digests' in arrays:
+            for index, crc in arrays['digests'].tolist():
+                img = teller._possible_images[index]
+                teller._digestToIndexes.setdefault((img.shape, img.dtype.str, crc), []).append(index)
+
+        return teller
+
+    def _confirm(self, img: np.ndarray, index: int, trace: Optional[List[Tuple[int, int]]] = None) -> int:
+        """
+        the last step of every tell. Returns <index> if <img> is the image of <index> or if this teller expects no
+        surprises, -1 otherwise
+
+        :param trace: if given and <img> isn't the image of <index>, a pixel where they differ is appended to it
+        """
+        possible_image = self._possible_images[index]
+        if not self._surprises:
+            return index
+
+        mask = self._masks[index]
+        if self._verifySamples:
+            matches, pixels = self._matches_samples, self._samples_of(tuple(possible_image.shape[:2]), mask)
+        else:
+            matches, pixels = self._matches, self._opaque_of(index)
+        if self._stats is None:
+            matched = matches(img, possible_image, pixels)
+        else:
+            start = time.perf_counter()
+            matched = matches(img, possible_image, pixels)
+            self._stats.verified(trace, time.perf_counter() - start)
+        if matched:
+            return index
+
+        if trace is not None and img.shape == possible_image.shape:
+            if self._verifySamples:
+                rows, columns = pixels  # where it didn't match
+                first = np.argmax(~_close(img[rows, columns], possible_image[rows, columns], self._tolerance))
+                trace.append((int(rows[first]), int(columns[first])))
+            else:
+                differing = ~_close(img, possible_image, self._tolerance)
+                differing = np.argwhere(differing if mask is None else differing & mask)
+                trace.append(tuple(differing[0].tolist()))
+        return -1
+
+    def _confirm_any(self, img: np.ndarray, indexes: List[int], trace: Optional[List[Tuple[int, int]]] = None) -> int:
+        """
+        _confirm the images of <indexes> one by one, for images that probing can't tell apart
+
+        :return: the first of them that <img> is, -1 if none
+        """
+        for index in indexes:
+            if self._confirm(img, index, trace) != -1:
+                return index
+        return -1
+
+    def _matches(self, img: np.ndarray, possible_image: np.ndarray,
+                 opaque: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> bool:
+        """
+        :param opaque: if given, only the pixels of the mask of <possible_image> are compared, see _opaque_of
+        :return: whether <img> is <possible_image>, within the tolerance of this teller
+        """
+        if opaque is not None:
+            if img.shape != possible_image.shape:
+                return False
+            flat, possible_image = opaque
+            img = np.ascontiguousarray(img).reshape(-1, img.shape[2]).take(flat, axis=0)
+        if self._tolerance:
+            return img.shape == possible_image.shape and bool(_close(img, possible_image, self._tolerance).all())
+        return np.array_equal(img, possible_image)
+
+    def _opaque_of(self, index: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :return: the flat pixels of the mask of the image of <index> and its colors there, None if it has no mask.
+            Taking them by flat pixel is several times faster than by the mask itself
+        """
+        if self._masks[index] is None:
+            return None
+        if index not in self._indexToOpaque:
+            flat = np.flatnonzero(self._masks[index])
+            img = self._possible_images[index]
+            self._indexToOpaque[index] = flat, img.reshape(-1, img.shape[2]).take(flat, axis=0)
+        return self._indexToOpaque[index]
+
+    def _matches_samples(self, img: np.ndarray, possible_image: np.ndarray,
+                         samples: Tuple[np.ndarray, np.ndarray]) -> bool:
+        """
+        :param samples: rows and columns of the pixels to compare, see _samples_of
+        :return: whether <img> is <possible_image> at <samples>
+        """
+        if img.shape != possible_image.shape:
+            return False
+
+        rows, columns = samples
+        if self._tolerance:
+            return bool(_close(img[rows, columns], possible_image[rows, columns], self._tolerance).all())
+        return np.array_equal(img[rows, columns], possible_image[rows, columns])
+
+    def _samples_of(self, shape: Tuple[int, int],
+                    mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param mask: if given, only the samples in it are returned
+        :return: rows and columns of the pixels an image of <shape> is verified at, one random pixel of every one of
+            verify_samples strips of the flattened image. They're drawn again on every call, so what an image passes
+            with doesn't depend on which pixels were drawn for the ones before
+        """
+        if shape not in self._shapeToStrips:
+            size = shape[0] * shape[1]
+            self._shapeToStrips[shape] = np.linspace(0, size, min(self._verifySamples, size) + 1).astype(np.int64)
+
+        bounds = self._shapeToStrips[shape]
+        widths = bounds[1:] - bounds[:-1]
+        flat = bounds[:-1] + (self._random.random_sample(len(widths)) * widths).astype(np.int64)
+        rows, columns = np.divmod(flat, shape[1])
+        if mask is None:
+            return rows, columns
+        kept = mask[rows, columns]
+        return rows[kept], columns[kept]
+
+    def _within_tolerance(self, color: np.ndarray, other_color: np.ndarray) -> bool:
+        return bool(np.all(_absdiff(color, other_color) <= self._tolerance))
+
+    def _compare_directly(self, img: np.ndarray, shape: Tuple[int, int]) -> int:
+        """
+        tell <img> by comparing it with every possible image of <shape> at once, for shapes that aren't analyzed yet
+        """
+        stack = self._store.stacks[shape]
+        indexes = self._shapeToImgIndexes[shape]
+
+        if img.shape != stack.shape[1:]:
+            return -1
+
+        if self._tolerance:
+            same = _close(stack, img, self._tolerance)
+        else:
+            same = np.all(stack == img, axis=-1)
+        mask_stack = self._store.mask_stacks.get(shape)
+        if mask_stack is not None:
+            same |= ~mask_stack
+        equal = same.reshape(len(stack), -1).all(axis=1)
+
+        rows = np.flatnonzero(equal)
+        return indexes[int(rows[0])] if len(rows) else -1
+
+    def _walk_tree(self, img: np.ndarray, shape: Tuple[int, int], trace: Optional[List[Tuple[int, int]]]) -> int:
+        node = self._shapeToTree[shape]
+
+        if trace is None:
+            while type(node) is tuple:
+                children = node[1]
+                node = children.get(img[node[0]].tobytes(), -1)
+                if node == -1:
+                    node = children.get(b'', -1)
+        else:
+            while type(node) is tuple:
+                trace.append(node[0])
+                children = node[1]
+                node = children.get(img[node[0]].tobytes(), -1)
+                if node == -1:
+                    node = children.get(b'', -1)
+
+        if self._stats is not None:
+            self._stats.branch('none' if node == -1 else 'leaf')
+
+        if node == -1:
+            return -1
+        if type(node) is list:
+            return self._confirm_any(img, node, trace)
+        return self._confirm(img, node, trace)
+
+    def _walk_digests(self, img: np.ndarray) -> int:
+        candidates = self._digestToIndexes.get(_digest(img))
+
+        if self._stats is not None:
+            self._stats.branch('none' if candidates is None else 'digest' if len(candidates) == 1 else 'collision')
+
+        if candidates is None:
             return -1
 
+        if len(candidates) == 1:
+            return self._confirm(img, candidates[0])
+
+        for index in candidates:  # a collision, the digest alone can't tell
+            if np.array_equal(img, self._possible_images[index]):
+                return index
+        return -1
+
+    def _walk_procedures(self, img: np.ndarray, shape: Tuple[int, int],
+                         trace: Optional[List[Tuple[int, int]]]) -> int:
         procedures_for_all_images = self._shapeToProcedures[shape]
 
         possibilities = self._shapeToImgIndexes[shape]
 
         if len(procedures_for_all_images) == 0:
             # assert len(possibilities) == 1, "Image Teller internal error"
+            if self._stats is not None:
+                self._stats.branch('single')
 
-            the_index = possibilities[0]
-
-            if self._surprises:
-                if np.array_equal(img, self._possible_images[the_index]):
-                    return the_index
-                else:
-                    return -1
-            else:
-                return the_index
+            return self._confirm(img, possibilities[0], trace)
 
 
         total_possibilities = set(possibilities)
+        equal = self._within_tolerance if self._tolerance else np.array_equal
 
-        while total_possibilities:
-            index = total_possibilities.pop()
+        for index in procedures_for_all_images:  # the most frequent images first, see adapt
+            if index not in total_possibilities:
+                continue
+            total_possibilities.discard(index)
             # print(procedures_for_all_images)
             procedures = procedures_for_all_images[index]
 
             for procedure in procedures:
+                if trace is not None:
+                    trace.append(procedure[0])
                 color = img[procedure[0]]
-                if np.array_equal(color, procedure[1]):
+                if equal(color, procedure[1]):
                     is_possible, possibilities = True, procedure[3]
-                elif np.array_equal(color, procedure[2]):
+                elif equal(color, procedure[2]):
                     is_possible, possibilities = False, procedure[4]
                 else:
                     is_possible, possibilities = False, procedure[5]
@@ -137,133 +1849,480 @@ class ImageTeller:
                 length = len(total_possibilities)
                 if is_possible:
                     if length == 0:
-                        if self._surprises:
-                            if np.array_equal(img, self._possible_images[index]):
-                                return index
-                            else:
-                                return -1
-                        else:
-                            return index
+                        if self._stats is not None:
+                            self._stats.branch('this')
+                        return self._confirm(img, index, trace)
 
                 else:
                     if length == 1:
-                        surprise = total_possibilities.pop()
-
-                        if self._surprises:
-                            if np.array_equal(img, self._possible_images[surprise]):
-                                return surprise
-                            else:
-                                return -1
-                        else:
-                            return surprise
+                        if self._stats is not None:
+                            self._stats.branch('last')
+                        return self._confirm(img, total_possibilities.pop(), trace)
 
                     elif length == 0:
+                        if self._stats is not None:
+                            self._stats.branch('none')
                         return -1
                     else:
                         break
+            else:  # masks keep the rest of them from being told apart from <index> by probing, compare
+                if self._confirm(img, index, trace) != -1:
+                    if self._stats is not None:
+                        self._stats.branch('this')
+                    return index
 
-    def _produce_procedures_of_shape(self, shape):
-        procedures = dict()
+        if self._stats is not None:
+            self._stats.branch('none')
+        return -1
 
-        indexes = self._shapeToImgIndexes[shape]
+    def _walk_table(self, img: np.ndarray, shape: Tuple[int, int], trace: Optional[List[Tuple[int, int]]]) -> int:
+        """
+        _walk_procedures on the flat probe table of <shape>
+        """
+        table = self._shapeToTable[shape]
+        indexes = table.indexes
+
+        if len(indexes) == 1:
+            if self._stats is not None:
+                self._stats.branch('single')
+            return self._confirm(img, indexes[0], trace)
+
+        channels = img.shape[2] if img.ndim == 3 else 1
+        if img.itemsize != table.itemsize or img.itemsize * channels != table.pixel_bytes:
+            return -1  # can't be any of the images of this shape
+
+        data, offset, row_stride, column_stride = _bytes_of(img)
+        if img.ndim == 3 and img.strides[2] == 0:  # gray broadcast to all channels, read one and spread it
+            pixel_bytes, spread = img.itemsize, table.gray_to_color
+        else:
+            pixel_bytes, spread = table.pixel_bytes, 1
+
+        starts, rows, columns, this, that = table.starts, table.rows, table.columns, table.this, table.that
+        this_masks, that_masks, neither_masks = table.this_masks, table.that_masks, table.neither_masks
+
+        remaining = (1 << len(indexes)) - 1
+        while remaining:
+            row = remaining.bit_length() - 1
+            remaining ^= 1 << row
+
+            for probe in range(starts[row], starts[row + 1]):
+                if trace is not None:
+                    trace.append(table.rc(probe))
+                at = offset + rows[probe] * row_stride + columns[probe] * column_stride
+                color = int.from_bytes(data[at:at + pixel_bytes], 'little') * spread
+
+                if color == this[probe]:
+                    remaining &= this_masks[probe]
+                    if remaining == 0:
+                        if self._stats is not None:
+                            self._stats.branch('this')
+                        return self._confirm(img, indexes[row], trace)
+                    continue
+
+                remaining &= that_masks[probe] if color == that[probe] else neither_masks[probe]
+                if remaining == 0:
+                    if self._stats is not None:
+                        self._stats.branch('none')
+                    return -1
+                if remaining & (remaining - 1) == 0:  # one bit left
+                    if self._stats is not None:
+                        self._stats.branch('last')
+                    return self._confirm(img, indexes[remaining.bit_length() - 1], trace)
+                break
+            else:  # see _walk_procedures
+                if self._confirm(img, indexes[row], trace) != -1:
+                    if self._stats is not None:
+                        self._stats.branch('this')
+                    return indexes[row]
+
+        if self._stats is not None:
+            self._stats.branch('none')
+        return -1
+
+    def _opaque_pixels_of(self, shape: Tuple[int, int]) -> Optional[np.ndarray]:
+        """
+        :return: for every image of <shape> and every pixel of the flattened image, whether it's in the mask of the
+            image. None if none of them has a mask.
 
-        progress = 0
+        An image can't be told apart from others at a pixel outside of its mask: it's left among the candidates of
+        every color probed there.
+        """
+        mask_stack = self._store.mask_stacks.get(shape)
+        return None if mask_stack is None else mask_stack.reshape(len(mask_stack), -1)
 
-        if len(indexes) == 1:  # There's only one image in a particular shape
+    def _produce_procedures_of_shape(self, shape, weights: Optional[np.ndarray] = None):
+        if len(self._shapeToImgIndexes[shape]) == 1:  # There's only one image in a particular shape
             return []
 
-        while progress < len(indexes):
+        stack = self._store.stacks[shape]
+        pixels = stack.reshape(len(stack), -1, stack.shape[-1])
 
-            procedures_for_progress = []
+        if self._tolerance:
+            # colors in the same bin of 2 * tolerance + 1 are roughly the ones too close to tell apart
+            packed = _pack_pixels(pixels // (2 * self._tolerance + 1))
+        else:
+            packed = _pack_pixels(pixels)
 
-            this_index = indexes[progress]
+        return self._produce_procedures_of_shape_stacked(shape, pixels, packed, weights)
 
-            this_possibilities = indexes.copy()
+    def _produce_procedures_of_shape_stacked(self, shape: Tuple[int, int], pixels: np.ndarray,
+                                             packed: Optional[np.ndarray], weights: Optional[np.ndarray] = None) -> Dict[int, List[Procedure]]:
+        """
+        produce the procedures of every image of <shape> from color statistics of every pixel of all images at once,
+        instead of comparing images pair by pair.
 
-            while True:  # generate procedures that's enough to determine a certain pic
+        Every procedure probes the pixel where the fewest remaining images share the color of the examined image.
 
-                diff_r, diff_c, this_color, that_color = self._get_diff_rc_color(this_index, this_possibilities)
+        :param pixels: (images, pixels, channels) stack of the images of <shape>
+        :param packed: (images, pixels) packed colors of <pixels>, None if pixels are too big to pack. Colors are then
+            compared channel by channel
+        :param weights: if given, the weight of every image of the stack. Then every procedure probes the pixel where
+            the remaining images that share the color of the examined image weigh the least
+        """
+        indexes = np.array(self._shapeToImgIndexes[shape])
+        opaque = self._opaque_pixels_of(shape)
 
-                that_possibilities = []
-                neither_possibilities = []
+        first_shared = None
+        if packed is not None:  # the first probe of every image considers all images
+            first_shared = _color_group_sizes(packed, weights=weights)
+        if first_shared is not None and opaque is not None:  # a guess, transparent images are counted by the color they happen to have too
+            first_shared = first_shared + ((~opaque).sum(axis=0) if weights is None else weights @ ~opaque)
 
-                for index in indexes:
-                    color = self._possible_images[index][diff_r][diff_c]
-                    if not np.array_equal(color, this_color):
-                        if index in this_possibilities:
-                            this_possibilities.remove(index)
-                        if np.array_equal(color, that_color):
-                            that_possibilities.append(index)
-                        else:
-                            neither_possibilities.append(index)
+        procedures = dict()
+        taken = 0
+
+        for this in range(len(indexes)):
+            procedures[int(indexes[this])] = self._stacked_procedures_of(this, np.arange(len(indexes)), indexes,
+                                                                         pixels, packed, shape[1],
+                                                                         None if first_shared is None else
+                                                                         first_shared[this],
+                                                                         self._tolerance, weights, opaque)
+
+            if self._procedureBytesLimit is not None:
+                taken += sum(_PROCEDURE_BYTES + _SET_ENTRY_BYTES * (len(procedure[3]) + len(procedure[4]) +
+                                                                    len(procedure[5]))
+                             for procedure in procedures[int(indexes[this])])
+                if taken > self._procedureBytesLimit:
+                    raise MemoryError("the procedures of the %d images of %dx%d take more than the %d bytes left" %
+                                      (len(indexes), shape[1], shape[0], self._procedureBytesLimit))
 
-                procedures_for_progress.append(
-                    ((diff_r, diff_c), this_color, that_color, set(this_possibilities.copy()),
-                     set(that_possibilities.copy()),
-                     set(neither_possibilities.copy())))
+        return procedures
 
-                if len(this_possibilities) == 1:
-                    break
+    @staticmethod
+    def _stacked_procedures_of(this: int, this_possibilities: np.ndarray, indexes: np.ndarray, pixels: np.ndarray,
+                               packed: Optional[np.ndarray], width: int, shared: Optional[np.ndarray] = None,
+                               tolerance: int = 0, weights: Optional[np.ndarray] = None,
+                               opaque: Optional[np.ndarray] = None) -> List[Procedure]:
+        """
+        generate procedures that tell the image at row <this> of the stack apart from <this_possibilities>
+
+        :param this_possibilities: rows of the stack that the image isn't told apart from yet, including <this>
+        :param shared: for every pixel, how many of <this_possibilities> share the color of <this>, if already known.
+            With a tolerance it's only a guess from binned colors
+        :param tolerance: colors that differ by at most twice the tolerance can't be told apart
+        :param weights: if given, <shared> is how much the images that share the color weigh, see
+            _produce_procedures_of_shape_stacked
+        :param opaque: if given, the masks of the images of the stack, see _opaque_pixels_of. Only pixels of the mask
+            of <this> are probed. If they can't tell <this> from some of <this_possibilities>, the procedures end with
+            them left, and a tell compares with <this> before it goes on with them
+        """
+        procedures_for_progress = []
+        margin = 2 * tolerance
+
+        while True:  # generate procedures that's enough to determine a certain pic
+            guessed = shared is not None and (tolerance > 0 or opaque is not None)
+            if shared is None:
+                if tolerance or packed is None:
+                    same = _close(pixels[this_possibilities], pixels[this], margin)
+                else:
+                    same = packed[this_possibilities] == packed[this]
+                if opaque is not None:
+                    same |= ~opaque[this_possibilities]
+                shared = np.count_nonzero(same, axis=0) if weights is None else weights[this_possibilities] @ same
 
-            procedures[this_index] = procedures_for_progress
+            flat_pixel = int(np.argmin(shared if opaque is None else np.where(opaque[this], shared, np.inf)))
 
-            progress += 1
+            colors = pixels[:, flat_pixel]
+            is_this = _close(colors, colors[this], margin)
+            transparent = None if opaque is None else ~opaque[:, flat_pixel]
+            if transparent is not None:
+                is_this |= transparent
 
-        return procedures
+            if guessed and is_this[this_possibilities].all():
+                shared = None  # the binned colors or the transparent pixels were misleading, count for real
+                continue
 
-    def _get_diff_rc_color(self, examined_img_index: int, possibilities: List[int]) -> Tuple[
-        int, int, np.array, np.array]:
-        """
-        pick a random image from <possibilities> that is different than <examined_img>,
-        compare those two images and return a random coordinate where they have different colors. The color of <examed_img> at that coordinate.
+            if opaque is not None and is_this[this_possibilities].all():
+                # every pixel of the mask of <this> is transparent or the same in the rest of them
+                others = this_possibilities[this_possibilities != this]
+                assert not (opaque[others] == opaque[this]).all(axis=1).any(), \
+                    "Got identical images" if tolerance == 0 else "Got images that are identical within the tolerance"
+                return procedures_for_progress
 
-        :param examined_img_index: the index of the examined image in self._possible_images
-        :param possibilities: a list of indexes of the compared images
-        :return: row, col, color, color
-        """
-        that_index = -1
-        for possibility in possibilities:
-            if possibility != examined_img_index:
-                that_index = possibility
+            assert not is_this[this_possibilities].all(), "Got identical images" if tolerance == 0 else \
+                "Got images that are identical within the tolerance"
 
-        assert that_index != -1
-        this_img = self._possible_images[examined_img_index]
-        that_img = self._possible_images[that_index]
+            that = this_possibilities[~is_this[this_possibilities]][0]
+            is_that = _close(colors, colors[that], margin)
 
-        absolute_diff = cv2.absdiff(this_img, that_img)
-        mask = np.any(absolute_diff != [0, 0, 0], axis=-1)
-        nonzero_r_c = np.where(mask)
-        # if not np.any(nonzero_r_c):
-        #     cv2.imshow('this', this_img)
-        #     cv2.imshow('that', that_img)
-        #     cv2.waitKey()
-        #     cv2.destroyAllWindows()
+            this_possibilities = this_possibilities[is_this[this_possibilities]]
 
-        assert np.any(nonzero_r_c), "Got identical images"
+            # when an image has exactly this or that color, a pixel close to it is always close to this or that
+            is_neither = ~np.all(colors == colors[this], axis=-1) & ~np.all(colors == colors[that], axis=-1)
+            if transparent is not None:  # whatever color is probed, they're left
+                is_that |= transparent
+                is_neither |= transparent
 
-        diff_r, diff_c = nonzero_r_c[0][0], nonzero_r_c[1][0]
-        this_color = this_img[diff_r][diff_c]
-        that_color = that_img[diff_r][diff_c]
-        return diff_r, diff_c, this_color, that_color
+            procedures_for_progress.append(
+                (divmod(flat_pixel, width), colors[this].copy(), colors[that].copy(),
+                 set(indexes[this_possibilities].tolist()),
+                 set(indexes[is_that].tolist()),
+                 set(indexes[is_neither].tolist())))
 
+            if len(this_possibilities) == 1:
+                return procedures_for_progress
 
-def cmd():
-    parser = argparse.ArgumentParser(
-        description="blazing fast template matching when possible images are all known"
-    )
+            shared = None
 
-    # parser.add_argument(
-    #     "blah",
-    #     action="store",
-    #     type=str,
-    #     help="blah",
-    # )
+    def _produce_tree_of_shape(self, shape: Tuple[int, int], weights: Optional[np.ndarray] = None) -> TreeNode:
+        """
+        build a decision tree for the images of <shape>. Every node picks the pixel whose colors split the images that
+        reach the node most evenly, i.e. the pixel with the highest entropy, so the tree stays about log(n) deep.
 
-    argv = parser.parse_args()
+        With masks, an image that's transparent at the pixel of a node follows every child of the node, and the b''
+        child for colors that no opaque image has there. Images that no pixel can split any further, e.g. images with
+        disjoint masks, end up together in a list that a tell compares with one by one.
 
-    # add your command line program here
+        :param weights: if given, the weight of every image of the stack. The entropy is then weighted, so heavy images
+            end up near the root, like the codes of frequent symbols in a Huffman code are short
 
-    print("reserved command line entry for python package whichimg")
+        :return: the index of the image if there's only one image of <shape>, otherwise the root node
+        """
+        indexes = self._shapeToImgIndexes[shape]
+
+        if len(indexes) == 1:
+            return indexes[0]
+
+        width = shape[1]
+        stack = self._store.stacks[shape]
+        pixels = stack.reshape(len(stack), -1, stack.shape[-1])
+        packed = _pack_pixels(pixels)
+
+        assert packed is not None, "the tree engine supports pixels of at most 8 bytes"
+
+        masks = self._opaque_pixels_of(shape)
+        varying = np.flatnonzero(np.any(packed != packed[0], axis=0))  # pixels that can tell anything at all
+
+        assert len(varying) > 0 or masks is not None, "Got identical images"
+
+        packed = packed[:, varying]
+        opaque = None if masks is None else masks[:, varying]
+        # a color of its own for every image, so transparent pixels don't join the groups of opaque colors
+        apart = ~np.arange(len(indexes)).astype(packed.dtype)[:, None]
+        highest = np.iinfo(packed.dtype).max
+
+        def split(members: np.ndarray, columns: np.ndarray) -> Tuple[Union[TreeNode, List[int]], np.ndarray]:
+            """
+            :param columns: the pixels, of <varying>, where the images that reach the parent node vary
+            :return: the node, and the pixels where <members> vary, for the children to start from
+            """
+            colors = packed[np.ix_(members, columns)]
+            if opaque is None:
+                still = np.any(colors != colors[0], axis=0)
+            else:  # only pixels with two colors among the opaque images split them
+                visible = opaque[np.ix_(members, columns)]
+                still = np.where(visible, colors, highest).min(axis=0) < np.where(visible, colors, 0).max(axis=0)
+            columns, colors = columns[still], colors[:, still]
+
+            if not len(columns):
+                assert opaque is not None, "Got identical images"
+                assert len(np.unique(masks[members], axis=0)) == len(members), \
+                    "Got images that are identical where they're opaque and have the same mask"
+                return [indexes[member] for member in members], columns
+
+            if opaque is None:
+                if weights is None:
+                    scores = np.log2(_color_group_sizes(colors)).sum(axis=0)
+                else:
+                    scores = weights[members] @ np.log2(_color_group_sizes(colors, weights=weights[members]))
+            else:
+                visible = visible[:, still]
+                member_weights = np.ones(len(members)) if weights is None else weights[members]
+                # a transparent image is in the group of every color, and its own group is all images
+                sizes = _color_group_sizes(np.where(visible, colors, apart[members]),
+                                           weights=None if weights is None else member_weights)
+                sizes = np.where(visible, sizes + member_weights @ ~visible, member_weights.sum())
+                scores = member_weights @ np.log2(sizes)
+            best = int(np.argmin(scores))
+
+            colors = colors[:, best]
+            flat_pixel = int(varying[columns[best]])
+            visible = np.ones(len(members), dtype=bool) if opaque is None else visible[:, best]
+            transparent = members[~visible]
+            children = dict()
+            for color in np.unique(colors[visible]):
+                group = members[visible & (colors == color)]
+                children[pixels[group[0], flat_pixel].tobytes()] = np.union1d(group, transparent)
+            if len(transparent):
+                children[b''] = transparent
+
+            return (divmod(flat_pixel, width), children), columns
+
+        root, columns = split(np.arange(len(indexes)), np.arange(len(varying)))
+
+        pending = [(root, columns)] if type(root) is tuple else []
+        while pending:  # no recursion, a badly balanced tree can be as deep as there are images
+            (_, children), columns = pending.pop()
+            for color, group in children.items():
+                if len(group) == 1:
+                    children[color] = indexes[group[0]]
+                else:
+                    children[color], child_columns = split(group, columns)
+                    if type(children[color]) is tuple:
+                        pending.append((children[color], child_columns))
+
+        return root
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp', '.pbm', '.pgm', '.ppm')
+
+
+def _image_paths(paths: Iterable[str]) -> Iterator[str]:
+    """
+    :param paths: files, and directories that are searched recursively for images. '-' reads paths from stdin, one
+        per line
+    :return: the files in the given order, the images of a directory sorted by path
+    """
+    for given in paths:
+        if given == '-':
+            yield from _image_paths(line.rstrip('\n') for line in sys.stdin if line.strip())
+        elif os.path.isdir(given):
+            found = [os.path.join(root, name) for root, _, names in os.walk(given) for name in names if
+                     name.lower().endswith(IMAGE_EXTENSIONS)]
+            yield from sorted(found)
+        else:
+            yield given
+
+
+def _decoded(paths: Iterable[str], workers: int,
+             read: Callable[[str], Optional[np.ndarray]] = cv2.imread) -> Iterator[Tuple[str, Optional[np.ndarray]]]:
+    """
+    decode images in a thread pool, cv2.imread releases the GIL so decoding overlaps with whatever the consumer does.
+    Only a few images per worker are decoded ahead, so any number of paths can be streamed.
+
+    :param read: decodes one file, None if it can't
+    :return: (path, image) in the order of <paths>, the image is None if it can't be read
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for file in paths:
+            pending.append((file, executor.submit(read, file)))
+            if len(pending) >= 4 * workers:
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+
+def _compile(args):
+    from whichimg.builder import build_index
+
+    files = list(_image_paths(args.templates))
+    if not files:
+        sys.exit("whichimg: found no images in %s" % ', '.join(args.templates))
+
+    memory_limit = None if args.memory_limit is None else args.memory_limit << 20
+    try:
+        teller = build_index(files, args.index, engine=args.engine, surprises=not args.no_surprises,
+                             tolerance=args.tolerance, memory_limit=memory_limit,
+                             labels=[os.path.splitext(os.path.basename(file))[0] for file in files],
+                             workers=args.workers)
+    except (ValueError, MemoryError) as error:
+        sys.exit("whichimg: %s" % error)
+    print("compiled %d images of %d shapes into %s" % (len(files), len(teller._shapeToImgIndexes), args.index),
+          file=sys.stderr)
+
+
+def _classify(args):
+    try:
+        teller = ImageTeller.load(args.index)
+    except (OSError, ValueError) as error:  # missing, unreadable or not an index
+        sys.exit("whichimg: %s" % error)
+    labels = teller.labels or []
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    parallel = None
+
+    if args.processes > 1:
+        from whichimg.parallel import ParallelTeller
+
+        parallel = ParallelTeller(args.index, args.processes)
+        files, sent = itertools.tee(_image_paths(args.paths))  # the workers read the files
+        answers = zip(files, parallel.tell_files(sent))
+    else:
+        answers = ((file, None if img is None else teller.tell(img)) for file, img in
+                   _decoded(_image_paths(args.paths), args.workers))
+
+    try:
+        if args.format == 'csv':
+            writer = csv.writer(output)
+            writer.writerow(['path', 'index', 'label'])
+
+        for file, index in answers:
+            label = labels[index] if index is not None and 0 <= index < len(labels) else None
+
+            if args.format == 'csv':
+                writer.writerow([file, '' if index is None else index, '' if label is None else label])
+            else:
+                record = {'path': file, 'index': index, 'label': label}
+                if index is None:
+                    record['error'] = "can't read image"
+                output.write(json.dumps(record) + '\n')
+    finally:
+        if parallel is not None:
+            parallel.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def cmd(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="blazing fast template matching when possible images are all known"
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    compile_parser = subparsers.add_parser('compile', help="analyze template images and save the teller to an index")
+    compile_parser.add_argument('templates', nargs='+', help="template images, or directories of them")
+    compile_parser.add_argument('-o', '--index', required=True, help="where to save the index")
+    compile_parser.add_argument('--engine', choices=ENGINES, default='procedures')
+    compile_parser.add_argument('--tolerance', type=int, default=0)
+    compile_parser.add_argument('--no-surprises', action='store_true',
+                                help="only classify images that are templates, unknown images may be mistaken")
+    compile_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="decoding threads")
+    compile_parser.add_argument('--memory-limit', type=int, metavar='MB',
+                                help="fail instead of analyzing images of one size that need more memory than this. "
+                                     "Only the images of one size are in memory at a time either way")
+    compile_parser.set_defaults(run=_compile)
+
+    classify_parser = subparsers.add_parser(
+        'classify', help="tell which template every image is, one result line per image. Unknown images get -1, "
+                         "unreadable ones no index")
+    classify_parser.add_argument('index', help="an index saved by compile")
+    classify_parser.add_argument('paths', nargs='+', help="images, or directories of them. - reads paths from stdin")
+    classify_parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+    classify_parser.add_argument('-o', '--output', help="where to write the results, stdout by default")
+    classify_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="decoding threads")
+    classify_parser.add_argument('--processes', type=int, default=1,
+                                 help="if > 1, images are read and told in this many processes instead of threads")
+    classify_parser.set_defaults(run=_classify)
+
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    args.run(args)
 
 
 def main():
@@ -0,0 +1,123 @@
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+import tempfile
+from typing import List, Optional, Iterable, Iterator, Union
+
+import numpy as np
+from cv2 import cv2
+
+from whichimg.main import ImageTeller
+
+_worker_teller: Optional[ImageTeller] = None  # the teller of a worker process, loaded once by _attach
+
+
+def _attach(index_path: str):
+    global _worker_teller
+    _worker_teller = ImageTeller.load(index_path)
+
+
+def _tell_images(images: List[np.ndarray]) -> List[int]:
+    return [_worker_teller.tell(img) for img in images]
+
+
+def _tell_files(paths: List[str]) -> List[Optional[int]]:
+    answers = []
+    for path in paths:
+        img = cv2.imread(path)
+        answers.append(None if img is None else _worker_teller.tell(img))
+    return answers
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _in_order(pool: multiprocessing.pool.Pool, function, chunks: Iterator[list], ahead: int) -> Iterator:
+    """
+    like pool.imap, but at most <ahead> chunks are taken from <chunks> before their answers are consumed, so neither
+    the input nor the answers pile up in memory
+    """
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(function, (chunk,)))
+        if len(pending) >= ahead:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+class ParallelTeller:
+    """
+    tells images in a pool of processes. Workers don't get a pickled teller, every worker memory maps the same saved
+    teller instead, see ImageTeller.save. So the procedures, trees and template pixels are read from one copy in the
+    page cache that all workers share, and starting a worker costs about as much as ImageTeller.load.
+
+    Answers are always in the order of the input.
+
+        with ParallelTeller(teller) as parallel:
+            for path, index in zip(paths, parallel.tell_files(paths)):
+                ...
+    """
+
+    def __init__(self, teller: Union[ImageTeller, str], processes: Optional[int] = None):
+        """
+        :param teller: an ImageTeller, or the path of a saved one. A teller is saved to a temporary file that's deleted
+            by close
+        :param processes: how many worker processes, the number of cores by default
+        """
+        self._temporary = None
+        if isinstance(teller, ImageTeller):
+            descriptor, self._temporary = tempfile.mkstemp(suffix='.whichimg')
+            os.close(descriptor)
+            teller.save(self._temporary)
+            index_path = self._temporary
+        else:
+            index_path = teller
+
+        self._processes = processes or os.cpu_count() or 1
+        self._pool = multiprocessing.Pool(self._processes, initializer=_attach, initargs=(index_path,))
+
+    def tell_files(self, paths: Iterable[str], chunk: int = 64) -> Iterator[Optional[int]]:
+        """
+        read and tell image files in the workers, so decoding is spread across cores too. Paths are consumed lazily,
+        any number of them can be streamed.
+
+        :param chunk: how many files a worker takes at once
+        :return: the index of every file, -1 for unknown images and None for files that can't be read
+        """
+        return _in_order(self._pool, _tell_files, _chunks(paths, chunk), 2 * self._processes)
+
+    def tell_many(self, images: Iterable[np.ndarray], chunk: int = 64) -> np.ndarray:
+        """
+        tell images that are already decoded. They have to be pickled to the workers, so this only pays off when
+        telling takes much longer than copying an image, e.g. with many surprises to verify.
+
+        :param chunk: how many images a worker takes at once
+        :return: an int array with the index of every image, -1 for unknown images
+        """
+        return np.fromiter(_in_order(self._pool, _tell_images, _chunks(images, chunk), 2 * self._processes),
+                           dtype=int)
+
+    def close(self):
+        """
+        stop the workers and delete the temporary copy of the teller, if any
+        """
+        self._pool.close()
+        self._pool.join()
+        if self._temporary is not None:
+            os.remove(self._temporary)
+            self._temporary = None
+
+    def __enter__(self) -> 'ParallelTeller':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
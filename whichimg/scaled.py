@@ -0,0 +1,154 @@
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from cv2 import cv2
+
+from whichimg.main import ImageTeller
+from whichimg.store import _image_checksum
+
+Variant = Tuple[int, float]  # template index, scale
+
+
+def _scaled(img: np.ndarray, scale: float, interpolation: int) -> np.ndarray:
+    """
+    :return: <img> resized by <scale>, the sides rounded to whole pixels. <img> itself at scale 1
+    """
+    if scale == 1:
+        return img
+    height, width = img.shape[:2]
+    size = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+    resized = cv2.resize(img, size, interpolation=interpolation)
+    return resized if resized.ndim == img.ndim else resized[..., None]  # cv2 drops a single channel axis
+
+
+class MultiScaleTeller:
+    """
+    tells images that were captured at any of a few display scalings, e.g. 100%, 125%, 150% and 200%. Every template is
+    resized to every scale once, when the teller is made, and all variants are possible images of one ImageTeller. So
+    the variants of the same size share a bucket and a tell is dispatched on the shape of the captured image, nothing
+    is resized at query time.
+
+        teller = MultiScaleTeller(templates, scales=(1, 1.25, 1.5, 2))
+        index, scale = teller.tell(capture)  # -1, None for unknown images
+
+    Variants that come out pixel for pixel the same as an earlier variant, e.g. of a plain colored template, are told as
+    the earlier one.
+    """
+
+    def __init__(self, possible_images: List[np.ndarray], scales: Sequence[float] = (1, 1.25, 1.5, 2),
+                 interpolation: int = cv2.INTER_LINEAR, weights: Optional[Sequence[float]] = None,
+                 masks: Union[None, str, List[Optional[np.ndarray]]] = None, **options):
+        """
+        :param possible_images: the templates at scale 1
+        :param scales: every template is resized by all of them
+        :param interpolation: how templates are resized, a cv2.INTER_* flag. It should be the one the captures are
+            scaled with, or the closest to how the scaled displays render
+        :param weights: see ImageTeller, one per template
+        :param masks: see ImageTeller, one per template. Masks are resized with cv2.INTER_NEAREST, alpha channels are
+            resized with the image and only pixels that stay fully opaque count
+        :param options: other arguments of ImageTeller, e.g. engine
+        """
+        assert len(scales) >= 1 and min(scales) > 0, "Please provide positive scales"
+        assert weights is None or len(weights) == len(possible_images), "give one weight per image"
+        assert masks is None or isinstance(masks, str) or len(masks) == len(possible_images), \
+            "give one mask per image"
+
+        self.scales = tuple(float(scale) for scale in scales)
+        self.variants: List[Variant] = []  # the template and scale of every image of the inner teller
+        variant_images = []
+        variant_masks = []
+        seen = set()
+
+        for index, img in enumerate(possible_images):
+            mask = masks[index] if isinstance(masks, list) else None
+            for scale in self.scales:
+                variant = _scaled(img, scale, interpolation)
+                variant_mask = None if mask is None else _scaled(mask.astype(np.uint8), scale,
+                                                                 cv2.INTER_NEAREST).astype(bool)
+                key = _image_checksum(variant) + (b'' if variant_mask is None else _image_checksum(variant_mask))
+                if key in seen:
+                    continue
+                seen.add(key)
+                self.variants.append((index, scale))
+                variant_images.append(variant)
+                variant_masks.append(variant_mask)
+
+        self.teller = ImageTeller(
+            variant_images, weights=None if weights is None else [weights[index] for index, _ in self.variants],
+            masks=variant_masks if isinstance(masks, list) else masks, **options)
+        self.teller._extraMeta = {'variants': self.variants, 'scales': self.scales, 'count': len(possible_images)}
+        self._count = len(possible_images)
+
+    def tell(self, img: np.ndarray, certain: bool = False) -> Tuple[int, Optional[float]]:
+        """
+        :param certain: see ImageTeller.tell
+        :return: the index of the template and the scale it was captured at, -1 and None if it's none of them
+        """
+        variant = self.teller.tell(img, certain)
+        return (-1, None) if variant == -1 else self.variants[variant]
+
+    def tell_many(self, images: Union[np.ndarray, List[np.ndarray]], chunk: int = 256,
+                  certain: bool = False) -> List[Tuple[int, Optional[float]]]:
+        """
+        see ImageTeller.tell_many
+
+        :return: the template index and scale of every image, -1 and None for unknown images
+        """
+        return [(-1, None) if variant == -1 else self.variants[variant] for variant in
+                self.teller.tell_many(images, chunk, certain).tolist()]
+
+    def closest(self, img: np.ndarray, count: int = 3, candidates: int = 8) -> List[Tuple[int, float, float]]:
+        """
+        see ImageTeller.closest, only templates at the scale that gives them the shape of <img> are compared
+
+        :return: (template index, scale, distance) of up to <count> variants, the closest first
+        """
+        return [self.variants[variant] + (distance,) for variant, distance in
+                self.teller.closest(img, count, candidates)]
+
+    def locate(self, frame: np.ndarray, probes: int = 8) -> List[Tuple[int, float, int, int]]:
+        """
+        see ImageTeller.locate
+
+        :return: (template index, scale, x, y) of every hit
+        """
+        return [self.variants[variant] + (x, y) for variant, x, y in self.teller.locate(frame, probes)]
+
+    def save(self, path: str, labels: Optional[List[str]] = None):
+        """
+        see ImageTeller.save
+
+        :param labels: if given, a name for every template
+        """
+        assert labels is None or len(labels) == self._count, "give one label per template"
+        self.teller.save(path, None if labels is None else [labels[index] for index, _ in self.variants])
+
+    @classmethod
+    def load(cls, path: str, **options) -> 'MultiScaleTeller':
+        """
+        open a teller saved by MultiScaleTeller.save
+
+        :param options: see ImageTeller.load
+        """
+        teller = ImageTeller.load(path, **options)
+        if 'variants' not in teller._extraMeta:
+            raise ValueError("%s is not a saved MultiScaleTeller" % path)
+
+        multi_scale = cls.__new__(cls)
+        multi_scale.teller = teller
+        multi_scale.scales = tuple(teller._extraMeta['scales'])
+        multi_scale.variants = [(index, scale) for index, scale in teller._extraMeta['variants']]
+        multi_scale._count = teller._extraMeta['count']
+        return multi_scale
+
+    @property
+    def labels(self) -> Optional[List[str]]:
+        """
+        the names of the templates, only loaded tellers have them, see save
+        """
+        if self.teller.labels is None:
+            return None
+        labels = [None] * self._count
+        for (index, _), label in zip(self.variants, self.teller.labels):
+            labels[index] = label
+        return labels
@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+from typing import List, Dict, Tuple, Optional, Iterable
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+_MAGIC = b'WHICHIMG'
+_ALIGNMENT = 64
+
+
+def template_checksum(images: Iterable[np.ndarray]) -> str:
+    """
+    a fingerprint of a list of images, their order, shapes, dtypes and pixels. A saved teller remembers the checksum of
+    its possible images so that it can't be loaded for a different set of images.
+
+    Images are fingerprinted the way a TemplateStore stores them, so a list of images and the teller made of them have
+    the same checksum.
+    """
+    images = list(images)
+    shape_to_images = dict()
+    for img in images:
+        if img is not None:  # None for images removed from a teller
+            shape_to_images.setdefault(tuple(img.shape[:2]), []).append(img)
+    layouts = {shape: _layout_of(same) for shape, same in shape_to_images.items()}
+
+    return _combined_checksum(None if img is None else _image_checksum(_with_layout(img, *layouts[img.shape[:2]]))
+                              for img in images)
+
+
+def _image_checksum(img: np.ndarray) -> bytes:
+    checksum = hashlib.blake2b(digest_size=16)
+    checksum.update(repr((img.shape, img.dtype.str)).encode())
+    checksum.update(np.ascontiguousarray(img))
+    return checksum.digest()
+
+
+def _combined_checksum(image_checksums: Iterable[Optional[bytes]]) -> str:
+    """
+    :param image_checksums: the _image_checksum of every image in order, None for removed images. They can be
+        computed in any order, e.g. one shape at a time
+    """
+    checksum = hashlib.blake2b(digest_size=16)
+    for image_checksum in image_checksums:
+        checksum.update(b'None' if image_checksum is None else image_checksum)
+    return checksum.hexdigest()
+
+
+class _IndexWriter:
+    """
+    writes the arrays of a teller one after another, aligned so they can be memory mapped, and a json footer that
+    tells where they are. Arrays can be written as soon as they're ready without holding all of them in memory.
+
+    layout: magic, version, arrays..., footer json, footer length, magic
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+        self._file.write(_MAGIC + np.array([FORMAT_VERSION, 0], dtype='<u4').tobytes())
+        self._arrays = dict()
+
+    def add(self, name: str, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        self._file.write(b'\0' * (-self._file.tell() % _ALIGNMENT))
+        self._arrays[name] = (self._file.tell(), array.dtype.str, array.shape)
+        self._file.write(array.data if array.size else b'')
+
+    def close(self, meta: dict):
+        meta = dict(meta, version=FORMAT_VERSION, arrays=self._arrays)
+        footer = json.dumps(meta).encode()
+        self._file.write(footer + np.array([len(footer)], dtype='<u8').tobytes() + _MAGIC)
+        self._file.close()
+
+    def discard(self):
+        """
+        close and remove the file, e.g. when the teller can't be written in full
+        """
+        self._file.close()
+        os.remove(self._file.name)
+
+
+def _read_index(path: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    :return: the footer and read-only memory mapped views of all arrays written by _IndexWriter
+    """
+    raw = np.memmap(path, dtype=np.uint8, mode='r')
+
+    if len(raw) < 32 or raw[:8].tobytes() != _MAGIC or raw[-8:].tobytes() != _MAGIC:
+        raise ValueError("%s is not a saved ImageTeller" % path)
+
+    version = int(raw[8:12].view('<u4')[0])
+    if version != FORMAT_VERSION:
+        raise ValueError("%s has format version %d, only version %d is supported" % (path, version, FORMAT_VERSION))
+
+    footer_length = int(raw[-16:-8].view('<u8')[0])
+    meta = json.loads(raw[-16 - footer_length:-16].tobytes().decode())
+
+    arrays = dict()
+    for name, (offset, dtype, shape) in meta['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        arrays[name] = raw[offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+
+    return meta, arrays
+
+
+def _layout_of(images: Iterable[np.ndarray]) -> Tuple[int, np.dtype]:
+    """
+    :return: channels and dtype that all of <images> fit in: the most channels of any of them, and a dtype that holds
+        the values of all of them
+    """
+    images = list(images)
+    channels = max(1 if img.ndim == 2 else img.shape[2] for img in images)
+    return channels, np.result_type(*images)
+
+
+def _with_layout(img: np.ndarray, channels: int, dtype: np.dtype) -> np.ndarray:
+    """
+    <img> as an image of <channels> channels and <dtype>. Gray is repeated to every color channel and missing alpha is
+    opaque, like cv2.cvtColor does it. Values keep their numbers, they're not scaled to the new dtype.
+    """
+    if img.ndim == 2:
+        img = img[..., None]
+    assert img.ndim == 3, "Please provide 2 dimensional grayscale images or images with a channel axis"
+
+    have = img.shape[2]
+    if have != channels:
+        assert (have, channels) in ((1, 3), (1, 4), (3, 4)), \
+            "can't put images of %d and %d channels of the same size together" % (have, channels)
+        img = img.astype(dtype)
+        if have == 1:
+            img = np.repeat(img, 3, axis=2)
+        if channels == 4:
+            opaque = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1
+            img = np.concatenate([img, np.full(img.shape[:2] + (1,), opaque, dtype=dtype)], axis=2)
+
+    return img.astype(dtype, copy=False)
+
+
+def _alpha_masks(images: List[np.ndarray]) -> Tuple[List[np.ndarray], List[Optional[np.ndarray]]]:
+    """
+    split BGRA images into BGR images and masks of their opaque pixels. Semi transparent pixels are blended with
+    whatever is behind them, so they're masked out too. Other images are returned as they are, without a mask.
+    """
+    colors, masks = [], []
+    for img in images:
+        if img.ndim == 3 and img.shape[2] == 4:
+            opaque = np.iinfo(img.dtype).max if np.issubdtype(img.dtype, np.integer) else 1
+            colors.append(img[..., :3])
+            masks.append(img[..., 3] == opaque)
+        else:
+            colors.append(img)
+            masks.append(None)
+    return colors, masks
+
+
+class TemplateStore:
+    """
+    The possible images of a teller, packed into one contiguous (images, rows, columns, channels) array per shape.
+    Every image is a view into the array of its shape, so probing, verifying and analyzing never copy an image.
+
+    Images keep their channels and dtype: grayscale images are stored with 1 channel, BGR with 3 and BGRA with 4, of
+    uint8, uint16 or any other dtype. Only images of the same size but different channels or dtypes are converted to a
+    common layout, see _with_layout.
+
+    With a path the arrays are written to that file and memory mapped. Processes that open the same file share its
+    pages through the page cache instead of each holding a copy of the images.
+
+    Images can have a mask of the pixels that count, e.g. the opaque pixels of an icon whose background changes. The
+    masks of a shape are packed into one (images, rows, columns) bool array too, only shapes with masked images have
+    one.
+    """
+
+    def __init__(self, images: List[np.ndarray], path: Optional[str] = None,
+                 masks: Optional[List[Optional[np.ndarray]]] = None):
+        """
+        :param images: a list of numpy images, (rows, columns) for grayscale or (rows, columns, channels)
+        :param path: if given, the images are written to this file, one shape at a time, and memory mapped from it
+        :param masks: if given, a (rows, columns) bool array for every image, True where the pixels of the image count.
+            None for images whose pixels all count
+        """
+        assert masks is None or len(masks) == len(images), "give one mask per image"
+        masks = masks or [None] * len(images)
+
+        shape_to_indexes = dict()
+        for index, img in enumerate(images):
+            assert img.ndim in (2, 3), "Please provide 2 dimensional grayscale images or images with a channel axis"
+            assert masks[index] is None or masks[index].shape == img.shape[:2], "a mask has the shape of its image"
+            shape_to_indexes.setdefault(tuple(img.shape[:2]), []).append(index)
+
+        mask_stacks = {shape: self._mask_stack([masks[index] for index in indexes], shape) for shape, indexes in
+                       shape_to_indexes.items() if any(masks[index] is not None for index in indexes)}
+
+        if path is None:
+            stacks = {shape: self._stack([images[index] for index in indexes]) for shape, indexes in
+                      shape_to_indexes.items()}
+        else:
+            writer = _IndexWriter(path)
+            for number, (shape, indexes) in enumerate(shape_to_indexes.items()):
+                writer.add('%d/stack' % number, self._stack([images[index] for index in indexes]))
+                if shape in mask_stacks:
+                    writer.add('%d/mask' % number, mask_stacks[shape])
+            writer.close({'count': len(images), 'buckets': [[list(shape), indexes] for shape, indexes in
+                                                            shape_to_indexes.items()]})
+            opened = TemplateStore.open(path)
+            stacks, mask_stacks = opened.stacks, opened.mask_stacks
+
+        self._assign(len(images), shape_to_indexes, stacks, mask_stacks)
+
+    @staticmethod
+    def _stack(images: List[np.ndarray]) -> np.ndarray:
+        layout = _layout_of(images)
+        return np.stack([_with_layout(img, *layout) for img in images])
+
+    @staticmethod
+    def _mask_stack(masks: List[Optional[np.ndarray]], shape: Tuple[int, int]) -> np.ndarray:
+        return np.stack([np.ones(shape, dtype=bool) if mask is None else mask.astype(bool) for mask in masks])
+
+    def _assign(self, count: int, shape_to_indexes: Dict[Tuple[int, int], List[int]],
+                stacks: Dict[Tuple[int, int], np.ndarray],
+                mask_stacks: Optional[Dict[Tuple[int, int], np.ndarray]] = None):
+        self.shape_to_indexes = shape_to_indexes
+        self.stacks = stacks
+        self.mask_stacks = mask_stacks or dict()
+        self.images: List[Optional[np.ndarray]] = [None] * count  # None for removed images
+        self.masks: List[Optional[np.ndarray]] = [None] * count  # None for images whose shape has no masks
+
+        for shape in shape_to_indexes:
+            self._reassign(shape)
+
+    @classmethod
+    def open(cls, path: str) -> 'TemplateStore':
+        """
+        memory map the images of a file written by a TemplateStore or by ImageTeller.save
+        """
+        return cls._from_index(*_read_index(path))
+
+    @classmethod
+    def _from_index(cls, meta: dict, arrays: Dict[str, np.ndarray]) -> 'TemplateStore':
+        store = cls.__new__(cls)
+        shape_to_indexes = {tuple(shape): indexes for shape, indexes in meta['buckets']}
+        stacks = {shape: arrays['%d/stack' % number] for number, shape in enumerate(shape_to_indexes)}
+        mask_stacks = {shape: arrays['%d/mask' % number] for number, shape in enumerate(shape_to_indexes) if
+                       '%d/mask' % number in arrays}
+        store._assign(meta['count'], shape_to_indexes, stacks, mask_stacks)
+        return store
+
+    def add(self, img: np.ndarray, mask: Optional[np.ndarray] = None) -> int:
+        """
+        append <img> to the array of its shape. The array is reallocated in memory, a memory mapped array stops being
+        memory mapped.
+
+        If <img> has more channels or a wider dtype than the images of its shape, all of them are converted to a layout
+        that fits <img>.
+
+        :param mask: see TemplateStore
+        :return: the index of <img>, which is never an index that was used before
+        """
+        assert img.ndim in (2, 3), "Please provide 2 dimensional grayscale images or images with a channel axis"
+        assert mask is None or mask.shape == img.shape[:2], "a mask has the shape of its image"
+
+        shape = tuple(img.shape[:2])
+        index = len(self.images)
+        self.images.append(None)
+        self.masks.append(None)
+
+        if shape in self.mask_stacks or mask is not None:
+            before = self.mask_stacks.get(shape)
+            if before is None:
+                before = np.ones((len(self.shape_to_indexes.get(shape, [])),) + shape, dtype=bool)
+            self.mask_stacks[shape] = np.concatenate([before, self._mask_stack([mask], shape)])
+
+        if shape in self.stacks:
+            stack = self.stacks[shape]
+            channels, dtype = _layout_of([stack[0], img])
+            if channels != stack.shape[3] or dtype != stack.dtype:
+                stack = np.stack([_with_layout(existing, channels, dtype) for existing in stack])
+            self.stacks[shape] = np.concatenate([stack, _with_layout(img, channels, dtype)[None]])
+            self.shape_to_indexes[shape].append(index)
+        else:
+            self.stacks[shape] = _with_layout(img, *_layout_of([img]))[None].copy()
+            self.shape_to_indexes[shape] = [index]
+
+        self._reassign(shape)
+        return index
+
+    def remove(self, index: int):
+        """
+        drop the image of <index>. The indexes of other images don't change, <index> just stays empty.
+        """
+        assert self.images[index] is not None, "image %d is not in the store" % index
+
+        shape = tuple(self.images[index].shape[:2])
+        indexes = self.shape_to_indexes[shape]
+        row = indexes.index(index)
+
+        self.images[index] = None
+        self.masks[index] = None
+        del indexes[row]
+
+        if indexes:
+            self.stacks[shape] = np.delete(self.stacks[shape], row, axis=0)
+            if shape in self.mask_stacks:
+                self.mask_stacks[shape] = np.delete(self.mask_stacks[shape], row, axis=0)
+            self._reassign(shape)
+        else:
+            del self.stacks[shape]
+            del self.shape_to_indexes[shape]
+            self.mask_stacks.pop(shape, None)
+
+    def _reassign(self, shape: Tuple[int, int]):
+        stack = self.stacks[shape]
+        mask_stack = self.mask_stacks.get(shape)
+        for row, index in enumerate(self.shape_to_indexes[shape]):
+            self.images[index] = stack[row]
+            self.masks[index] = None if mask_stack is None else mask_stack[row]
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.images[index]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        return iter(self.images)
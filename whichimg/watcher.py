@@ -0,0 +1,153 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import List, Optional, Callable, Tuple, AsyncIterator
+
+import numpy as np
+
+from whichimg.main import ImageTeller, _FrameWatch
+
+Box = Tuple[int, int, int, int]  # x, y, width, height
+
+
+class Region:
+    """
+    a fixed part of the screen that one teller keeps telling, see ScreenWatcher.watch. Iterate it with async for to get
+    (screenshot number, index) whenever its index changes, starting with the first screenshot.
+    """
+
+    def __init__(self, teller: ImageTeller, box: Box, interval: float, verify_every: int = 0):
+        self.teller = teller
+        self.box = box
+        self.interval = interval
+        self.index: Optional[int] = None  # the index of the latest told screenshot
+        self._watch = _FrameWatch(teller, verify_every)
+        self._due = 0.0  # loop time of the next tell
+        self._busy = False  # a tell of this region is running in the executor
+        self._changes: Optional[asyncio.Queue] = None  # created in the event loop, see _queue
+
+    def _queue(self) -> asyncio.Queue:
+        if self._changes is None:
+            self._changes = asyncio.Queue()
+        return self._changes
+
+    def _see(self, number: int, screenshot: np.ndarray) -> Optional[Tuple[int, int]]:
+        """
+        runs in the executor
+
+        :return: (screenshot number, index) if the index changed
+        """
+        x, y, width, height = self.box
+        index = self._watch.see(screenshot[y:y + height, x:x + width])  # a view, nothing is copied
+        if index == self.index:
+            return None
+        self.index = index
+        return number, index
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[int, int]]:
+        while True:
+            change = await self._queue().get()
+            if change is None:  # the watcher stopped
+                return
+            yield change
+
+
+class ScreenWatcher:
+    """
+    watches many regions of the screen at once, every one with its own teller and poll interval. The screen is grabbed
+    once per tick, and every region that's due reads its part of that one screenshot without copying it. Grabbing and
+    telling run in a thread executor, so the event loop stays free for the bot.
+
+        watcher = ScreenWatcher(grab_screen)
+        health = watcher.watch(health_teller, (10, 10, 120, 16), interval=0.1)
+        menu = watcher.watch(menu_teller, (800, 40, 64, 64), interval=0.5)
+
+        async def on_health():
+            async for number, index in health:
+                ...
+
+        await asyncio.gather(watcher.run(), on_health(), ...)
+
+    A region that's still being told when it's due again skips that tick, slow regions don't pile up work.
+    """
+
+    def __init__(self, grab: Callable[[], np.ndarray], executor: Optional[Executor] = None):
+        """
+        :param grab: returns a screenshot, e.g. from mss or PIL.ImageGrab converted to a BGR numpy array
+        :param executor: where screenshots are grabbed and told, a thread pool of its own by default
+        """
+        self._grab = grab
+        self._executor = executor
+        self._regions: List[Region] = []
+        self._running = False
+
+    def watch(self, teller: ImageTeller, box: Box, interval: float = 0.1, verify_every: int = 0) -> Region:
+        """
+        :param box: x, y, width, height of the region in the screenshot
+        :param interval: seconds between two tells of the region
+        :param verify_every: see ImageTeller.stream
+        :return: the region, iterate it with async for to get its changes
+        """
+        assert interval > 0, "the interval has to be positive"
+        region = Region(teller, box, interval, verify_every)
+        self._regions.append(region)
+        return region
+
+    async def run(self):
+        """
+        grab and tell until stop is called. When it returns the iterators of all regions end, and exceptions of grab
+        or of a teller are raised here.
+        """
+        loop = asyncio.get_event_loop()
+        executor = self._executor or ThreadPoolExecutor(thread_name_prefix='whichimg watcher')
+        tasks = set()
+        number = 0
+        self._running = True
+
+        try:
+            while self._running:
+                for task in [task for task in tasks if task.done()]:
+                    tasks.discard(task)
+                    task.result()  # raises what the tell raised
+
+                now = loop.time()
+                due = [region for region in self._regions if region._due <= now and not region._busy]
+                if not due:
+                    idle = [region._due for region in self._regions if not region._busy]
+                    timeout = max(0.0, min(idle) - now) if idle else None
+                    if tasks:  # a region that's done telling may be due already
+                        await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    else:
+                        await asyncio.sleep(0.01 if timeout is None else timeout)
+                    continue
+
+                screenshot = await loop.run_in_executor(executor, self._grab)
+                for region in due:
+                    region._due = max(region._due + region.interval, now)
+                    region._busy = True
+                    tasks.add(loop.create_task(self._tell(loop, executor, region, number, screenshot)))
+                number += 1
+
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            self._running = False
+            for region in self._regions:
+                region._queue().put_nowait(None)
+            if self._executor is None:
+                executor.shutdown(wait=False)
+
+    @staticmethod
+    async def _tell(loop: asyncio.AbstractEventLoop, executor: Executor, region: Region, number: int,
+                    screenshot: np.ndarray):
+        try:
+            change = await loop.run_in_executor(executor, region._see, number, screenshot)
+        finally:
+            region._busy = False
+        if change is not None:
+            region._queue().put_nowait(change)
+
+    def stop(self):
+        """
+        make run return after the tells in progress
+        """
+        self._running = False